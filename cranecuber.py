@@ -18,30 +18,24 @@ Motor connections
 - D is squisher
 """
 
+from time import time
+LAUNCH_TIME = time()
+
+# Startup time matters on the EV3 so only the cheap modules are imported
+# here.  ev3dev2 (PIL for the display in particular), json, re and argparse
+# are imported where they are used.
+from collections import deque
 from copy import deepcopy
-from ev3dev2 import get_current_platform
-from ev3dev2.display import Display
-from ev3dev2.led import Leds
-from ev3dev2.port import LegoPort
-from ev3dev2.sensor import INPUT_1, INPUT_2, INPUT_3, INPUT_4
-from ev3dev2.sensor.lego import TouchSensor
-from ev3dev2.motor import OUTPUT_A, OUTPUT_B, OUTPUT_C, OUTPUT_D, LargeMotor, MediumMotor
-from math import pi, sqrt
-from pprint import pformat
-from select import select
-from threading import Thread, Event
-from time import sleep
-import argparse
+from math import pi
+from select import select, poll, POLLPRI, POLLERR
+from threading import Thread, Event, Lock
 import datetime
-import json
 import logging
 import math
 import os
-import re
-import shutil
+import protocol
 import signal
 import socket
-import subprocess
 import sys
 
 log = logging.getLogger(__name__)
@@ -59,6 +53,79 @@ TURNTABLE_TURN_DEGREES = 420
 TURN_FREE_TOUCH_DEGREES = 80
 TURN_FREE_SQUARE_TT_DEGREES = -80
 
+# When the elevator or flipper jams we first back off this many degrees and
+# try again before moving on to the more expensive recovery steps
+ELEVATOR_JAM_BACKOFF_DEGREES = 30
+FLIPPER_JAM_BACKOFF_DEGREES = 30
+JAM_RECOVERY_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jam-recovery.json')
+
+# The flip used to be retried up to three times, with a motor reset before
+# each retry.  Walking its recovery ladder twice keeps at least that many
+# attempts, the elevator only ever had one go at clearing a jam.
+FLIP_JAM_ROUNDS = 2
+ELEVATE_JAM_ROUNDS = 1
+
+# Motor waits are done in slices of this many ms so that a shutdown request
+# is noticed quickly instead of after the full wait timeout
+MOTOR_WAIT_SLICE_MS = 50
+
+# How often the TouchSensor watcher process re-reads the sensor if it is
+# not woken up by poll(2)
+TOUCH_SENSOR_POLL_MS = 10
+
+# The display is redrawn in the background at most this many times per second
+DISPLAY_MAX_REFRESH_HZ = 4
+
+# The most recent TRACE_BUFFER_SIZE trace events are kept in memory
+TRACE_BUFFER_SIZE = 20000
+TRACE_FILENAME = '/tmp/cranecuber-trace.log'
+
+# With --trace the robot and cranecuberd spans of each solve are merged into
+# one timeline, %d is the solve_id
+SOLVE_TIMELINE_FILENAME = '/tmp/cranecuber-solve-%d.log'
+
+# If the last solve parked the robot cleanly init_motors() only checks that
+# the motors are within this many degrees of where park() left them
+WARM_HOMING_TOLERANCE_DEGREES = 10
+
+# Estimated ms for each primitive, used by plan_scan_route() to pick the
+# fastest way to show all six sides to the camera
+SCAN_ROUTE_COSTS_MS = {
+    'elevate_short': 300,   # 0 <-> 1 row or 1 row <-> all rows
+    'elevate_long': 450,    # 0 <-> all rows
+    'flip_cube': 600,       # flip with the cube in the flipper
+    'flip_clear': 250,      # flip with the cube up in the turntable
+    'rotate_90': 800,
+    'rotate_180': 1100,
+}
+
+# The side that must be at the top of the picture of each side.  The tracker
+# and resolver expect the pictures the fixed route takes, U with B at the
+# top, D with F at the top and the other four with U at the top.
+SCAN_PICTURE_UP = {
+    'F': 'U',
+    'R': 'U',
+    'B': 'U',
+    'L': 'U',
+    'U': 'B',
+    'D': 'F',
+}
+
+# The resident agent (--agent) takes jobs on this localhost port
+AGENT_PORT = 10001
+
+# The primitives a RUN_PROGRAM job is allowed to call and the type of each of
+# their arguments
+AGENT_PROGRAM_PRIMITIVES = {
+    'elevate': (int,),
+    'elevate_max': (),
+    'flip': (bool,),
+    'flip_to_init': (),
+    'rotate': (bool, int, bool),
+    'squish': (),
+    'squisher_reset': (),
+}
+
 # References
 # ==========
 # cube sizes
@@ -67,6 +134,178 @@ TURN_FREE_SQUARE_TT_DEGREES = -80
 # README editing
 # https://jbt.github.io/markdown-editor/
 
+class TraceBuffer(object):
+    """
+    Low overhead tracing for the motion hot paths.  event() only appends a
+    (timestamp, format, args) tuple to a ring buffer, the string formatting
+    is deferred until dump() is called after the solve or when something
+    goes wrong.
+
+    verbose logs each event as it happens plus the motor state lines from
+    motor_state(), those require a sysfs read so they are only done in
+    verbose mode.
+    """
+
+    def __init__(self, size=TRACE_BUFFER_SIZE):
+        self.enabled = False
+        self.verbose = False
+        self.events = deque(maxlen=size)
+
+    def event(self, fmt, *args):
+
+        if self.enabled:
+            self.events.append((time(), fmt, args))
+
+        if self.verbose:
+            log.info(fmt % args)
+
+    def motor_state(self, fmt, motor):
+        if self.verbose:
+            log.info(fmt % motor.state)
+
+    def dump(self, filename=TRACE_FILENAME):
+
+        if not self.enabled:
+            return
+
+        with open(filename, 'w') as fh:
+            for (timestamp, fmt, args) in self.events:
+                fh.write("%s %s\n" % (datetime.datetime.fromtimestamp(timestamp).strftime('%H:%M:%S.%f'), fmt % args))
+
+        log.info("wrote %d trace events to %s" % (len(self.events), filename))
+        self.events.clear()
+
+
+tracer = TraceBuffer()
+
+
+class SolveTrace(object):
+    """
+    Spans for one solve.  send_command() tags each request with the solve_id
+    and a new span_id, cranecuberd records its own spans (camera, PNG writes,
+    subprocesses) under that span_id.  finish() fetches those via GET_TRACE
+    and merges both sides into one timeline.
+    """
+
+    def __init__(self):
+        self.solve_id = None
+        self.spans = []
+        self.next_span_id = 0
+        self.lock = Lock()
+
+    def start(self):
+        with self.lock:
+            # ms since the epoch, easy to find in the logs of both sides
+            self.solve_id = int(time() * 1000)
+            self.spans = []
+            self.next_span_id = 0
+
+        log.info("solve %d started" % self.solve_id)
+
+    def new_span(self):
+        """
+        Returns a (solve_id, span_id) trace or None if there is no solve in
+        progress
+        """
+        with self.lock:
+            if self.solve_id is None:
+                return None
+
+            self.next_span_id += 1
+            return (self.solve_id, self.next_span_id)
+
+    def record(self, name, start, span_id=None):
+        """
+        Record a robot span from start until now
+        """
+        finish = time()
+
+        if span_id is None:
+            trace = self.new_span()
+
+            if trace is None:
+                return
+
+            span_id = trace[1]
+
+        with self.lock:
+            if self.solve_id is not None:
+                self.spans.append({
+                    'span': span_id,
+                    'parent': None,
+                    'name': name,
+                    'start': start,
+                    'ms': int((finish - start) * 1000),
+                    'side': 'robot',
+                })
+
+    def finish(self, server, filename=SOLVE_TIMELINE_FILENAME):
+        """
+        Stop tagging requests, with --trace write the merged timeline
+        """
+        import json
+
+        solve_id = self.solve_id
+
+        if solve_id is None or not tracer.enabled:
+            self.solve_id = None
+            return
+
+        try:
+            server_spans = json.loads(send_command(server, 10000, "GET_TRACE:%d" % solve_id))
+        except Exception as e:
+            log.warning("GET_TRACE failed, the timeline will only have robot spans: %s" % e)
+            server_spans = []
+
+        with self.lock:
+            self.solve_id = None
+            spans = list(self.spans)
+
+        # cranecuberd's clock is not our clock.  For each request we know when
+        # we sent it and when the response arrived, cranecuberd knows when it
+        # started and finished handling it.  The request that spent the least
+        # time on the network gives the best estimate of the offset.
+        requests = dict((span['span'], span) for span in spans)
+        offset = 0
+        best_network_ms = None
+
+        for span in server_spans:
+            robot_span = requests.get(span['parent'])
+
+            if not span['name'].startswith('request ') or robot_span is None:
+                continue
+
+            network_ms = robot_span['ms'] - span['ms']
+
+            if best_network_ms is None or network_ms < best_network_ms:
+                best_network_ms = network_ms
+                offset = ((span['start'] - robot_span['start']) +
+                          (span['start'] + span['ms'] / 1000.0 - robot_span['start'] - robot_span['ms'] / 1000.0)) / 2
+
+        for span in server_spans:
+            span['start'] -= offset
+            span['side'] = 'cranecuberd'
+
+        spans.extend(server_spans)
+        spans.sort(key=lambda span: span['start'])
+        filename = filename % solve_id
+
+        with open(filename, 'w') as fh:
+            fh.write("solve %d, cranecuberd clock offset %dms (best request spent %sms on the network)\n" %
+                     (solve_id, offset * 1000, best_network_ms))
+            fh.write("%8s %8s  %-11s  %-6s  %-6s  %s\n" % ('at_ms', 'ms', 'side', 'span', 'parent', 'name'))
+
+            for span in spans:
+                fh.write("%8d %8d  %-11s  %-6s  %-6s  %s\n" %
+                         ((span['start'] - spans[0]['start']) * 1000, span['ms'], span['side'],
+                          span['span'], span['parent'] or '', span['name']))
+
+        log.info("wrote %d robot and %d cranecuberd spans to %s" % (len(spans) - len(server_spans), len(server_spans), filename))
+
+
+solve_trace = SolveTrace()
+
+
 def round_to_quarter_turn(target_degrees):
     """
     round target_degrees up/down so that it is a multiple of TURNTABLE_TURN_DEGREES
@@ -74,12 +313,13 @@ def round_to_quarter_turn(target_degrees):
     a = int(target_degrees/TURNTABLE_TURN_DEGREES)
 
     if target_degrees % TURNTABLE_TURN_DEGREES == 0:
-        log.info("round_to_quarter_turn %d is already a multiple of %d" % (target_degrees, TURNTABLE_TURN_DEGREES))
+        tracer.event("round_to_quarter_turn %d is already a multiple of %d", target_degrees, TURNTABLE_TURN_DEGREES)
         return target_degrees
 
-    log.info("round_to_quarter_turn %d/%d is %s" % (target_degrees, TURNTABLE_TURN_DEGREES, float(target_degrees/TURNTABLE_TURN_DEGREES)))
+    tracer.event("round_to_quarter_turn %d/%d is %s",
+        target_degrees, TURNTABLE_TURN_DEGREES, float(target_degrees/TURNTABLE_TURN_DEGREES))
     result = int(round(float(target_degrees/TURNTABLE_TURN_DEGREES)) * TURNTABLE_TURN_DEGREES)
-    log.info("round_to_quarter_turn result is %s" % result)
+    tracer.event("round_to_quarter_turn result is %s", result)
     return result
 
 
@@ -93,11 +333,273 @@ def convert_key_strings_to_int(data):
     return result
 
 
+# (rows_and_cols, start state) -> (route, cost_ms)
+scan_route_cache = {}
+
+
+def plan_scan_route(rows_and_cols, rows_in_turntable, flipper_at_init, facing, scanned):
+    """
+    Find the fastest sequence of elevate/flip/rotate/scan_face steps that
+    shows every side not in 'scanned' to the camera.  The camera sees the
+    south side when no rows are in the turntable and the flipper is at init,
+    a side only counts as scanned if it is the right way up for the tracker
+    (see SCAN_PICTURE_UP).
+
+    facing is (north, west, south, east, up, down), the orientation changes
+    match the bookkeeping in flip() and rotate().  Returns (route, cost_ms)
+    where each scan_face step names the side it expects to be facing south.
+    """
+    import heapq
+
+    start = (rows_in_turntable, flipper_at_init, tuple(facing), frozenset(scanned))
+
+    if (rows_and_cols, start) in scan_route_cache:
+        return scan_route_cache[(rows_and_cols, start)]
+
+    def moves(state):
+        (rows, at_init, facing, scanned) = state
+        (north, west, south, east, up, down) = facing
+
+        if rows == 0 and at_init and south not in scanned and up == SCAN_PICTURE_UP[south]:
+            yield (('scan_face', south), 0, (rows, at_init, facing, scanned | frozenset([south])))
+
+        for target in (0, 1, rows_and_cols):
+            if target != rows:
+                if (target, rows) in ((0, rows_and_cols), (rows_and_cols, 0)):
+                    cost = SCAN_ROUTE_COSTS_MS['elevate_long']
+                else:
+                    cost = SCAN_ROUTE_COSTS_MS['elevate_short']
+                yield (('elevate', target), cost, (target, at_init, facing, scanned))
+
+        # The cube only tips over if it is sitting in the flipper
+        if rows:
+            yield (('flip',), SCAN_ROUTE_COSTS_MS['flip_clear'], (rows, not at_init, facing, scanned))
+        elif at_init:
+            yield (('flip',), SCAN_ROUTE_COSTS_MS['flip_cube'],
+                   (rows, False, (up, west, down, east, south, north), scanned))
+        else:
+            yield (('flip',), SCAN_ROUTE_COSTS_MS['flip_cube'],
+                   (rows, True, (down, west, up, east, north, south), scanned))
+
+        # The entire cube only turns if it is all the way up in the turntable
+        if rows == rows_and_cols:
+            yield (('rotate', True, 1), SCAN_ROUTE_COSTS_MS['rotate_90'],
+                   (rows, at_init, (west, south, east, north, up, down), scanned))
+            yield (('rotate', False, 1), SCAN_ROUTE_COSTS_MS['rotate_90'],
+                   (rows, at_init, (east, north, west, south, up, down), scanned))
+            yield (('rotate', True, 2), SCAN_ROUTE_COSTS_MS['rotate_180'],
+                   (rows, at_init, (south, east, north, west, up, down), scanned))
+
+    # Dijkstra, the counter keeps heapq from comparing states
+    counter = 0
+    queue = [(0, counter, start, [])]
+    visited = set()
+
+    while queue:
+        (cost, _, state, route) = heapq.heappop(queue)
+
+        if state in visited:
+            continue
+        visited.add(state)
+
+        if len(state[3]) == 6:
+            scan_route_cache[(rows_and_cols, start)] = (route, cost)
+            return (route, cost)
+
+        for (step, step_cost, next_state) in moves(state):
+            if next_state not in visited:
+                counter += 1
+                heapq.heappush(queue, (cost + step_cost, counter, next_state, route + [step]))
+
+    raise Exception("could not find a scan route from %s" % str(start))
+
+
 class BrokenSocket(Exception):
     pass
 
 
-def send_command(ip, port, cmd, timeout=30):
+class DaemonError(Exception):
+    """
+    cranecuberd replied ERROR, the connection itself is fine
+    """
+    pass
+
+
+# send_command() keeps one DaemonSession per cranecuberd, --one-shot goes
+# back to a new connection per command for an older cranecuberd.  An older
+# cranecuberd dies on a command it does not know so with --one-shot we only
+# send the commands it has always had.
+daemon_sessions = {}
+use_daemon_sessions = True
+
+
+class DaemonSession(object):
+    """
+    A long lived connection to cranecuberd that carries every command of a
+    solve.  Requests and responses are length prefixed frames (see
+    protocol.py) tagged with a request id.  If the connection drops we
+    reconnect and send the command again.
+    """
+
+    def __init__(self, ip, port):
+        self.ip = ip
+        self.port = port
+        self.sock = None
+        self.lock = Lock()
+        self.request_id = 0
+        self.connects = 0
+        self.commands = 0
+        self.aborted = False
+
+    def __str__(self):
+        return "DaemonSession(%s:%d)" % (self.ip, self.port)
+
+    def connect(self):
+        start = time()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(10)
+        sock.connect((self.ip, self.port))
+
+        # Notice a dead cranecuberd within ~30s instead of the two hour default
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 10)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 4)
+
+        # Our requests are small, do not let Nagle hold them back
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+
+        try:
+            (ack, _) = self.exchange('PING', 10)
+        except BrokenSocket:
+            raise Exception("cranecuberd does not support framed sessions (try --one-shot)")
+
+        if ack != 'REPLY':
+            raise Exception("cranecuberd replied '%s' to PING (try --one-shot)" % ack)
+
+        self.connects += 1
+        log.info("%s: connected in %dms (connection %d)" % (self, (time() - start) * 1000, self.connects))
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def abort(self):
+        """
+        Called on shutdown, give up on the request in flight without taking
+        self.lock.  cranecuberd sees the connection close and cancels it,
+        the next request reconnects.
+        """
+        self.aborted = True
+        sock = self.sock
+
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def exchange(self, cmd, timeout, binary=b'', progress=None, trace=None):
+        """
+        Send one request frame and return the (text, binary) of the
+        response with the same request id.  Progress frames for the request
+        are passed to progress(), timeout applies to each frame.
+        """
+        self.request_id += 1
+        self.sock.settimeout(timeout)
+
+        try:
+            protocol.send_frame(self.sock, self.request_id, cmd, binary, trace=trace)
+
+            while True:
+                frame = protocol.recv_frame(self.sock)
+
+                if frame.request_id != self.request_id:
+                    log.warning("%s: dropped response %d while waiting for %d" % (self, frame.request_id, self.request_id))
+
+                elif frame.flags & protocol.FLAG_PROGRESS:
+                    if progress:
+                        progress(frame.text)
+                    else:
+                        log.info("%s: request %d progress %s" % (self, frame.request_id, frame.text))
+
+                else:
+                    return (frame.text, frame.binary)
+
+        except socket.timeout:
+            raise BrokenSocket("did not receive a response within %s seconds" % timeout)
+
+    def request(self, cmd, timeout, binary=b'', progress=None):
+        trace = solve_trace.new_span()
+        start = time()
+
+        with self.lock:
+            # abort() only gives up on the request in flight, the agent
+            # keeps using the session after an emergency stop
+            self.aborted = False
+
+            for attempt in (1, 2):
+                try:
+                    if self.sock is None:
+                        self.connect()
+
+                    log.info("TXed %s to cranecuberd (request %d)" % (cmd, self.request_id + 1))
+                    (response, response_binary) = self.exchange(cmd, timeout, binary, progress, trace)
+                    break
+
+                except BrokenSocket:
+                    # We may have stopped reading in the middle of a frame,
+                    # closing the connection also makes cranecuberd cancel
+                    # the command
+                    self.close()
+                    raise
+
+                except (socket.error, protocol.ProtocolError) as e:
+                    self.close()
+
+                    if self.aborted:
+                        raise Exception("%s: aborted for shutdown" % self)
+
+                    if attempt == 2:
+                        raise Exception("Could not talk to cranecuberd at %s:%d, %s" % (self.ip, self.port, e))
+
+                    log.warning("%s: %s, reconnecting" % (self, e))
+
+            self.commands += 1
+
+        if trace:
+            solve_trace.record(cmd.split(':')[0], start, trace[1])
+
+        if response_binary:
+            log.info("RXed '%s' response with %d bytes of binary" % (response, len(response_binary)))
+        else:
+            log.info("RXed '%s' response" % response)
+
+        if response.startswith('ERROR'):
+            raise DaemonError("cranecuberd %s" % response)
+
+        return (response, response_binary)
+
+    def send(self, cmd, timeout, progress=None):
+        return self.request(cmd, timeout, progress=progress)[0]
+
+
+def send_command(ip, port, cmd, timeout=30, progress=None):
+    """
+    progress is only called for a DaemonSession, with --one-shot we just
+    wait for the final response
+    """
+
+    if use_daemon_sessions:
+        if (ip, port) not in daemon_sessions:
+            daemon_sessions[(ip, port)] = DaemonSession(ip, port)
+
+        return daemon_sessions[(ip, port)].send(cmd, timeout, progress)
+
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_address = (ip, port)
 
@@ -123,12 +625,14 @@ def send_command(ip, port, cmd, timeout=30):
                 data = data.decode()
 
                 if data.startswith('ERROR'):
-                    raise Exception("cranecuberd %s" % data)
+                    raise DaemonError("cranecuberd %s" % data)
 
                 total_data.append(data)
             else:
                 break
         else:
+            # Closing the socket tells cranecuberd to cancel the command
+            sock.close()
             raise BrokenSocket("did not receive a response within %s seconds" % timeout)
 
     total_data = ''.join(total_data)
@@ -139,16 +643,111 @@ def send_command(ip, port, cmd, timeout=30):
     return total_data
 
 
+def brake_motors(motors, request_time=None):
+    """
+    Brake all of the motors in parallel, one thread per motor, so that the
+    last motor does not have to wait for the sysfs writes of the others.
+
+    Return the number of ms from request_time (defaults to now) until all
+    of the motors have stopped moving.
+    """
+    if request_time is None:
+        request_time = time()
+
+    def brake(motor):
+        motor.stop(stop_action='brake')
+        motor.wait_until_not_moving(timeout=1000)
+
+    threads = [Thread(target=brake, args=(motor,)) for motor in motors]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    return (time() - request_time) * 1000
+
+
 class CubeJammed(Exception):
     pass
 
 
+class JamRecoveryStats(object):
+    """
+    Remember which jam recovery steps have cleared a jam for each primitive
+    (elevate, flip) and cube size.  This is saved to disk so that over time
+    the recovery ladder tries the step that is most likely to work first.
+    """
+
+    def __init__(self, filename=JAM_RECOVERY_FILENAME):
+        import json
+        self.filename = filename
+        self.data = {}
+
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename, 'r') as fh:
+                    self.data = json.load(fh)
+            except (IOError, ValueError) as e:
+                log.warning("could not load %s, starting with empty jam recovery stats: %s" % (self.filename, e))
+                self.data = {}
+
+    def save(self):
+        import json
+
+        try:
+            with open(self.filename, 'w') as fh:
+                json.dump(self.data, fh, indent=4, sort_keys=True)
+        except IOError as e:
+            log.warning("could not save %s: %s" % (self.filename, e))
+
+    def record(self, primitive, size, step, success, delta_ms):
+        key = "%s-%d" % (primitive, size)
+        stats = self.data.setdefault(key, {}).setdefault(step, {'attempts': 0, 'successes': 0, 'total_ms': 0})
+        stats['attempts'] += 1
+        stats['total_ms'] += int(delta_ms)
+
+        if success:
+            stats['successes'] += 1
+
+        log.warning("%s jam recovery step %s %s after %dms (%d/%d successful for %dx%dx%d)" %
+            (primitive, step, "cleared the jam" if success else "failed", delta_ms,
+             stats['successes'], stats['attempts'], size, size, size))
+        self.save()
+
+    def ladder(self, primitive, size, steps):
+        """
+        steps is a list of (name, estimated_ms, function) tuples ordered from
+        the cheapest step to the most expensive one.  Return them sorted by
+        the expected time to clear a jam, that is the average time the step
+        takes divided by how often it works.  Steps we have no history for
+        keep their estimated_ms and are given even odds.
+        """
+        history = self.data.get("%s-%d" % (primitive, size), {})
+
+        def expected_ms(step):
+            (name, estimated_ms, _) = step
+            stats = history.get(name)
+
+            if stats and stats['attempts']:
+                avg_ms = float(stats['total_ms']) / stats['attempts']
+                success_rate = float(stats['successes'] + 1) / (stats['attempts'] + 2)
+            else:
+                avg_ms = estimated_ms
+                success_rate = 0.5
+
+            return avg_ms / success_rate
+
+        return sorted(steps, key=expected_ms)
+
+
 class DummyMotor(object):
 
     def __init__(self, address):
         self.address = address
         self.position = 0
-        self.state = None
+        self.state = []
 
     def __str__(self):
         return "DummyMotor(%s)" % self.address
@@ -159,7 +758,7 @@ class DummyMotor(object):
     def stop(self, stop_action=None):
         pass
 
-    def run_forever(self, speed_sp, stop_action):
+    def run_forever(self, speed_sp, stop_action=None):
         pass
 
     def run_to_abs_pos(self, speed_sp=None, stop_action=None, position_sp=None, ramp_up_sp=None, ramp_down_sp=None):
@@ -169,13 +768,13 @@ class DummyMotor(object):
         pass
 
     def wait_until(self, state, timeout=None):
-        pass
+        return True
 
     def wait_while(self, state, timeout=None):
-        pass
+        return True
 
     def wait_until_not_moving(self, timeout=None):
-        pass
+        return True
 
 
 class DummySensor(object):
@@ -184,27 +783,78 @@ class DummySensor(object):
         return True
 
 
-class CraneCuber3x3x3(object):
+class StartupProfile(object):
+    """
+    Record how long each startup phase took, from the moment the kernel
+    created our process until we are ready for the TouchSensor press.
+    """
+
+    def __init__(self):
+        self.phases = []
+        self.last = LAUNCH_TIME
+
+        # LAUNCH_TIME is taken after the interpreter has started, the process
+        # start time from /proc tells us how long that took
+        try:
+            with open('/proc/self/stat', 'r') as fh:
+                # field 22 is the start time in clock ticks since boot, skip
+                # past the command name in case it contains spaces
+                stat = fh.read().rsplit(')', 1)[1].split()
+                start_ticks = int(stat[19])
+
+            with open('/proc/uptime', 'r') as fh:
+                uptime = float(fh.read().split()[0])
+
+            process_age = uptime - (start_ticks / float(os.sysconf('SC_CLK_TCK')))
+            self.phases.append(('interpreter', int((process_age - (time() - LAUNCH_TIME)) * 1000)))
+        except Exception:
+            pass
+
+    def mark(self, phase):
+        now = time()
+        self.phases.append((phase, int((now - self.last) * 1000)))
+        self.last = now
+
+    def report(self):
+        total_ms = sum([ms for (phase, ms) in self.phases])
+        log.info("startup took %dms: %s" % (total_ms, ', '.join(["%s %dms" % (phase, ms) for (phase, ms) in self.phases])))
+
+
+class Hardware(object):
+    """
+    The motors, LEDs and display renderer are created once per process and
+    shared by every CraneCuber object, the main loop creates two CraneCuber
+    objects per solve.
+    """
+    instance = None
+
+    @classmethod
+    def get(cls, emulate, platform):
+        if cls.instance is None:
+            cls.instance = cls(emulate, platform)
+
+        # shutdown_robot() stops the renderer, the agent keeps going after
+        # an emergency stop so start a new one
+        elif cls.instance.renderer.shutdown_event.is_set():
+            cls.instance.renderer = DisplayRenderer()
+            cls.instance.renderer.start()
+
+        return cls.instance
+
+    def __init__(self, emulate, platform):
+        from ev3dev2.led import Leds
+        from ev3dev2.motor import OUTPUT_A, OUTPUT_B, OUTPUT_C, OUTPUT_D, LargeMotor, MediumMotor
 
-    def __init__(self, SERVER, emulate, platform, rows_and_cols=3, size_mm=57):
-        self.SERVER = SERVER
-        self.shutdown_event = Event()
-        self.rows_and_cols = rows_and_cols
-        self.size_mm = size_mm
-        self.square_size_mm = float(self.size_mm / self.rows_and_cols)
-        self.emulate = emulate
-        self.cube_for_resolver = None
-        self.mts = None
-        self.waiting_for_touch_sensor = Event()
-        self.move_north_to_top_calls = 0
-        self.move_south_to_top_calls = 0
-        self.move_east_to_top_calls = 0
-        self.move_west_to_top_calls = 0
-        self.move_down_to_top_calls = 0
         self.leds = Leds()
-        self.display = Display()
+        self.renderer = DisplayRenderer()
+        self.renderer.start()
 
-        if self.emulate:
+        # park() sets these when a solve finishes cleanly, init_motors()
+        # uses them to skip the full homing sequence
+        self.parked = False
+        self.flipper_at_init = True
+
+        if emulate:
             self.elevator = DummyMotor(OUTPUT_A)
             self.flipper = DummyMotor(OUTPUT_B)
             self.turntable = DummyMotor(OUTPUT_C)
@@ -220,6 +870,229 @@ class CraneCuber3x3x3(object):
             self.turntable = LargeMotor(OUTPUT_C)
             self.squisher = LargeMotor(OUTPUT_D)
 
+
+class DisplayRenderer(Thread):
+    """
+    Draw on the EV3 display from a background thread so that the motion loop
+    never waits on it.  show() only records the latest text, the renderer
+    coalesces updates to at most DISPLAY_MAX_REFRESH_HZ and only copies the
+    part of the framebuffer that changed.
+
+    The Display is created by the renderer thread itself, importing
+    ev3dev2.display pulls in PIL which is slow to load on the EV3 so we do
+    that in the background while the motors are initialized.
+    """
+
+    def __init__(self, max_refresh_hz=DISPLAY_MAX_REFRESH_HZ):
+        Thread.__init__(self)
+        self.daemon = True
+        self.display = None
+        self.min_interval = 1.0 / max_refresh_hz
+        self.lock = Lock()
+        self.pending = None
+        self.pending_event = Event()
+        self.shutdown_event = Event()
+        self.drawn = None
+        self.drawn_box = None
+        self.fonts = {}
+
+        # time the callers (the motion loop) spent in show()
+        self.time_show_ms = 0
+        self.show_calls = 0
+
+        # time we spent drawing in the background, the motion loop used to
+        # spend this in display.text_grid() and display.update()
+        self.time_render_ms = 0
+        self.renders = 0
+
+    def __str__(self):
+        return "DisplayRenderer"
+
+    def show(self, text, x, y, font):
+        """
+        text, x, y and font are the same as for Display.text_grid().  The
+        renderer must already be started, Hardware starts it.
+        """
+        start = time()
+
+        with self.lock:
+            self.pending = (text, x, y, font)
+            self.show_calls += 1
+
+        self.pending_event.set()
+        self.time_show_ms += (time() - start) * 1000
+
+    def stop(self):
+        self.shutdown_event.set()
+        self.pending_event.set()
+
+        if self.is_alive():
+            self.join()
+
+        if self.display:
+            self.display.reset_screen()
+            self.display.update()
+
+    def stats(self):
+        return ("%d display updates requested, %d drawn, %dms spent in the motion loop, "
+                "%dms drawing in the background that the motion loop used to wait on" %
+                (self.show_calls, self.renders, self.time_show_ms, self.time_render_ms))
+
+    def run(self):
+        from ev3dev2.display import Display
+
+        try:
+            self.display = Display()
+        except Exception as e:
+            log.exception(e)
+            return
+
+        last_render = 0
+
+        while True:
+            self.pending_event.wait()
+
+            if self.shutdown_event.is_set():
+                break
+
+            # Coalesce any updates that arrive within min_interval
+            wait = last_render + self.min_interval - time()
+
+            if wait > 0 and self.shutdown_event.wait(wait):
+                break
+
+            with self.lock:
+                pending = self.pending
+                self.pending = None
+                self.pending_event.clear()
+
+            if pending is None or pending == self.drawn:
+                continue
+
+            start = time()
+
+            try:
+                self._render(*pending)
+            except Exception as e:
+                log.exception(e)
+
+            last_render = time()
+            self.time_render_ms += (last_render - start) * 1000
+            self.renders += 1
+
+    def _render(self, text, x, y, font_name):
+
+        if font_name not in self.fonts:
+            from ev3dev2 import fonts
+            self.fonts[font_name] = fonts.load(font_name)
+        font = self.fonts[font_name]
+
+        try:
+            (width, height) = font.getsize(text)
+        except AttributeError:
+            (_, _, width, height) = font.getbbox(text)
+
+        # text_grid() uses a 6x10 pixel grid
+        pixel_x = x * 6
+        pixel_y = y * 10
+        box = (pixel_x, pixel_y, pixel_x + width, pixel_y + height)
+
+        if self.drawn_box is None:
+            self.display.clear()
+            self.display.draw.text((pixel_x, pixel_y), text, fill='black', font=font)
+            self.display.update()
+        else:
+            region = (min(box[0], self.drawn_box[0]),
+                      min(box[1], self.drawn_box[1]),
+                      max(box[2], self.drawn_box[2]),
+                      max(box[3], self.drawn_box[3]))
+            self.display.draw.rectangle(region, fill='white')
+            self.display.draw.text((pixel_x, pixel_y), text, fill='black', font=font)
+            self._update_region(region)
+
+        self.drawn = (text, x, y, font_name)
+        self.drawn_box = box
+
+    def _update_region(self, region):
+        """
+        Copy the rows and columns in region from the display's image to the
+        framebuffer.  Fall back to a full update for framebuffer formats we
+        do not handle.
+        """
+        display = self.display
+
+        try:
+            bits_per_pixel = display.var_info.bits_per_pixel
+            line_length = display.fix_info.line_length
+            (screen_width, screen_height) = display.image.size
+        except AttributeError:
+            display.update()
+            return
+
+        (x0, y0, x1, y1) = region
+        x1 = min(x1, screen_width)
+        y1 = min(y1, screen_height)
+
+        if bits_per_pixel == 1:
+            # 8 pixels per byte so the columns must be byte aligned
+            x0 = (x0 // 8) * 8
+            x1 = min(((x1 + 7) // 8) * 8, screen_width)
+            crop = display.image.crop((x0, y0, x1, y1)).tobytes("raw", "1;R")
+            offset = x0 // 8
+        elif bits_per_pixel == 32:
+            crop = display.image.crop((x0, y0, x1, y1)).convert("RGB").tobytes("raw", "XRGB")
+            offset = x0 * 4
+        else:
+            display.update()
+            return
+
+        if y1 <= y0:
+            return
+
+        row_length = len(crop) // (y1 - y0)
+
+        for row in range(y1 - y0):
+            start = ((y0 + row) * line_length) + offset
+            display.mmap[start:start + row_length] = crop[row * row_length:(row + 1) * row_length]
+
+
+class CraneCuber3x3x3(object):
+
+    # The agent handles SIGTERM/SIGINT itself, it clears this so the
+    # CraneCuber objects it creates for each job do not take them over
+    install_signal_handlers = True
+
+    def __init__(self, SERVER, emulate, platform, rows_and_cols=3, size_mm=57):
+        self.SERVER = SERVER
+        self.platform = platform
+        self.shutdown_event = Event()
+        self.rows_and_cols = rows_and_cols
+        self.size_mm = size_mm
+        self.square_size_mm = float(self.size_mm / self.rows_and_cols)
+        self.emulate = emulate
+        self.cube_for_resolver = None
+        self.resolved_colors = None
+        self.speculative_thread = None
+        self.speculative_solution = None
+        self.speculative_error = None
+        self.speculative_finish = None
+        self.mts = None
+        self.waiting_for_touch_sensor = Event()
+        self.touch_sensor_pressed = Event()
+        self.move_north_to_top_calls = 0
+        self.move_south_to_top_calls = 0
+        self.move_east_to_top_calls = 0
+        self.move_west_to_top_calls = 0
+        self.move_down_to_top_calls = 0
+        hardware = Hardware.get(emulate, platform)
+        self.hardware = hardware
+        self.leds = hardware.leds
+        self.renderer = hardware.renderer
+        self.elevator = hardware.elevator
+        self.flipper = hardware.flipper
+        self.turntable = hardware.turntable
+        self.squisher = hardware.squisher
+
         #self.elevator.total_distance = 0
         #self.flipper.total_distance = 0
         #self.turntable.total_distance = 0
@@ -233,13 +1106,18 @@ class CraneCuber3x3x3(object):
         self.facing_east = 'R'
         self.facing_up = 'U'
         self.facing_down = 'D'
-        signal.signal(signal.SIGTERM, self.signal_term_handler)
-        signal.signal(signal.SIGINT, self.signal_int_handler)
+
+        if self.install_signal_handlers:
+            signal.signal(signal.SIGTERM, self.signal_term_handler)
+            signal.signal(signal.SIGINT, self.signal_int_handler)
+
         self.time_elevate = 0
         self.time_flip = 0
         self.time_rotate = 0
         self.flipper_at_init = True
         self.colors = {}
+        self.scan_face_ms = {}
+        self.jam_stats = None
 
         # positive moves to init position
         # negative moves towards camera
@@ -267,23 +1145,79 @@ class CraneCuber3x3x3(object):
         self.SQUISH_SPEED_OPEN = 400
         self.rows_in_turntable_to_count_as_face_turn = 2
 
+        # 'planned' uses plan_scan_route(), 'fixed' is the original route
+        # that scans F R B L U D and then moves F back to the camera
+        self.SCAN_ROUTE = 'planned'
+
+    def motors_parked(self):
+        """
+        Return True if the last solve ended with park() and the motors are
+        still where it left them
+        """
+        if not self.hardware.parked or not self.hardware.flipper_at_init:
+            return False
+
+        turntable_pos = self.turntable.position
+        errors = (
+            (self.elevator, self.elevator.position),
+            (self.flipper, self.flipper.position),
+            (self.turntable, turntable_pos - round_to_quarter_turn(turntable_pos)),
+            (self.squisher, self.squisher.position),
+        )
+
+        for (motor, error) in errors:
+            if abs(error) > WARM_HOMING_TOLERANCE_DEGREES:
+                log.warning("%s is %d degrees from its parked position" % (motor, error))
+                return False
+
+            if 'stalled' in motor.state or 'overloaded' in motor.state:
+                log.warning("%s is %s" % (motor, ', '.join(motor.state)))
+                return False
+
+        return True
+
     def init_motors(self):
 
         if self.leds:
             self.leds.set_color('LEFT', 'ORANGE')
             self.leds.set_color('RIGHT', 'ORANGE')
 
+        start = datetime.datetime.now()
+
+        # If the motors are where the last solve left them there is no need
+        # to home everything again
+        if self.motors_parked():
+            self.hardware.parked = False
+            self.flipper_at_init = True
+            self.flipper.stop(stop_action="hold")
+
+            turntable_pos = self.turntable.position
+            self.turntable.position = turntable_pos - round_to_quarter_turn(turntable_pos)
+            self.turntable.stop(stop_action='hold')
+            self.squisher.stop(stop_action='brake')
+
+            finish = datetime.datetime.now()
+            delta_ms = ((finish - start).seconds * 1000) + ((finish - start).microseconds / 1000)
+            log.info("Initialize motors - verified parked positions in %dms, skipped full homing" % delta_ms)
+
+            if self.leds:
+                self.leds.set_color('LEFT', 'GREEN')
+                self.leds.set_color('RIGHT', 'GREEN')
+            return
+
+        self.hardware.parked = False
+
         # 'brake' stops but doesn't hold the motor in place
         # 'hold' stops and holds the motor in place
-        sleep(1)
+        self.shutdown_event.wait(1)
 
         # Lower all the way down, then raise a bit, then lower back down.
         # We do this to make sure it is in the same starting spot each time.
         '''
         log.info("Initialize elevator %s - lower all the way down" % self.elevator)
         self.elevator.run_forever(speed_sp=10, stop_action='brake')
-        self.elevator.wait_until("running")
-        self.elevator.wait_until_not_moving(timeout=10000)
+        self.motor_wait_until(self.elevator, "running")
+        self.motor_wait_until_not_moving(self.elevator, timeout=10000)
         self.elevator.stop()
         self.elevator.reset()
         '''
@@ -292,19 +1226,19 @@ class CraneCuber3x3x3(object):
         self.elevator.reset()
         self.elevator.stop(stop_action='coast')
         self.elevator.run_to_rel_pos(speed_sp=200, position_sp=-50)
-        self.elevator.wait_until("running", timeout=4000)
-        self.elevator.wait_until_not_moving(timeout=4000)
+        self.motor_wait_until(self.elevator, "running", timeout=4000)
+        self.motor_wait_until_not_moving(self.elevator, timeout=4000)
 
         log.info("Initialize elevator %s - lower back down" % self.elevator)
         self.elevator.run_forever(speed_sp=20)
-        if self.elevator.wait_until("running", timeout=3000):
-            self.elevator.wait_until_not_moving(timeout=15000)
+        if self.motor_wait_until(self.elevator, "running", timeout=3000):
+            self.motor_wait_until_not_moving(self.elevator, timeout=15000)
         self.elevator.position = 0
 
         log.info("Initialize flipper %s" % self.flipper)
         self.flipper.run_forever(speed_sp=150, stop_action='hold')
-        if self.flipper.wait_until("running", timeout=4000):
-            self.flipper.wait_until_not_moving(timeout=4000)
+        if self.motor_wait_until(self.flipper, "running", timeout=4000):
+            self.motor_wait_until_not_moving(self.flipper, timeout=4000)
         self.flipper.position = 0
         self.flipper_at_init = True
         self.flipper.stop(stop_action="hold")
@@ -317,33 +1251,80 @@ class CraneCuber3x3x3(object):
         self.squisher_reset()
         self.squisher.stop(stop_action='brake')
 
+        finish = datetime.datetime.now()
+        delta_ms = ((finish - start).seconds * 1000) + ((finish - start).microseconds / 1000)
+        log.info("Initialize motors - full homing took %dms" % delta_ms)
+
         if self.leds:
             self.leds.set_color('LEFT', 'GREEN')
             self.leds.set_color('RIGHT', 'GREEN')
 
-    def shutdown_robot(self):
+    def shutdown_robot(self, request_time=None):
+        """
+        request_time is when the stop was requested, it is used to measure
+        how long it took until all of the motors were stopped
+        """
+        if request_time is None:
+            request_time = time()
 
         if self.shutdown_event.is_set():
             log.info('shutdown already in progress')
             return
 
+        # Stop the motors before doing anything else, any motor waits in
+        # the main thread will return within MOTOR_WAIT_SLICE_MS
         self.shutdown_event.set()
-        log.info('shutting down')
-        self.display.reset_screen()
-        self.display.update()
+        latency_ms = brake_motors(self.motors, request_time)
+        self.touch_sensor_pressed.set()
+        log.info('shutting down, all motors stopped %dms after the stop request' % latency_ms)
+
+        # Do not leave cranecuberd working on a solution nobody will use
+        for session in list(daemon_sessions.values()):
+            session.abort()
 
-        for x in self.motors:
-            x.stop(stop_action='brake')
+        self.renderer.stop()
 
         if self.mts:
             log.info('shutting down mts')
-            self.mts.shutdown_event.set()
+            self.mts.stop()
             self.mts.join()
             self.mts = None
             log.info('shutting down mts complete')
 
         log.info('shutdown complete')
 
+    def _motor_wait(self, wait_function, timeout):
+        """
+        Call wait_function in MOTOR_WAIT_SLICE_MS slices until it returns
+        True, 'timeout' ms have passed or a shutdown is requested
+        """
+        if timeout is None:
+            deadline = None
+        else:
+            deadline = time() + (timeout / 1000)
+
+        while not self.shutdown_event.is_set():
+            slice_ms = MOTOR_WAIT_SLICE_MS
+
+            if deadline is not None:
+                remaining_ms = int((deadline - time()) * 1000)
+
+                if remaining_ms <= 0:
+                    return False
+
+                slice_ms = min(slice_ms, remaining_ms)
+
+            if wait_function(slice_ms):
+                return True
+
+        return False
+
+    def motor_wait_until(self, motor, state, timeout=None):
+        return self._motor_wait(lambda slice_ms: motor.wait_until(state, timeout=slice_ms), timeout)
+
+    def motor_wait_until_not_moving(self, motor, timeout=None):
+        return self._motor_wait(lambda slice_ms: motor.wait_until_not_moving(timeout=slice_ms), timeout)
+
     def signal_term_handler(self, signal, frame):
         log.error('Caught SIGTERM')
         self.shutdown_robot()
@@ -413,18 +1394,18 @@ class CraneCuber3x3x3(object):
         # log.info("_rotate post run_to_abs_pos squisher state %s" % self.squisher.state)
 
         # log.info("_rotate pre wait_until running turntable state %s" % self.turntable.state)
-        self.turntable.wait_until("running", timeout=2000)
+        self.motor_wait_until(self.turntable, "running", timeout=2000)
         # log.info("_rotate post wait_until running turntable state %s" % self.turntable.state)
         # log.info("_rotate pre wait_until running squisher state %s" % self.squisher.state)
-        self.squisher.wait_until("running", timeout=2000)
+        self.motor_wait_until(self.squisher, "running", timeout=2000)
         # log.info("_rotate post wait_until running squisher state %s" % self.squisher.state)
 
         # Now wait for both to stop
         # log.info("_rotate pre wait_until_not_moving turntable state %s" % self.turntable.state)
-        self.turntable.wait_until_not_moving(timeout=2000)
+        self.motor_wait_until_not_moving(self.turntable, timeout=2000)
         # log.info("_rotate post wait_until_not_moving turntable state %s" % self.turntable.state)
         # log.info("_rotate pre wait_until_not_moving squisher state %s" % self.squisher.state)
-        self.squisher.wait_until_not_moving(timeout=2000)
+        self.motor_wait_until_not_moving(self.squisher, timeout=2000)
         # log.info("_rotate post wait_until_not_moving squisher state %s" % self.squisher.state)
 
         # log.info("_rotate end, goal pos %s, speed %d, must_be_accurate %s, %s is %s went %s->%s, squisher %s\n" %\
@@ -459,8 +1440,8 @@ class CraneCuber3x3x3(object):
             delta_ms = ((finish - start).seconds * 1000) + ((finish - start).microseconds / 1000)
             self.time_rotate += delta_ms
 
-            log.info("rotate_cube() FREE %d quarter turns, clockwise %s, current_pos %d, turn_pos %d, square_turntable_pos %d took %dms" %
-                (quarter_turns, clockwise, current_pos, turn_pos, square_turntable_pos, delta_ms))
+            tracer.event("rotate_cube() FREE %d quarter turns, clockwise %s, current_pos %d, turn_pos %d, square_turntable_pos %d took %dms",
+                quarter_turns, clockwise, current_pos, turn_pos, square_turntable_pos, delta_ms)
 
         else:
             turn_degrees = self.TURN_BLOCKED_TOUCH_DEGREES + (TURNTABLE_TURN_DEGREES * quarter_turns)
@@ -486,8 +1467,8 @@ class CraneCuber3x3x3(object):
             finish = datetime.datetime.now()
             delta_ms = ((finish - start).seconds * 1000) + ((finish - start).microseconds / 1000)
             self.time_rotate += delta_ms
-            log.info("rotate_cube() BLOCKED %d quarter turns, clockwise %s, current_pos %d, turn_pos %d, square_cube_pos %d, square_turntable_pos %d took %dms" %
-                (quarter_turns, clockwise, current_pos, turn_pos, square_cube_pos, square_turntable_pos, delta_ms))
+            tracer.event("rotate_cube() BLOCKED %d quarter turns, clockwise %s, current_pos %d, turn_pos %d, square_cube_pos %d, square_turntable_pos %d took %dms",
+                quarter_turns, clockwise, current_pos, turn_pos, square_cube_pos, square_turntable_pos, delta_ms)
 
         # Only update the facing_XYZ variables if the entire side is turning.  For
         # a 3x3x3 this means the middle square is being turned, this happens if at
@@ -520,8 +1501,8 @@ class CraneCuber3x3x3(object):
             #log.warning("north %s, west %s, south %s, east %s, up %s, down %s (original), rows_in_turntable %d, rows_in_turntable_to_count_as_face_turn %d" %
             #    (orig_north, orig_west, orig_south, orig_east, orig_up, orig_down, self.rows_in_turntable, self.rows_in_turntable_to_count_as_face_turn))
 
-        log.info("rotate_cube() north %s, west %s, south %s, east %s, up %s, down %s\n\n" %
-            (self.facing_north, self.facing_west, self.facing_south, self.facing_east, self.facing_up, self.facing_down))
+        tracer.event("rotate_cube() north %s, west %s, south %s, east %s, up %s, down %s",
+            self.facing_north, self.facing_west, self.facing_south, self.facing_east, self.facing_up, self.facing_down)
 
     def squish(self):
 
@@ -529,21 +1510,21 @@ class CraneCuber3x3x3(object):
         self.turntable.stop(stop_action='hold')
         self.squisher.reset()
         self.squisher.run_to_rel_pos(position_sp=self.SQUISH_DEGREES, speed_sp=self.SQUISH_SPEED_CLOSE, stop_action='brake')
-        self.squisher.wait_until("running")
-        self.squisher.wait_until_not_moving(timeout=5000)
+        self.motor_wait_until(self.squisher, "running")
+        self.motor_wait_until_not_moving(self.squisher, timeout=5000)
         self.squisher.stop()
 
         # negative opens the squisher
         self.squisher.run_to_rel_pos(position_sp=self.SQUISH_DEGREES * -1, speed_sp=self.SQUISH_SPEED_OPEN, stop_action='coast')
-        self.squisher.wait_until("running")
-        self.squisher.wait_until_not_moving(timeout=2000)
+        self.motor_wait_until(self.squisher, "running")
+        self.motor_wait_until_not_moving(self.squisher, timeout=2000)
         self.squisher.stop()
         self.turntable.stop(stop_action='brake')
 
     def squisher_reset(self):
         self.squisher.run_forever(speed_sp=-30, stop_action='coast')
-        self.squisher.wait_until("running")
-        self.squisher.wait_until_not_moving(timeout=10000)
+        self.motor_wait_until(self.squisher, "running")
+        self.motor_wait_until_not_moving(self.squisher, timeout=10000)
         self.squisher.reset()
 
     def flip_settle_cube(self):
@@ -563,8 +1544,8 @@ class CraneCuber3x3x3(object):
                                     ramp_up_sp=0,
                                     ramp_down_sp=0,
                                     stop_action='hold')
-        self.flipper.wait_until("running")
-        self.flipper.wait_until_not_moving(timeout=2000)
+        self.motor_wait_until(self.flipper, "running")
+        self.motor_wait_until_not_moving(self.flipper, timeout=2000)
 
         if self.shutdown_event.is_set():
             return
@@ -575,8 +1556,95 @@ class CraneCuber3x3x3(object):
                                     ramp_up_sp=0,
                                     ramp_down_sp=500,
                                     stop_action='hold')
-        self.flipper.wait_until("running")
-        self.flipper.wait_until_not_moving(timeout=2000)
+        self.motor_wait_until(self.flipper, "running")
+        self.motor_wait_until_not_moving(self.flipper, timeout=2000)
+
+    def clear_jam(self, primitive, steps, cleared, rounds):
+        """
+        Work our way up the ladder of recovery steps, cheapest (or
+        historically most successful) first, until cleared() says the jam is
+        gone.  The whole ladder is tried up to 'rounds' times.  The outcome
+        of each step, including a step that raised, is recorded in
+        self.jam_stats.
+        """
+        # Jams are rare so only load the stats when we need them
+        if self.jam_stats is None:
+            self.jam_stats = JamRecoveryStats()
+
+        for attempt in range(rounds):
+            for (name, estimated_ms, step_function) in self.jam_stats.ladder(primitive, self.rows_and_cols, steps):
+
+                if self.shutdown_event.is_set():
+                    return False
+
+                log.warning("%s jam recovery: trying step %s (round %d of %d)" % (primitive, name, attempt + 1, rounds))
+                start = datetime.datetime.now()
+                success = False
+
+                try:
+                    step_function()
+                    success = cleared()
+                finally:
+                    finish = datetime.datetime.now()
+                    delta_ms = ((finish - start).seconds * 1000) + ((finish - start).microseconds / 1000)
+                    self.jam_stats.record(primitive, self.rows_and_cols, name, success, delta_ms)
+
+                if success:
+                    return True
+
+        return False
+
+    def _flip_to(self, final_pos, flipper_speed, ramp_up_speed, ramp_down_speed):
+        self.flipper.position_sp = final_pos
+        self.flipper.speed_sp = flipper_speed
+        self.flipper.ramp_up_sp = ramp_up_speed
+        self.flipper.ramp_down_sp = ramp_down_speed
+        self.flipper.stop_action = 'hold'
+
+        tracer.motor_state("flipper pre run_to_abs_pos state %s", self.flipper)
+        self.flipper.run_to_abs_pos()
+        tracer.motor_state("flipper post run_to_abs_pos state %s", self.flipper)
+
+        tracer.motor_state("flipper pre wait until running state %s", self.flipper)
+        self.motor_wait_until(self.flipper, "running")
+        tracer.motor_state("flipper post wait until running state %s", self.flipper)
+
+        tracer.motor_state("flipper pre wait until not moving state %s", self.flipper)
+        self.motor_wait_until_not_moving(self.flipper, timeout=4000)
+        tracer.motor_state("flipper post wait until not moving state %s", self.flipper)
+
+        tracer.motor_state("flipper pre stop state %s", self.flipper)
+        self.flipper.stop(stop_action="hold")
+        tracer.motor_state("flipper post stop state %s", self.flipper)
+
+    def flip_jam_cleared(self, init_pos):
+        return abs(self.flipper.position - init_pos) > abs(int(FLIPPER_DEGREES/2))
+
+    def flip_jam_backoff(self, init_pos, final_pos, flipper_speed, ramp_up_speed, ramp_down_speed):
+        """
+        Move the flipper back towards where it started a little, then try again
+        """
+        current_pos = self.flipper.position
+
+        if init_pos > current_pos:
+            backoff_pos = current_pos + FLIPPER_JAM_BACKOFF_DEGREES
+        else:
+            backoff_pos = current_pos - FLIPPER_JAM_BACKOFF_DEGREES
+
+        self._flip_to(backoff_pos, int(self.FLIPPER_SPEED / 2), 0, 0)
+        self._flip_to(final_pos, flipper_speed, ramp_up_speed, ramp_down_speed)
+
+    def flip_jam_reset(self, final_pos, flipper_speed, ramp_up_speed, ramp_down_speed):
+        """
+        The most expensive step, reset the flipper motor and give the cube
+        a second to settle before trying again
+        """
+        current_pos = self.flipper.position
+        self.flipper.stop()
+        self.flipper.reset()
+        self.shutdown_event.wait(1)
+        self.flipper.position = current_pos
+        self._flip_to(final_pos, flipper_speed, ramp_up_speed, ramp_down_speed)
 
     def flip_to_init(self):
 
@@ -610,8 +1678,8 @@ class CraneCuber3x3x3(object):
         # the cube to slide a little when the flipper stops.  When the cube
         # slides like this it is no longer lined up with the turntable above so
         # when we raise the cube it jams up.
-        log.info("flipper run_to_abs_pos(), rows_in_turntable %s, flipper_at_init %s, init_pos %s, final_pos %s" %
-            (self.rows_in_turntable, self.flipper_at_init, init_pos, final_pos))
+        tracer.event("flipper run_to_abs_pos(), rows_in_turntable %s, flipper_at_init %s, init_pos %s, final_pos %s",
+            self.rows_in_turntable, self.flipper_at_init, init_pos, final_pos)
 
         if slow:
             flipper_speed = int(self.FLIPPER_SPEED / 2)
@@ -629,67 +1697,38 @@ class CraneCuber3x3x3(object):
                 ramp_up_speed = 0
                 ramp_down_speed = 0
 
-        self.flipper.position_sp = final_pos
-        self.flipper.speed_sp = flipper_speed
-        self.flipper.ramp_up_sp = ramp_up_speed
-        self.flipper.ramp_down_sp = ramp_down_speed
-        self.flipper.stop_action = 'hold'
-
-        for attempt in range(3):
-            log.info("flipper pre run_to_abs_pos state %s" % self.flipper.state)
-            self.flipper.run_to_abs_pos()
-            log.info("flipper post run_to_abs_pos state %s" % self.flipper.state)
-
-            log.info("flipper pre wait until running state %s" % self.flipper.state)
-            self.flipper.wait_until("running")
-            log.info("flipper post wait until running state %s" % self.flipper.state)
-
-            log.info("flipper pre wait until not moving state %s" % self.flipper.state)
-            self.flipper.wait_until_not_moving(timeout=4000)
-            log.info("flipper post wait until not moving state %s" % self.flipper.state)
-
-            log.info("flipper pre stop state %s" % self.flipper.state)
-            self.flipper.stop(stop_action="hold")
-            log.info("flipper post stop state %s" % self.flipper.state)
-
-            if self.emulate:
-                current_pos = final_pos
-            else:
-                current_pos = self.flipper.position
+        self._flip_to(final_pos, flipper_speed, ramp_up_speed, ramp_down_speed)
 
-            # log.info("flipper not moving, at_init %s, final_pos %s, position %s" % (self.flipper_at_init, final_pos, self.flipper.position))
+        # If we did not move at least halfway we know the flip jammed up
+        if not self.emulate and not self.shutdown_event.is_set() and not self.flip_jam_cleared(init_pos):
+            log.warning("flip jammed, moved %d degrees (%s -> %s, target %s)...attempting to clear" %
+                (abs(self.flipper.position - init_pos), init_pos, self.flipper.position, final_pos))
 
-            finish = datetime.datetime.now()
-            delta_ms = ((finish - start).seconds * 1000) + ((finish - start).microseconds / 1000)
-            self.time_flip += delta_ms
-            degrees_moved = abs(current_pos - init_pos)
-            log.info("flip() %s degrees (%s -> %s, target %s) took %dms" %
-                (degrees_moved, init_pos, current_pos, final_pos, delta_ms))
+            steps = [
+                ('retry', 500,
+                 lambda: self._flip_to(final_pos, flipper_speed, ramp_up_speed, ramp_down_speed)),
+                ('backoff', 900,
+                 lambda: self.flip_jam_backoff(init_pos, final_pos, flipper_speed, ramp_up_speed, ramp_down_speed)),
+                ('reset', 1700,
+                 lambda: self.flip_jam_reset(final_pos, flipper_speed, ramp_up_speed, ramp_down_speed)),
+            ]
 
-            if self.emulate:
-                self.flipper_at_init = not self.flipper_at_init
-                break
-            else:
-                # We flipped without issue
-                if abs(degrees_moved) > abs(int(FLIPPER_DEGREES/2)):
-                    self.flipper_at_init = not self.flipper_at_init
-                    break
+            if not self.clear_jam('flip', steps, lambda: self.flip_jam_cleared(init_pos), FLIP_JAM_ROUNDS):
+                raise CubeJammed("jammed on flip, moved %d degrees" % abs(self.flipper.position - init_pos))
 
-                # If we did not move at least halfway we know the flip jammed up so try again
-                else:
-                    self.flipper.stop()
-                    self.flipper.reset()
-                    sleep(1)
-                    self.flipper.position = current_pos
-                    self.flipper.position_sp = final_pos
-                    self.flipper.speed_sp = flipper_speed
-                    self.flipper.ramp_up_sp = ramp_up_speed
-                    self.flipper.ramp_down_sp = ramp_down_speed
-                    self.flipper.stop_action = 'hold'
-                    log.warning("flip jammed...trying again")
+        if self.emulate:
+            current_pos = final_pos
         else:
-            raise CubeJammed("jammed on flip, moved %d degrees" % abs(degrees_moved))
+            current_pos = self.flipper.position
+
+        finish = datetime.datetime.now()
+        delta_ms = ((finish - start).seconds * 1000) + ((finish - start).microseconds / 1000)
+        self.time_flip += delta_ms
+        degrees_moved = abs(current_pos - init_pos)
+        tracer.event("flip() %s degrees (%s -> %s, target %s) took %dms",
+            degrees_moved, init_pos, current_pos, final_pos, delta_ms)
 
+        self.flipper_at_init = not self.flipper_at_init
         self.flipper.position_sp = final_pos
 
         # facing_west and facing_east won't change
@@ -709,8 +1748,8 @@ class CraneCuber3x3x3(object):
                 self.facing_south = orig_up
                 self.facing_up = orig_north
                 self.facing_down = orig_south
-                log.info("flipper2 north %s, west %s, south %s, east %s, up %s, down %s" %
-                    (self.facing_north, self.facing_west, self.facing_south, self.facing_east, self.facing_up, self.facing_down))
+                tracer.event("flipper2 north %s, west %s, south %s, east %s, up %s, down %s",
+                    self.facing_north, self.facing_west, self.facing_south, self.facing_east, self.facing_up, self.facing_down)
 
             # We flipped from the init position to where the flipper is blocking the view of the camera
             else:
@@ -718,8 +1757,8 @@ class CraneCuber3x3x3(object):
                 self.facing_south = orig_down
                 self.facing_up = orig_south
                 self.facing_down = orig_north
-                log.info("flipper1 north %s, west %s, south %s, east %s, up %s, down %s" %
-                    (self.facing_north, self.facing_west, self.facing_south, self.facing_east, self.facing_up, self.facing_down))
+                tracer.event("flipper1 north %s, west %s, south %s, east %s, up %s, down %s",
+                    self.facing_north, self.facing_west, self.facing_south, self.facing_east, self.facing_up, self.facing_down)
 
     def elevate(self, rows):
         """
@@ -746,23 +1785,22 @@ class CraneCuber3x3x3(object):
                             ||
                             ||
         """
-        log.info("elevate called for rows %d, rows_in_turntable %d" % (rows, self.rows_in_turntable))
+        tracer.event("elevate called for rows %d, rows_in_turntable %d", rows, self.rows_in_turntable)
         assert 0 <= rows <= self.rows_and_cols, "rows was %d, rows must be between 0 and %d" % (rows, self.rows_and_cols)
 
         if self.shutdown_event.is_set():
-            log.info("elevate: shutdown_event is set")
+            tracer.event("elevate: shutdown_event is set")
             return
 
         # nothing to do
         if rows == self.rows_in_turntable:
-            log.info("elevate: rows == rows_in_turntable nothing to do")
+            tracer.event("elevate: rows == rows_in_turntable nothing to do")
             return
 
         # The table in section 5 shows says that our 16 tooth gear has an outside diameter of 17.4
         # http://www.robertcailliau.eu/Alphabetical/L/Lego/Gears/Dimensions/
         diameter = 17.4
         circ = diameter * pi
-        final_pos_mm = 0
 
         # 16 studs at 8mm per stud = 128mm
         flipper_plus_holder_height_studs_mm = 134
@@ -862,7 +1900,7 @@ class CraneCuber3x3x3(object):
         if rows < self.rows_in_turntable:
             # If we are lowering the cube we have to use a ramp_up because if we
             # drop the cube too suddenly it tends to jam up
-            log.info("elevate down: pre run_to_abs_pos state %s" % self.elevator.state)
+            tracer.motor_state("elevate down: pre run_to_abs_pos state %s", self.elevator)
 
             # drop the cube a few more rows
             if final_pos:
@@ -879,21 +1917,21 @@ class CraneCuber3x3x3(object):
                                              ramp_down_sp=400,
                                              stop_action='hold')
 
-            log.info("elevate down: post run_to_abs_pos state %s" % self.elevator.state)
+            tracer.motor_state("elevate down: post run_to_abs_pos state %s", self.elevator)
 
-            log.info("elevate down: pre wait_until running state %s" % self.elevator.state)
-            self.elevator.wait_until("running", timeout=3000)
-            log.info("elevate down: post wait_until running state %s" % self.elevator.state)
+            tracer.motor_state("elevate down: pre wait_until running state %s", self.elevator)
+            self.motor_wait_until(self.elevator, "running", timeout=3000)
+            tracer.motor_state("elevate down: post wait_until running state %s", self.elevator)
 
-            log.info("elevate down: pre wait_until_not_moving state %s" % self.elevator.state)
-            self.elevator.wait_until_not_moving(timeout=3000)
-            log.info("elevate down: post wait_until_not_moving state %s" % self.elevator.state)
+            tracer.motor_state("elevate down: pre wait_until_not_moving state %s", self.elevator)
+            self.motor_wait_until_not_moving(self.elevator, timeout=3000)
+            tracer.motor_state("elevate down: post wait_until_not_moving state %s", self.elevator)
 
             self.elevator.stop(stop_action="hold")
 
         # going up
         else:
-            log.info("elevate up: pre run_to_abs_pos state %s" % self.elevator.state)
+            tracer.motor_state("elevate up: pre run_to_abs_pos state %s", self.elevator)
 
             # raise the cube a few more rows
             if self.rows_in_turntable:
@@ -909,15 +1947,15 @@ class CraneCuber3x3x3(object):
                                              ramp_up_sp=200, # ramp_up here so we don't slam into the cube at full speed
                                              ramp_down_sp=400, # ramp_down so we stop at the right spot
                                              stop_action='hold')
-            log.info("elevate up: post run_to_abs_pos state %s" % self.elevator.state)
+            tracer.motor_state("elevate up: post run_to_abs_pos state %s", self.elevator)
 
-            log.info("elevate up: pre wait_until running state %s" % self.elevator.state)
-            self.elevator.wait_until("running", timeout=3000)
-            log.info("elevate up: post wait_until running state %s" % self.elevator.state)
+            tracer.motor_state("elevate up: pre wait_until running state %s", self.elevator)
+            self.motor_wait_until(self.elevator, "running", timeout=3000)
+            tracer.motor_state("elevate up: post wait_until running state %s", self.elevator)
 
-            log.info("elevate up: pre wait_until_not_moving state %s" % self.elevator.state)
-            self.elevator.wait_until_not_moving(timeout=3000)
-            log.info("elevate up: post wait_until_not_moving state %s" % self.elevator.state)
+            tracer.motor_state("elevate up: pre wait_until_not_moving state %s", self.elevator)
+            self.motor_wait_until_not_moving(self.elevator, timeout=3000)
+            tracer.motor_state("elevate up: post wait_until_not_moving state %s", self.elevator)
 
             self.elevator.stop(stop_action="hold")
 
@@ -926,68 +1964,84 @@ class CraneCuber3x3x3(object):
             delta = abs(current_pos - init_pos)
             delta_target = abs(final_pos - init_pos)
 
-            if not self.emulate and delta < (delta_target * 0.90):
-                current_pos = self.elevator.position
+            if not self.emulate and not self.shutdown_event.is_set() and delta < (delta_target * 0.90):
                 log.warning("elevate jammed up, only moved %d, should have moved %d, state %s...attempting to clear (init_pos %d, current_pos %d, final_pos %d)" %
                     (delta, delta_target, self.elevator.state, init_pos, current_pos, final_pos))
-                self.elevator.stop()
-                self.elevator.reset()
-                sleep(1)
-                self.elevator.position = current_pos
-
-                log.info("elevate up jam clear: pre run_to_abs_pos state %s" % self.elevator.state)
-                self.elevator.run_to_abs_pos(position_sp=0,
-                                             speed_sp=self.ELEVATOR_SPEED_DOWN_SLOW,
-                                             stop_action='hold')
-                log.info("elevate up jam clear: post run_to_abs_pos state %s" % self.elevator.state)
 
-                log.info("elevate up jam clear: pre wait_until running state %s" % self.elevator.state)
-                self.elevator.wait_until("running", timeout=3000)
-                log.info("elevate up jam clear: post wait_until running state %s" % self.elevator.state)
+                steps = [
+                    ('backoff', 600, lambda: self.elevate_jam_backoff(final_pos)),
+                    ('lower', 1500, lambda: self.elevate_jam_lower(final_pos)),
+                    ('full', 6000, lambda: self.elevate_jam_full(final_pos)),
+                ]
 
-                log.info("elevate up jam clear: pre wait_until_not_moving state %s" % self.elevator.state)
-                self.elevator.wait_until_not_moving(timeout=3000)
-                log.info("elevate up jam clear: post wait_until_not_moving state %s" % self.elevator.state)
-
-                self.squisher_reset()
-                self.flip(slow=True)
-                self.flip(slow=True)
-
-                log.info("elevate up jam clear: pre run_to_abs_pos state %s" % self.elevator.state)
-                self.elevator.run_to_abs_pos(position_sp=final_pos,
-                                             speed_sp=self.ELEVATOR_SPEED_UP_FAST,
-                                             ramp_up_sp=200, # ramp_up here so we don't slam into the cube at full speed
-                                             ramp_down_sp=400, # ramp_down so we stop at the right spot
-                                             stop_action='hold')
-                log.info("elevate up jam clear: post run_to_abs_pos state %s" % self.elevator.state)
-
-                log.info("elevate up jam clear: pre wait_until running state %s" % self.elevator.state)
-                self.elevator.wait_until("running", timeout=3000)
-                log.info("elevate up jam clear: post wait_until running state %s" % self.elevator.state)
-
-                log.info("elevate up jam clear: pre wait_until_not_moving state %s" % self.elevator.state)
-                self.elevator.wait_until_not_moving(timeout=3000)
-                log.info("elevate up jam clear: post wait_until_not_moving state %s" % self.elevator.state)
-
-                current_pos = self.elevator.position
-                delta = abs(current_pos - init_pos)
-                delta_target = abs(final_pos - init_pos)
-
-                if delta < (delta_target * 0.90):
+                if not self.clear_jam('elevate', steps, lambda: self.elevate_jam_cleared(init_pos, final_pos), ELEVATE_JAM_ROUNDS):
+                    current_pos = self.elevator.position
+                    delta = abs(current_pos - init_pos)
                     raise CubeJammed("elevate jammed up, only moved %d, should have moved %d, init_pos %d, current_pos %d, final_pos %d" %
                         (delta, delta_target, init_pos, current_pos, final_pos))
 
         finish = datetime.datetime.now()
         delta_ms = ((finish - start).seconds * 1000) + ((finish - start).microseconds / 1000)
         self.time_elevate += delta_ms
-        log.info("elevate() from %d to %d took %dms, final_pos target %s, position %s, final_pos_mm %d" %
-            (self.rows_in_turntable, rows, delta_ms, final_pos, self.elevator.position, final_pos_mm))
+        # Do not read self.elevator.position just to log it, that is a sysfs read
+        tracer.event("elevate() from %d to %d took %dms, final_pos target %s",
+            self.rows_in_turntable, rows, delta_ms, final_pos)
         self.rows_in_turntable = rows
 
         if final_pos == 0 and self.elevator.position != final_pos:
             self.elevator.reset()
             self.elevator.stop(stop_action='hold')
 
+    def elevate_jam_cleared(self, init_pos, final_pos):
+        delta = abs(self.elevator.position - init_pos)
+        delta_target = abs(final_pos - init_pos)
+        return delta >= (delta_target * 0.90)
+
+    def _elevator_to(self, final_pos, speed, ramp_up=200, ramp_down=400):
+        log.info("elevate jam clear: pre run_to_abs_pos %d state %s" % (final_pos, self.elevator.state))
+        self.elevator.run_to_abs_pos(position_sp=final_pos,
+                                     speed_sp=speed,
+                                     ramp_up_sp=ramp_up,
+                                     ramp_down_sp=ramp_down,
+                                     stop_action='hold')
+        self.motor_wait_until(self.elevator, "running", timeout=3000)
+        self.motor_wait_until_not_moving(self.elevator, timeout=3000)
+        log.info("elevate jam clear: post wait_until_not_moving state %s, position %d" % (self.elevator.state, self.elevator.position))
+
+    def elevate_jam_backoff(self, final_pos):
+        """
+        The cheapest step, lower the cube a few degrees and raise it again
+        slowly.  This clears most minor snags.
+        """
+        # positive moves down
+        backoff_pos = min(self.elevator.position + ELEVATOR_JAM_BACKOFF_DEGREES, 0)
+        self._elevator_to(backoff_pos, self.ELEVATOR_SPEED_DOWN_SLOW, ramp_up=0, ramp_down=0)
+        self._elevator_to(final_pos, self.ELEVATOR_SPEED_UP_SLOW)
+
+    def elevate_jam_lower(self, final_pos):
+        """
+        Lower the cube all the way back into the flipper and raise it again
+        """
+        self._elevator_to(0, self.ELEVATOR_SPEED_DOWN_SLOW)
+        self._elevator_to(final_pos, self.ELEVATOR_SPEED_UP_FAST)
+
+    def elevate_jam_full(self, final_pos):
+        """
+        The most expensive step, lower the cube, reset the squisher and
+        flip the cube back and forth to re-seat it before raising it again
+        """
+        current_pos = self.elevator.position
+        self.elevator.stop()
+        self.elevator.reset()
+        self.shutdown_event.wait(1)
+        self.elevator.position = current_pos
+
+        self._elevator_to(0, self.ELEVATOR_SPEED_DOWN_SLOW, ramp_up=0, ramp_down=0)
+        self.squisher_reset()
+        self.flip(slow=True)
+        self.flip(slow=True)
+        self._elevator_to(final_pos, self.ELEVATOR_SPEED_UP_FAST)
+
     def elevate_max(self):
         self.elevate(self.rows_and_cols)
 
@@ -999,10 +2053,18 @@ class CraneCuber3x3x3(object):
         log.info("scan_face() %s" % name)
 
         if not self.emulate:
+            # cranecuberd replies as soon as the frame is grabbed, it saves
+            # the picture while we move on to the next side
+            start = datetime.datetime.now()
             send_command(self.SERVER, 10000, "TAKE_PICTURE:%s" % name)
+            finish = datetime.datetime.now()
+            self.scan_face_ms[name] = ((finish - start).seconds * 1000) + ((finish - start).microseconds / 1000)
 
-    def scan(self):
-
+    def scan_first_side(self):
+        """
+        Take the picture of F, cranecuberd can tell us the cube size from
+        that before we scan the other five sides
+        """
         if self.shutdown_event.is_set():
             return
 
@@ -1012,37 +2074,124 @@ class CraneCuber3x3x3(object):
 
         log.info("scan()")
         self.colors = {}
-        self.display.text_grid("scan F", clear_screen=True, x=x_grid, y=y_grid, font=display_font)
-        self.display.update()
+        self.scan_face_ms = {}
+        self.renderer.show("scan F", x_grid, y_grid, display_font)
         self.scan_face('F')
 
+    def get_cube_size(self):
+        """
+        Returns the cube size based on the picture of F or None if
+        cranecuberd could not tell.  With None we keep scanning with the
+        6x6x6 profile and GET_RGB_COLORS tells us the size, as we did
+        before cranecuberd had GET_CUBE_SIZE.
+        """
+        if self.shutdown_event.is_set():
+            return None
+
+        # The emulated colors are for a 5x5x5
+        if self.emulate:
+            return 5
+
+        # An older cranecuberd does not have GET_CUBE_SIZE
+        if not use_daemon_sessions:
+            return None
+
+        try:
+            return int(send_command(self.SERVER, 10000, "GET_CUBE_SIZE"))
+        except Exception as e:
+            log.warning("GET_CUBE_SIZE failed, scanning as a %dx%dx%d: %s" % (self.rows_and_cols, self.rows_and_cols, self.rows_and_cols, e))
+            return None
+
+    def scan(self):
+        """
+        Scan the other five sides, scan_first_side() took the picture of F
+        """
+        if self.shutdown_event.is_set():
+            return
+
+        if self.SCAN_ROUTE == 'planned':
+            self.scan_planned_route()
+        else:
+            self.scan_fixed_route()
+
+        log.info("scan display: %s" % self.renderer.stats())
+
+    def scan_planned_route(self):
+        """
+        Scan the sides in the order picked by plan_scan_route(), the cube is
+        left wherever the last picture was taken.  copy_state() carries the
+        orientation over to the object that solves the cube.
+        """
+        display_font = "luBS24"
+        x_grid = 4
+        y_grid = 4
+
+        # cranecuberd starts a new scan when it sees side F
+        assert self.facing_south == 'F' and not self.rows_in_turntable and self.flipper_at_init, \
+            "scan must start with F facing the camera"
+        scanned = ['F']
+
+        facing = (self.facing_north, self.facing_west, self.facing_south, self.facing_east, self.facing_up, self.facing_down)
+        (route, cost_ms) = plan_scan_route(self.rows_and_cols, self.rows_in_turntable, self.flipper_at_init, facing, scanned)
+        log.info("scan route: %d steps, estimated %dms: %s" % (len(route), cost_ms, ' '.join([str(step) for step in route])))
+
+        for step in route:
+
+            if self.shutdown_event.is_set():
+                return
+
+            if step[0] == 'scan_face':
+                assert self.facing_south == step[1], "expected %s to face the camera, it is %s" % (step[1], self.facing_south)
+                assert self.facing_up == SCAN_PICTURE_UP[step[1]], \
+                    "expected %s at the top of the picture of %s, it is %s" % (SCAN_PICTURE_UP[step[1]], step[1], self.facing_up)
+                log.warning("expose side-%s" % step[1])
+                self.renderer.show("scan %s" % step[1], x_grid, y_grid, display_font)
+                self.scan_face(step[1])
+                scanned.append(step[1])
+
+                # We have all six pictures, get the colors and the solution
+                # from cranecuberd while the cube is handed over to the
+                # object that solves it
+                if len(scanned) == 6:
+                    self.start_speculative_solve()
+
+            elif step[0] == 'elevate':
+                self.elevate(step[1])
+
+            elif step[0] == 'flip':
+                self.flip()
+
+            elif step[0] == 'rotate':
+                self.rotate(clockwise=step[1], quarter_turns=step[2])
+
+    def scan_fixed_route(self):
+        display_font = "luBS24"
+        x_grid = 4
+        y_grid = 4
+
         log.warning("expose side-R")
-        self.display.text_grid("scan R", clear_screen=True, x=x_grid, y=y_grid, font=display_font)
-        self.display.update()
+        self.renderer.show("scan R", x_grid, y_grid, display_font)
         self.elevate_max()
         self.rotate(clockwise=True, quarter_turns=1)
         self.elevate(0)
         self.scan_face('R')
 
         log.warning("expose side-B")
-        self.display.text_grid("scan B", clear_screen=True, x=x_grid, y=y_grid, font=display_font)
-        self.display.update()
+        self.renderer.show("scan B", x_grid, y_grid, display_font)
         self.elevate_max()
         self.rotate(clockwise=True, quarter_turns=1)
         self.elevate(0)
         self.scan_face('B')
 
         log.warning("expose side-L")
-        self.display.text_grid("scan L", clear_screen=True, x=x_grid, y=y_grid, font=display_font)
-        self.display.update()
+        self.renderer.show("scan L", x_grid, y_grid, display_font)
         self.elevate_max()
         self.rotate(clockwise=True, quarter_turns=1)
         self.elevate(0)
         self.scan_face('L')
 
         log.warning("expose side-U")
-        self.display.text_grid("scan U", clear_screen=True, x=x_grid, y=y_grid, font=display_font)
-        self.display.update()
+        self.renderer.show("scan U", x_grid, y_grid, display_font)
         self.elevate_max()
         self.rotate(clockwise=True, quarter_turns=1)
         self.flip()
@@ -1051,8 +2200,7 @@ class CraneCuber3x3x3(object):
         self.scan_face('U')
 
         log.warning("expose side-D")
-        self.display.text_grid("scan D", clear_screen=True, x=x_grid, y=y_grid, font=display_font)
-        self.display.update()
+        self.renderer.show("scan D", x_grid, y_grid, display_font)
         self.flip()
         self.elevate(1)
         self.flip()
@@ -1063,21 +2211,85 @@ class CraneCuber3x3x3(object):
         self.elevate(0)
         self.scan_face('D')
 
-        # To make troubleshooting easier, move the F of the cube so that it
-        # is facing the camera like it was when we started the scan
-        log.info("\n")
-        log.warning("expose side-F (back to where we started)")
-        self.display.text_grid("back to F", clear_screen=True, x=x_grid, y=y_grid, font=display_font)
-        self.display.update()
-        self.elevate(1)
-        self.flip()
-        self.elevate(0)
-        self.flip()
+        # We have all six pictures, get the colors and the solution from
+        # cranecuberd while we move F back to the camera
+        self.start_speculative_solve()
+
+        # To make troubleshooting easier, move the F of the cube so that it
+        # is facing the camera like it was when we started the scan
+        log.info("\n")
+        log.warning("expose side-F (back to where we started)")
+        self.renderer.show("back to F", x_grid, y_grid, display_font)
+        self.elevate(1)
+        self.flip()
+        self.elevate(0)
+        self.flip()
+
+        #log.info("Paused")
+        #input("Paused")
+
+    def speculative_solve(self):
+        try:
+            solution = None
+
+            if not self.emulate and use_daemon_sessions:
+                try:
+                    solution = self.solve_from_pics()
+                except DaemonError as e:
+                    log.warning("SOLVE_FROM_PICS failed, falling back to GET_RGB_COLORS, GET_CUBE_STATE and GET_SOLUTION: %s" % e)
+
+            if solution is None:
+                self.get_colors()
+                self.resolve_colors()
+
+                if not self.shutdown_event.is_set():
+                    solution = self.fetch_solution()
+
+            self.speculative_solution = solution
+
+        except Exception as e:
+            log.exception(e)
+            self.speculative_error = e
+
+        finally:
+            self.speculative_finish = time()
+
+    def start_speculative_solve(self):
+
+        if self.shutdown_event.is_set():
+            return
+
+        self.speculative_solution = None
+        self.speculative_error = None
+        self.speculative_finish = None
+        self.speculative_thread = Thread(target=self.speculative_solve)
+        self.speculative_thread.daemon = True
+        self.speculative_thread.start()
 
-        #log.info("Paused")
-        #input("Paused")
+    def wait_for_speculative_solve(self):
+        """
+        Returns the solution fetched while scan() was moving the cube, the
+        colors have been resolved by then as well
+        """
+        if self.speculative_thread is None:
+            return None
+
+        start = time()
+        self.speculative_thread.join()
+        self.speculative_thread = None
+
+        if self.speculative_error:
+            raise self.speculative_error
+
+        if self.speculative_finish > start:
+            log.info("speculative solve: waited %dms for cranecuberd after the scan moves" % ((self.speculative_finish - start) * 1000))
+        else:
+            log.info("speculative solve: finished %dms before the scan moves" % ((start - self.speculative_finish) * 1000))
+
+        return self.speculative_solution
 
     def get_colors(self):
+        import json
 
         if self.shutdown_event.is_set():
             return
@@ -1099,16 +2311,59 @@ class CraneCuber3x3x3(object):
 
             log.info("GET_RGB_COLORS\n%s\n" % output)
             self.colors = json.loads(output)
+            self.log_capture_stats()
+
+    def log_capture_stats(self):
+        """
+        Log how long we waited on each TAKE_PICTURE vs. how long cranecuberd
+        spent writing and tracking the picture while we were moving to the
+        next side.  These are only nice to have, a failure here must not
+        cost us the solve.
+        """
+        import json
+
+        # An older cranecuberd does not have GET_CAPTURE_STATS
+        if not use_daemon_sessions:
+            return
+
+        try:
+            capture_stats = json.loads(send_command(self.SERVER, 10000, "GET_CAPTURE_STATS"))
+        except Exception as e:
+            log.warning("GET_CAPTURE_STATS failed: %s" % e)
+            return
+
+        total_overlap_ms = 0
+
+        for name in ('F', 'R', 'B', 'L', 'U', 'D'):
+            if name not in capture_stats or name not in self.scan_face_ms:
+                continue
+
+            stats = capture_stats[name]
+            tracker_ms = stats.get('tracker_ms', 0)
+
+            # write_ms is only there if cranecuberd is archiving PNGs
+            write_ms = stats.get('write_ms', 0)
+            total_overlap_ms += write_ms + tracker_ms
+            log.info("capture %s: waited %dms for TAKE_PICTURE (grab %dms, store %dms), %dms of PNG write and %dms of tracking done in the background" %
+                (name, self.scan_face_ms[name], stats.get('grab_ms', 0), stats.get('store_ms', 0), write_ms, tracker_ms))
+
+        log.info("capture: %dms of PNG writes and tracking done in the background" % total_overlap_ms)
 
     def resolve_colors(self):
+        import json
 
         if self.shutdown_event.is_set():
             return
 
         cmd = "GET_CUBE_STATE:%s" % json.dumps(self.colors)
         output = send_command(self.SERVER, 10000, cmd)
-        self.resolved_colors = json.loads(output)
+        self.set_resolved_colors(json.loads(output))
 
+    def set_resolved_colors(self, resolved_colors):
+        """
+        resolved_colors is the rubiks-color-resolver.py --json output
+        """
+        self.resolved_colors = resolved_colors
         self.resolved_colors['squares'] = convert_key_strings_to_int(self.resolved_colors['squares'])
         self.cube_for_resolver = self.resolved_colors['kociemba']
 
@@ -1116,6 +2371,33 @@ class CraneCuber3x3x3(object):
         log.info("north %s, west %s, south %s, east %s, up %s, down %s" %
                  (self.facing_north, self.facing_west, self.facing_south, self.facing_east, self.facing_up, self.facing_down))
 
+    def solve_from_pics(self):
+        """
+        Have cranecuberd run tracker -> resolver -> solver on the pictures
+        it took with one SOLVE_FROM_PICS request instead of sending the
+        colors and the cube state back and forth.  Returns the list of moves.
+        """
+        import json
+
+        if self.shutdown_event.is_set():
+            return None
+
+        def progress(update):
+            update = json.loads(update)
+            log.info("SOLVE_FROM_PICS: %s finished in %dms" % (update['stage'], update['ms']))
+
+        # The timeout applies to each stage, the solver is the slow one
+        output = send_command(self.SERVER, 10000, "SOLVE_FROM_PICS", timeout=300, progress=progress)
+        result = json.loads(output)
+
+        self.colors = result['colors']
+        self.set_resolved_colors(result['state'])
+        log.info("SOLVE_FROM_PICS: %s" % ", ".join("%s %dms" % (stage, result['timings_ms'][stage])
+                                                  for stage in ('tracker', 'resolver', 'solver', 'total')))
+        self.log_capture_stats()
+
+        return result['solution']
+
     def flip_with_elevator_clear(self):
 
         if self.rows_in_turntable:
@@ -1127,7 +2409,7 @@ class CraneCuber3x3x3(object):
 
     def move_north_to_top(self, rows):
         original_north = self.facing_north
-        log.info("move_north_to_top() - flipper_at_init %s, rows %d" % (self.flipper_at_init, rows))
+        tracer.event("move_north_to_top() - flipper_at_init %s, rows %d", self.flipper_at_init, rows)
 
         # There are four starting points
         # flipper at init, elevator rows in turntable
@@ -1161,11 +2443,11 @@ class CraneCuber3x3x3(object):
 
     def move_west_to_top(self, rows):
 
-        log.info("north %s, west %s, south %s, east %s, up %s, down %s" %
-                 (self.facing_north, self.facing_west, self.facing_south, self.facing_east, self.facing_up, self.facing_down))
+        tracer.event("north %s, west %s, south %s, east %s, up %s, down %s",
+            self.facing_north, self.facing_west, self.facing_south, self.facing_east, self.facing_up, self.facing_down)
 
         original_west = self.facing_west
-        log.info("move_west_to_top() - flipper_at_init %s, rows %d" % (self.flipper_at_init, rows))
+        tracer.event("move_west_to_top() - flipper_at_init %s, rows %d", self.flipper_at_init, rows)
         self.elevate_max()
 
         # Since we have the cube raised up as far as it can go, go
@@ -1182,13 +2464,13 @@ class CraneCuber3x3x3(object):
         self.flip()
         self.elevate(rows)
         self.move_west_to_top_calls += 1
-        log.info("north %s, west %s, south %s, east %s, up %s, down %s" %
-                 (self.facing_north, self.facing_west, self.facing_south, self.facing_east, self.facing_up, self.facing_down))
+        tracer.event("north %s, west %s, south %s, east %s, up %s, down %s",
+            self.facing_north, self.facing_west, self.facing_south, self.facing_east, self.facing_up, self.facing_down)
         assert self.facing_up == original_west, "self.facing_up is %s but should be %s" % (self.facing_up, original_west)
 
     def move_south_to_top(self, rows):
         original_south = self.facing_south
-        log.info("move_south_to_top() - flipper_at_init %s, rows %d" % (self.flipper_at_init, rows))
+        tracer.event("move_south_to_top() - flipper_at_init %s, rows %d", self.flipper_at_init, rows)
 
         # There are four starting points
         # flipper at init, elevator rows in turntable
@@ -1229,7 +2511,7 @@ class CraneCuber3x3x3(object):
         be more likely to jam up on the elevate(0). I'll stick with what I have :)
         """
         original_east = self.facing_east
-        log.info("move_east_to_top() - flipper_at_init %s, rows %d" % (self.flipper_at_init, rows))
+        tracer.event("move_east_to_top() - flipper_at_init %s, rows %d", self.flipper_at_init, rows)
         self.elevate_max()
 
         # Since we have the cube raised up as far as it can go, go
@@ -1250,7 +2532,7 @@ class CraneCuber3x3x3(object):
 
     def move_down_to_top(self, rows):
         original_down = self.facing_down
-        log.info("move_down_to_top() - flipper_at_init %s, rows %d" % (self.flipper_at_init, rows))
+        tracer.event("move_down_to_top() - flipper_at_init %s, rows %d", self.flipper_at_init, rows)
         self.elevate(0)
         self.flip()
         self.flip_with_elevator_clear()
@@ -1303,6 +2585,8 @@ class CraneCuber3x3x3(object):
         - ignore the x, y, z at the end, this is just rotating the entire cube to get the F side back to the front
         """
 
+        import re
+
         log.info('Moves: %s' % ' '.join(actions))
         total_actions = len(actions)
         start = datetime.datetime.now()
@@ -1357,10 +2641,8 @@ class CraneCuber3x3x3(object):
         y_grid = 4
 
         for (index, action) in enumerate(actions):
-            desc = "Move %d/%d : %s" % (index, total_actions, action)
-            log.info(desc)
-            self.display.text_grid("%d/%d" % (index, total_actions), clear_screen=True, x=x_grid, y=y_grid, font=display_font)
-            self.display.update()
+            tracer.event("Move %d/%d : %s", index, total_actions, action)
+            self.renderer.show("%d/%d" % (index, total_actions), x_grid, y_grid, display_font)
 
             if self.shutdown_event.is_set():
                 break
@@ -1399,9 +2681,9 @@ class CraneCuber3x3x3(object):
                 target_face = action[0]
                 rows = 1
 
-            log.info("Up %s, Down %s, North %s, West %s, South %s, East %s, target_face %s, rows %d, quarter_turns %d, clockwise %s" %
-                    (self.facing_up, self.facing_down, self.facing_north, self.facing_west, self.facing_south, self.facing_east,
-                     target_face, rows, quarter_turns, clockwise))
+            tracer.event("Up %s, Down %s, North %s, West %s, South %s, East %s, target_face %s, rows %d, quarter_turns %d, clockwise %s",
+                self.facing_up, self.facing_down, self.facing_north, self.facing_west, self.facing_south, self.facing_east,
+                target_face, rows, quarter_turns, clockwise)
 
             if rows == self.rows_and_cols:
                 pass
@@ -1492,9 +2774,8 @@ class CraneCuber3x3x3(object):
             if index % 25 == 0:
                 self.squisher_reset()
 
-            log.info("Up %s, Down %s, North %s, West %s, South %s, East %s" %
-                    (self.facing_up, self.facing_down, self.facing_north, self.facing_west, self.facing_south, self.facing_east))
-            log.info("\n\n\n\n")
+            tracer.event("Up %s, Down %s, North %s, West %s, South %s, East %s",
+                self.facing_up, self.facing_down, self.facing_north, self.facing_west, self.facing_south, self.facing_east)
             moves += 1
 
         finish = datetime.datetime.now()
@@ -1504,6 +2785,7 @@ class CraneCuber3x3x3(object):
             log.info("SOLVED!! %ds in elevate, %ds in flip, %ds in rotate, %ds in run_solution, %d moves, avg %dms per move" %
                 (int(self.time_elevate/1000), int(self.time_flip/1000), int(self.time_rotate/1000),
                  int(delta_ms/1000), moves, int(delta_ms/moves)))
+            log.info("run_solution display: %s" % self.renderer.stats())
 
     def compress_actions(self, actions):
         actions = actions.replace("Uw Uw Uw ", "Uw' ")
@@ -1537,14 +2819,12 @@ class CraneCuber3x3x3(object):
         actions = actions.replace("D D ", "D2 ")
         return actions
 
-    def resolve_actions(self):
-
-        if self.shutdown_event.is_set():
-            return
-
+    def fetch_solution(self):
+        """
+        Ask cranecuberd to solve self.cube_for_resolver, returns the list of moves
+        """
         if self.emulate:
             solution = """R Fw Dw' Rw2 Fw' Dw' Uw' Rw' U Fw' B' Uw' L' Dw Lw2 Uw' F Rw2 Dw' B2 Bw2 Lw2 B Bw2 Dw2 R2 U' Uw2 Lw2 Fw2 Lw B R L2 B' Lw' R B' U2 Bw2 R2 D' B2 L2 R2 D L2 Bw2 U' Dw F2 Dw Uw F2 R2 Uw B2 L2 Dw F2 Uw2 Bw D2 L2 D2 Bw' D2 Fw U2 Fw' Rw F2 U2 Lw D2 Lw2 B2 Lw' B2 Lw2 U L D' B2 U2 F B U' D F' U B2 R2 L2 U' B2 U L2 U R2""".split()
-            self.rows_and_cols = 5
 
             #solution = """L' 3Dw' Uw2 L R' Uw F' 3Rw2 Uw' Bw2 D Fw2 3Rw2 3Fw2 Uw2 L' Dw2 L F 3Uw2 L2 F R Dw2 B 3Uw2 U F' Uw L2 D2 Fw Uw2 Rw Dw Lw2 Rw Bw' B' Fw2 Uw B Dw2 Uw2 L' Dw' F Uw' Uw2 Lw2 Rw2 Bw2 U2 D' L2 Uw2 L Lw2 F2 Dw2 3Dw2 U' L 3Rw2 D2 B U2 F R 3Fw2 3Lw2 D2 F 3Dw' L D2 3Dw R2 U2 3Dw' L' 3Uw 2Bw2 L U L' F' U' 2Bw2 L' 2Bw2 B2 2Lw2 D F2 D' F2 2Lw2 2Bw2 L2 2Uw2 R2 2Uw B2 L2 2Uw' R2 2Uw L2 B2 2Uw 2Lw2 2Rw' B2 D2 B2 D2 2Lw2 2Rw 2Fw R2 L2 D2 2Fw L2 2Fw' U2 2Bw R L U2 B L U2 L F2 L' D B' U' R2 U' D2 B2 R2 D2 L2""".split()
             #self.rows_and_cols = 6
@@ -1560,7 +2840,52 @@ class CraneCuber3x3x3(object):
             else:
                 raise Exception("Could not find solution in output\n%s" % "\n".join(output))
 
+        return solution
+
+    def resolve_actions(self, solution=None):
+        """
+        solution is passed in if it was already fetched by the speculative
+        solve during scan()
+        """
+        if self.shutdown_event.is_set():
+            return
+
+        if solution is None:
+            solution = self.fetch_solution()
+
+        # The emulated solution is for a 5x5x5
+        if self.emulate:
+            self.rows_and_cols = 5
+
         self.run_solution(solution)
+        self.park()
+
+    def copy_state(self, other):
+        """
+        Take over the cube orientation and the scan results from 'other',
+        the CraneCuber object that did the scan
+        """
+        self.rows_in_turntable = other.rows_in_turntable
+        self.flipper_at_init = other.flipper_at_init
+        self.facing_north = other.facing_north
+        self.facing_west = other.facing_west
+        self.facing_south = other.facing_south
+        self.facing_east = other.facing_east
+        self.facing_up = other.facing_up
+        self.facing_down = other.facing_down
+        self.colors = deepcopy(other.colors)
+        self.scan_face_ms = dict(other.scan_face_ms)
+        self.resolved_colors = other.resolved_colors
+        self.cube_for_resolver = other.cube_for_resolver
+
+    def park(self):
+        """
+        Put the elevator, flipper, turntable and squisher back where
+        init_motors() left them
+        """
+        if self.shutdown_event.is_set():
+            return
+
         self.elevate(0)
         self.squisher_reset()
 
@@ -1571,6 +2896,57 @@ class CraneCuber3x3x3(object):
         square_pos = round_to_quarter_turn(self.turntable.position)
         self._rotate(square_pos, True, False)
 
+        if not self.shutdown_event.is_set():
+            self.hardware.parked = True
+            self.hardware.flipper_at_init = self.flipper_at_init
+
+    def check_program_step(self, step):
+        """
+        Raise an exception unless step calls one of the
+        AGENT_PROGRAM_PRIMITIVES with arguments it accepts
+        """
+        import inspect
+
+        if not isinstance(step, list) or not step or step[0] not in AGENT_PROGRAM_PRIMITIVES:
+            raise Exception("Unsupported program step %s" % str(step))
+
+        (name, args) = (step[0], step[1:])
+
+        try:
+            inspect.signature(getattr(self, name)).bind(*args)
+        except TypeError as e:
+            raise Exception("Program step %s: %s" % (str(step), e))
+
+        # bool is an int, do not let true through as a row count
+        for (arg, arg_type) in zip(args, AGENT_PROGRAM_PRIMITIVES[name]):
+            if type(arg) is not arg_type:
+                raise Exception("Program step %s: %r should be a %s" % (str(step), arg, arg_type.__name__))
+
+        if name == 'elevate' and not 0 <= args[0] <= self.rows_and_cols:
+            raise Exception("Program step %s: rows must be between 0 and %d" % (str(step), self.rows_and_cols))
+
+        if name == 'rotate' and args[1] not in (1, 2):
+            raise Exception("Program step %s: quarter_turns must be 1 or 2" % str(step))
+
+    def run_program(self, program):
+        """
+        program is a list of primitives with their arguments such as
+        [["elevate", 3], ["rotate", true, 1], ["flip"], ["squish"]]
+        """
+
+        # Check the entire program before we move anything
+        for step in program:
+            self.check_program_step(step)
+
+        log.info("run_program: %d steps" % len(program))
+
+        for step in program:
+            if self.shutdown_event.is_set():
+                break
+
+            tracer.event("run_program %s", step)
+            getattr(self, step[0])(*step[1:])
+
     def test_basics(self):
         """
         Test the three motors
@@ -1760,7 +3136,7 @@ class CraneCuber6x6x6(CraneCuber3x3x3):
 
 class CraneCuber7x7x7(CraneCuber3x3x3):
 
-    def __init__(self, SERVER, emulate, rows_and_cols=7, size_mm=69):
+    def __init__(self, SERVER, emulate, platform, rows_and_cols=7, size_mm=69):
         CraneCuber3x3x3.__init__(self, SERVER, emulate, platform, rows_and_cols, size_mm)
 
         # These are for a 69mm 7x7x7 cube
@@ -1773,57 +3149,508 @@ class CraneCuber7x7x7(CraneCuber3x3x3):
         log.warning("Using CraneCuber7x7x7, rows_in_turntable_to_count_as_face_turn %d" % self.rows_in_turntable_to_count_as_face_turn)
 
 
+def create_cranecuber(SERVER, emulate, platform, size):
+
+    if size == 2:
+        cc = CraneCuber2x2x2(SERVER, emulate, platform)
+    elif size == 3:
+        cc = CraneCuber3x3x3(SERVER, emulate, platform)
+    elif size == 4:
+        cc = CraneCuber4x4x4(SERVER, emulate, platform)
+    elif size == 5:
+        cc = CraneCuber5x5x5(SERVER, emulate, platform)
+    elif size == 6:
+        cc = CraneCuber6x6x6(SERVER, emulate, platform)
+    elif size == 7:
+        cc = CraneCuber7x7x7(SERVER, emulate, platform)
+    else:
+        raise Exception("%dx%dx%d cubes are not yet supported" % (size, size, size))
+
+    if platform == 'brickpi3':
+        cc.leds = None
+
+    return cc
+
+
+def switch_cranecuber(cc, mts, size):
+    """
+    Hand the cube over to a CraneCuber object for a 'size' cube
+    """
+    log.info("switching from %dx%dx%d to %dx%dx%d" % (cc.rows_and_cols, cc.rows_and_cols, cc.rows_and_cols, size, size, size))
+    new_cc = create_cranecuber(cc.SERVER, cc.emulate, cc.platform, size)
+    new_cc.copy_state(cc)
+    mts.cc = new_cc
+    new_cc.mts = mts
+    return new_cc
+
+
+def scan_and_solve(cc, mts):
+    """
+    cc is the CraneCuber6x6x6 object we start scanning with, its motors
+    must already be initialized.  Returns the CraneCuber object that solved
+    the cube.
+    """
+    if cc.leds:
+        cc.leds.set_color('LEFT', 'ORANGE')
+        cc.leds.set_color('RIGHT', 'ORANGE')
+
+    solve_trace.start()
+
+    # cranecuberd can tell the size from the picture of F, use the right
+    # motion profile for the other five sides
+    start = time()
+    cc.scan_first_side()
+    solve_trace.record('scan_first_side', start)
+    size = cc.get_cube_size()
+
+    if size and size != cc.rows_and_cols:
+        cc = switch_cranecuber(cc, mts, size)
+
+    # scan() fetches the colors and the solution in the background while it
+    # finishes moving the cube
+    start = time()
+    cc.scan()
+    solve_trace.record('scan', start)
+
+    start = time()
+    solution = cc.wait_for_speculative_solve()
+    solve_trace.record('wait_for_speculative_solve', start)
+
+    if cc.shutdown_event.is_set():
+        solve_trace.finish(cc.SERVER)
+        return cc
+
+    # We have scanned all sides and know how many squares there are, if
+    # that does not agree with GET_CUBE_SIZE switch to the right class
+    #
+    # cc.colors is a dict where the square_index is the key and the RGB is the value
+    squares_per_side = len(cc.colors.keys()) / 6
+    size = int(math.sqrt(squares_per_side))
+
+    if size != cc.rows_and_cols:
+        cc = switch_cranecuber(cc, mts, size)
+
+    start = time()
+    cc.resolve_actions(solution)
+    solve_trace.record('resolve_actions', start)
+
+    tracer.dump()
+    solve_trace.finish(cc.SERVER)
+
+    if cc.leds:
+        cc.leds.set_color('LEFT', 'GREEN')
+        cc.leds.set_color('RIGHT', 'GREEN')
+
+    return cc
+
+
+class TouchSensorWatcher(object):
+    """
+    Watch the TouchSensor from a small forked child process so the robot
+    process does not spend any CPU or GIL time polling it.  The child
+    poll(2)s the sensor's value attribute and writes a line per press or
+    release, along with the time it saw the change, to a pipe.  sysfs only
+    wakes up poll(2) if the sensor driver calls sysfs_notify so the child
+    also re-reads the value every TOUCH_SENSOR_POLL_MS.
+    """
+
+    def __init__(self, value_filename):
+        self.value_filename = value_filename
+        self.pid = None
+        self.fh = None
+
+    def start(self):
+        (read_fd, write_fd) = os.pipe()
+        parent_pid = os.getpid()
+        pid = os.fork()
+
+        if pid == 0:
+            os.close(read_fd)
+
+            try:
+                self._watch(write_fd, parent_pid)
+            except Exception:
+                pass
+            finally:
+                os._exit(0)
+
+        os.close(write_fd)
+        self.pid = pid
+        self.fh = os.fdopen(read_fd, 'r')
+
+    def _watch(self, write_fd, parent_pid):
+        # The parent handles ctrl-c and will kill us via stop()
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        pressed = None
+
+        with open(self.value_filename, 'rb', buffering=0) as fh:
+            poller = poll()
+            poller.register(fh, POLLPRI | POLLERR)
+
+            while os.getppid() == parent_pid:
+                fh.seek(0)
+                value = (fh.read().strip() == b'1')
+
+                if value != pressed:
+                    pressed = value
+                    os.write(write_fd, ("%d %f\n" % (int(pressed), time())).encode())
+
+                poller.poll(TOUCH_SENSOR_POLL_MS)
+
+    def events(self):
+        """
+        Yield a (pressed, event_time) tuple for each press and release, this
+        blocks until the next one happens or the watcher is stopped
+        """
+        while True:
+            line = self.fh.readline()
+
+            if not line:
+                break
+
+            (pressed, event_time) = line.split()
+            yield (pressed == '1', float(event_time))
+
+    def stop(self):
+        if self.pid:
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+                os.waitpid(self.pid, 0)
+            except OSError:
+                pass
+            self.pid = None
+
+
 class MonitorTouchSensor(Thread):
 
-    def __init__(self, emulate):
+    def __init__(self, emulate, touch_sensor=None):
         Thread.__init__(self)
         self.cc = None
         self.shutdown_event = Event()
-        self.waiting_for_release = False
         self.emulate = emulate
+        self.touch_sensor = touch_sensor
+        self.watcher = None
 
     def __str__(self):
         return "MonitorTouchSensor"
 
+    def stop(self):
+        self.shutdown_event.set()
+
+        if self.watcher:
+            self.watcher.stop()
+
     def run(self):
 
         try:
             if self.emulate:
-                self.touch_sensor = DummySensor()
-            else:
-                self.touch_sensor = TouchSensor(INPUT_1)
+                self.shutdown_event.wait()
+                log.warning('%s: shutdown_event is set' % self)
+                return
 
-            while True:
+            self.watcher = TouchSensorWatcher(os.path.join(self.touch_sensor._path, 'value0'))
+            self.watcher.start()
 
-                if self.shutdown_event.is_set():
-                    log.warning('%s: shutdown_event is set' % self)
-                    break
+            if self.shutdown_event.is_set():
+                self.watcher.stop()
 
-                if self.touch_sensor.is_pressed:
+            for (pressed, event_time) in self.watcher.events():
 
-                    if not self.waiting_for_release:
-                        self.waiting_for_release = True
+                if self.shutdown_event.is_set():
+                    break
 
-                        if self.cc:
-                            if self.cc.waiting_for_touch_sensor.is_set():
-                                log.warning('%s: TouchSensor pressed, clearing cc waiting_for_touch_sensor' % self)
-                                self.cc.waiting_for_touch_sensor.clear()
-                            else:
-                                log.warning('%s: TouchSensor pressed, setting cc shutdown_event' % self)
-                                self.cc.mts = None
-                                self.cc.shutdown_robot()
-                                self.shutdown_event.set()
+                if pressed:
+                    if self.cc:
+                        if self.cc.waiting_for_touch_sensor.is_set():
+                            log.warning('%s: TouchSensor pressed, clearing cc waiting_for_touch_sensor' % self)
+                            self.cc.waiting_for_touch_sensor.clear()
+                            self.cc.touch_sensor_pressed.set()
+                        else:
+                            log.warning('%s: TouchSensor pressed, setting cc shutdown_event' % self)
+                            self.cc.mts = None
+                            self.cc.shutdown_robot(request_time=event_time)
+                            log.warning('%s: TouchSensor press-to-stop took %dms' % (self, (time() - event_time) * 1000))
+                            self.shutdown_event.set()
+                            break
                 else:
-                    if self.waiting_for_release:
-                        self.waiting_for_release = False
-                        log.warning('%s: TouchSensor released' % self)
-                #log.warning("MTS sleep 10ms")
-                sleep(0.1)
+                    log.warning('%s: TouchSensor released' % self)
+
+            log.warning('%s: shutdown_event is set' % self)
 
         except Exception as e:
             log.exception(e)
             self.shutdown_event.set()
 
+        finally:
+            if self.watcher:
+                self.watcher.stop()
+
+
+class RobotAgent(object):
+    """
+    A long lived process that owns the motors, display and TouchSensor and
+    runs jobs it receives on a localhost socket.  The motors are homed when
+    the agent starts, after a job that ended cleanly init_motors() only
+    verifies the parked positions.
+
+    Jobs use the same <START>...<END> framing as cranecuberd:
+
+        SCAN_AND_SOLVE
+        RUN_SOLUTION:<size>:<moves>
+        RUN_PROGRAM:{"size": 3, "program": [["elevate", 3], ["rotate", true, 1], ["flip"]]}
+        STATUS
+        QUIT
+
+    Jobs run one at a time in the order they were received, the reply is
+    sent when the job finishes.  See utils/agent_client.py
+    """
+
+    def __init__(self, SERVER, emulate, platform, touch_sensor, port=AGENT_PORT):
+        from queue import Queue
+        self.SERVER = SERVER
+        self.emulate = emulate
+        self.platform = platform
+        self.touch_sensor = touch_sensor
+        self.port = port
+        self.jobs = Queue()
+        self.job_count = 0
+        self.jobs_finished = 0
+        self.current_job = None
+        self.lock = Lock()
+        self.mts = None
+        self.shutdown_event = Event()
+        self.tcp_socket = None
+
+    def __str__(self):
+        return "RobotAgent"
+
+    def signal_handler(self, signal, frame):
+        log.error('%s: caught signal %d' % (self, signal))
+        self.shutdown_event.set()
+
+        if self.mts and self.mts.cc:
+            self.mts.cc.shutdown_robot()
+
+    def status(self):
+        job = self.current_job
+
+        if job:
+            running = "job %d %s" % (job['id'], job['command'].split(':')[0])
+        else:
+            running = "nothing"
+
+        return "FINISHED: running %s, %d jobs waiting, %d jobs finished" % (running, self.jobs.qsize(), self.jobs_finished)
+
+    def queue_job(self, command):
+
+        with self.lock:
+            self.job_count += 1
+            job = {
+                'id': self.job_count,
+                'command': command,
+                'queued': time(),
+                'done': Event(),
+                'result': None,
+            }
+
+        self.jobs.put(job)
+        log.info("%s: queued job %d %s, %d jobs waiting" % (self, job['id'], command.split(':')[0], self.jobs.qsize()))
+        return job
+
+    def cancel_jobs(self, reason):
+        from queue import Empty
+
+        while True:
+            try:
+                job = self.jobs.get_nowait()
+            except Empty:
+                break
+
+            log.warning("%s: cancelled job %d, %s" % (self, job['id'], reason))
+            job['result'] = "ERROR: job %d cancelled, %s" % (job['id'], reason)
+            job['done'].set()
+
+    def handle_connection(self, connection):
+
+        try:
+            total_data = []
+            data = ''
+
+            # RX the entire packet
+            while True:
+                chunk = connection.recv(4096)
+
+                if not chunk:
+                    break
+
+                total_data.append(chunk.decode())
+                data = ''.join(total_data)
+
+                if data.startswith('<START>') and data.endswith('<END>'):
+                    break
+
+            if not (data.startswith('<START>') and data.endswith('<END>')):
+                log.warning("%s: RXed incomplete command %s" % (self, data))
+                return
+
+            # Remove the <START> and <END>
+            command = data[7:-5]
+
+            if command == 'STATUS':
+                response = self.status()
+
+            elif command == 'QUIT':
+                log.info("%s: QUIT RXed, stopping after the current job" % self)
+                self.shutdown_event.set()
+                response = 'FINISHED: agent is stopping'
+
+            else:
+                job = self.queue_job(command)
+                job['done'].wait()
+                response = job['result']
+
+            connection.sendall(response.encode())
+
+        except Exception as e:
+            log.exception(e)
+
+        finally:
+            connection.close()
+
+    def listen(self):
+
+        while not self.shutdown_event.is_set():
+            ready = select([self.tcp_socket], [], [], 1)
+
+            if ready[0]:
+                (connection, _) = self.tcp_socket.accept()
+                thread = Thread(target=self.handle_connection, args=(connection,))
+                thread.daemon = True
+                thread.start()
+
+    def prepare(self, size):
+        """
+        Return a CraneCuber object for a 'size' cube with its motors
+        initialized
+        """
+        if self.mts is None or not self.mts.is_alive():
+            self.mts = MonitorTouchSensor(self.emulate, self.touch_sensor)
+            self.mts.start()
+
+        cc = create_cranecuber(self.SERVER, self.emulate, self.platform, size)
+        self.mts.cc = cc
+        cc.mts = self.mts
+        cc.init_motors()
+        return cc
+
+    def run_job(self, job):
+        command = job['command']
+        cc = None
+        start = time()
+        self.current_job = job
+        log.info("%s: starting job %d %s, waited %dms in the queue" %
+            (self, job['id'], command.split(':')[0], (start - job['queued']) * 1000))
+
+        try:
+            if command == 'SCAN_AND_SOLVE':
+                cc = self.prepare(6)
+                cc = scan_and_solve(cc, self.mts)
+
+            elif command.startswith('RUN_SOLUTION:'):
+                (size, solution) = command[len('RUN_SOLUTION:'):].split(':', 1)
+                cc = self.prepare(int(size))
+                cc.run_solution(solution.split())
+                cc.park()
+
+            elif command.startswith('RUN_PROGRAM:'):
+                import json
+                program = json.loads(command[len('RUN_PROGRAM:'):])
+                cc = self.prepare(int(program['size']))
+                cc.run_program(program['program'])
+                cc.park()
+
+            else:
+                raise Exception("unsupported job %s" % command)
+
+            if cc.shutdown_event.is_set():
+                job['result'] = "ERROR: job %d was stopped" % job['id']
+                self.cancel_jobs("job %d was stopped" % job['id'])
+            else:
+                job['result'] = "FINISHED: job %d took %dms" % (job['id'], (time() - start) * 1000)
+
+        except Exception as e:
+            log.exception(e)
+            job['result'] = "ERROR: job %d failed, %s" % (job['id'], e)
+
+            if cc:
+                cc.shutdown_robot()
+            else:
+                hardware = Hardware.get(self.emulate, self.platform)
+                brake_motors([hardware.elevator, hardware.flipper, hardware.turntable, hardware.squisher])
+
+        finally:
+            # Ignore TouchSensor presses until the next job starts
+            if self.mts:
+                self.mts.cc = None
+
+            self.current_job = None
+            self.jobs_finished += 1
+            tracer.dump()
+            log.info("%s: %s" % (self, job['result']))
+            job['done'].set()
+
+    def run(self, profile=None):
+        from queue import Empty
+
+        signal.signal(signal.SIGTERM, self.signal_handler)
+        signal.signal(signal.SIGINT, self.signal_handler)
+        CraneCuber3x3x3.install_signal_handlers = False
+
+        cc = self.prepare(3)
+        self.mts.cc = None
+
+        # Nothing has moved since init_motors() so the first job does not
+        # need to home the motors again
+        cc.hardware.parked = True
+
+        if profile:
+            profile.mark('init_motors')
+            profile.report()
+
+        self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp_socket.bind(('127.0.0.1', self.port))
+        self.tcp_socket.listen(5)
+
+        listener = Thread(target=self.listen)
+        listener.daemon = True
+        listener.start()
+        log.info("%s: waiting for jobs on port %d" % (self, self.port))
+
+        while not self.shutdown_event.is_set():
+            try:
+                job = self.jobs.get(timeout=1)
+            except Empty:
+                continue
+
+            self.run_job(job)
+
+        self.cancel_jobs("agent is stopping")
+        listener.join()
+        self.tcp_socket.close()
+
+        hardware = Hardware.get(self.emulate, self.platform)
+        brake_motors([hardware.elevator, hardware.flipper, hardware.turntable, hardware.squisher])
+        hardware.renderer.stop()
+
+        if self.mts:
+            self.mts.stop()
+            self.mts.join()
+            self.mts = None
+
+        log.info("%s: stopped after %d jobs" % (self, self.jobs_finished))
+
 
 if __name__ == '__main__':
 
@@ -1838,9 +3665,27 @@ if __name__ == '__main__':
     logging.addLevelName(logging.ERROR, "\033[91m   %s\033[0m" % logging.getLevelName(logging.ERROR))
     logging.addLevelName(logging.WARNING, "\033[91m %s\033[0m" % logging.getLevelName(logging.WARNING))
 
+    import argparse
+    from ev3dev2 import get_current_platform
+
+    profile = StartupProfile()
+    profile.mark('imports')
+
     parser = argparse.ArgumentParser()
     parser.add_argument('--emulate', action='store_true', default=False, help='Run in emulator mode')
+    parser.add_argument('--trace', action='store_true', default=False,
+                        help='Record motion events in memory and write them to %s after each solve, '
+                             'also write a timeline of the robot and cranecuberd spans to %s' % (TRACE_FILENAME, SOLVE_TIMELINE_FILENAME.replace('%d', '<solve_id>')))
+    parser.add_argument('--verbose', action='store_true', default=False, help='Log every motion event as it happens')
+    parser.add_argument('--one-shot', action='store_true', default=False,
+                        help='Open a new connection to cranecuberd for every command (for an older cranecuberd)')
+    parser.add_argument('--agent', action='store_true', default=False,
+                        help='Stay running and take jobs on localhost port %d, see utils/agent_client.py' % AGENT_PORT)
     args = parser.parse_args()
+    tracer.enabled = args.trace
+    tracer.verbose = args.verbose
+    use_daemon_sessions = not args.one_shot
+    profile.mark('args')
 
     server_conf = "server.conf"
     SERVER = None
@@ -1863,6 +3708,9 @@ if __name__ == '__main__':
     platform = get_current_platform()
 
     if platform == 'brickpi3':
+        from ev3dev2.port import LegoPort
+        from ev3dev2.sensor import INPUT_4
+
         # http://docs.ev3dev.org/projects/lego-linux-drivers/en/ev3dev-jessie/sensors.html
         sensor_port1 = LegoPort(INPUT_4)
         sensor_port1.mode = 'ev3-analog'
@@ -1898,13 +3746,24 @@ if __name__ == '__main__':
 
     # Verify we can talk to the cranecuberd server
     send_command(SERVER, 10000, "PING")
+    profile.mark('server ping')
 
     # Verify the TouchSensor is connected
-    if not args.emulate:
+    if args.emulate:
+        touch_sensor = None
+    else:
+        from ev3dev2.sensor import INPUT_1
+        from ev3dev2.sensor.lego import TouchSensor
         touch_sensor = TouchSensor(INPUT_1)
+    profile.mark('touch sensor')
+
+    if args.agent:
+        agent = RobotAgent(SERVER, args.emulate, platform, touch_sensor)
+        agent.run(profile)
+        sys.exit(0)
 
     cc = None
-    mts = MonitorTouchSensor(args.emulate)
+    mts = MonitorTouchSensor(args.emulate, touch_sensor)
     mts.cc = cc
     mts.start()
 
@@ -1912,67 +3771,26 @@ if __name__ == '__main__':
         while True:
 
             # Use a CraneCuber6x6x6 object for scanning
-            cc = CraneCuber6x6x6(SERVER, args.emulate, platform)
-
-            if platform == 'brickpi3':
-                cc.leds = None
-
+            cc = create_cranecuber(SERVER, args.emulate, platform, 6)
             mts.cc = cc
             cc.mts = mts
+
+            if profile:
+                profile.mark('hardware')
+
             cc.init_motors()
 
+            if profile:
+                profile.mark('init_motors')
+                profile.report()
+                profile = None
+
             if not args.emulate:
                 cc.waiting_for_touch_sensor.set()
                 log.info('waiting for TouchSensor press')
+                cc.touch_sensor_pressed.wait()
 
-            while not cc.shutdown_event.is_set() and cc.waiting_for_touch_sensor.is_set():
-                sleep (0.1)
-
-            if cc.leds:
-                cc.leds.set_color('LEFT', 'ORANGE')
-                cc.leds.set_color('RIGHT', 'ORANGE')
-
-            cc.scan()
-            cc.get_colors()
-
-            if cc.shutdown_event.is_set():
-                break
-
-            # We have scanned all sides and know how many squares there are, use
-            # this to create an object of the appropriate class
-            #
-            # cc.colors is a dict where the square_index is the key and the RGB is the value
-            colors = deepcopy(cc.colors)
-            squares_per_side = len(colors.keys()) / 6
-            size = int(math.sqrt(squares_per_side))
-
-            if size == 2:
-                cc = CraneCuber2x2x2(SERVER, args.emulate, platform)
-            elif size == 3:
-                cc = CraneCuber3x3x3(SERVER, args.emulate, platform)
-            elif size == 4:
-                cc = CraneCuber4x4x4(SERVER, args.emulate, platform)
-            elif size == 5:
-                cc = CraneCuber5x5x5(SERVER, args.emulate, platform)
-            elif size == 6:
-                cc = CraneCuber6x6x6(SERVER, args.emulate, platform)
-            elif size == 7:
-                pass
-            else:
-                raise Exception("%dx%dx%d cubes are not yet supported" % (size, size, size))
-
-            if platform == 'brickpi3':
-                cc.leds = None
-
-            mts.cc = cc
-            cc.mts = mts
-            cc.colors = colors
-            cc.resolve_colors()
-            cc.resolve_actions()
-
-            if cc.leds:
-                cc.leds.set_color('LEFT', 'GREEN')
-                cc.leds.set_color('RIGHT', 'GREEN')
+            cc = scan_and_solve(cc, mts)
 
             if cc.shutdown_event.is_set() or args.emulate:
                 break
@@ -1994,13 +3812,14 @@ if __name__ == '__main__':
 
     except Exception as e:
         log.exception(e)
+        tracer.dump()
 
         if cc and cc.leds:
             cc.leds.set_color('LEFT', 'RED')
             cc.leds.set_color('RIGHT', 'RED')
 
         if mts:
-            mts.shutdown_event.set()
+            mts.stop()
             mts.join()
             mts = None
 
@@ -3,25 +3,738 @@
 
 import argparse
 import cv2
+import datetime
+import glob
+import hashlib
+import json
 import logging
+import mmap
+import multiprocessing
 import os
+import protocol
 import random
+import re
+import resource
+import runpy
 import signal
 import socket
 import string
 import subprocess
 import sys
 import numpy as np
-from threading import Event
-from time import sleep
+from collections import OrderedDict, deque
+from distutils.spawn import find_executable
+from Queue import Empty, PriorityQueue, Queue
+from StringIO import StringIO
+from select import error as select_error, select
+from threading import Condition, Event, Lock, Thread
+from time import mktime, sleep, time
+
+# With the rubikscubetracker module the tracker processes read the frames
+# straight out of the FrameStore, without it we fall back to writing PNGs
+# and running rubiks-cube-tracker.py on them
+try:
+    from rubikscubetracker import RubiksImage
+except ImportError:
+    RubiksImage = None
 
 SCRATCHPAD_DIR = '/tmp/cranecuberd/'
 
+SOLVER_DIR = '/home/robot/rubiks-cube-NxNxN-solver/'
+
+# These are quick and must not wait behind a solve, they have their own
+# worker.  Anything that waits on the PNG writers or the tracker does not
+# belong here, PING and TAKE_PICTURE would wait behind it.
+FAST_COMMANDS = ('PING', 'TAKE_PICTURE', 'GET_TRACE', 'GET_WORKER_STATS', 'GET_CACHE_STATS')
+
+# When all of the --jobs workers are busy the waiting job with the lowest
+# priority runs next.  GET_CUBE_SIZE waits for side F to be tracked, the
+# robot holds the scan until it has the answer.  REPLAY_SCAN is offline
+# analysis and goes after everything a robot is waiting on.
+JOB_PRIORITY = {
+    'GET_CUBE_SIZE': 0,
+    'GET_RGB_COLORS': 1,
+    'GET_CUBE_STATE': 1,
+    'GET_CUBE_STATE_OLD': 1,
+    'SOLVE_FROM_PICS': 2,
+    'GET_SOLUTION': 2,
+    'REPLAY_SCAN': 3,
+}
+DEFAULT_JOB_PRIORITY = 1
+
+# The capture thread keeps the most recent CAMERA_RING_FRAMES frames
+CAMERA_RING_FRAMES = 4
+
+# Reopen the camera after this many camera.read() failures in a row
+CAMERA_MAX_READ_FAILURES = 10
+
+# Each FrameStore slot holds a frame up to this size (1080p BGR)
+FRAME_SLOT_BYTES = 1920 * 1080 * 3
+
+# With --solver-workers the solver's lookup tables are mmap'd and paged in
+# at start so a solve does not have to wait on the disk for them
+SOLVER_TABLES = 'lookup-table*'
+
+# A solved 3x3x3, each solver worker solves it once at start so everything
+# the solver imports is loaded before the first real solve
+WARMUP_CUBE_STATE = 'UUUUUUUUURRRRRRRRRFFFFFFFFFDDDDDDDDDLLLLLLLLLBBBBBBBBB'
+
+# Solutions are cached on disk here, the SOLUTION_CACHE_SIZE most recently
+# used are kept
+SOLUTION_CACHE_FILENAME = os.path.expanduser('~/.cranecuberd-solutions.json')
+SOLUTION_CACHE_SIZE = 5000
+
+# Tracker results are cached on disk in this directory, one file per side
+# of an archived scan and one per scan for all six sides.  TRACKER_CACHE_SIZE
+# of them are also kept in memory and the oldest files are removed at start
+# once there are more than TRACKER_CACHE_FILES.
+TRACKER_CACHE_DIR = os.path.expanduser('~/.cranecuberd-tracker/')
+TRACKER_CACHE_SIZE = 120
+TRACKER_CACHE_FILES = 5000
+
+# The faces in kociemba order and the direction each one faces, x is to
+# the right, y is up and z is towards the front
+FACE_NORMALS = (
+    ('U', (0, 1, 0)),
+    ('R', (1, 0, 0)),
+    ('F', (0, 0, 1)),
+    ('D', (0, -1, 0)),
+    ('L', (-1, 0, 0)),
+    ('B', (0, 0, -1)),
+)
+
+# x, y and z turn the whole cube the same way as R, U and F
+ROTATION_FACE = {'x': 'R', 'y': 'U', 'z': 'F'}
+# (rotation, reversed) for turning the whole cube the way a face turns
+FACE_ROTATION = {
+    'R': ('x', False),
+    'L': ('x', True),
+    'U': ('y', False),
+    'D': ('y', True),
+    'F': ('z', False),
+    'B': ('z', True),
+}
+
+# A move such as U, R', 2F, Bw2 or 3Lw' or a whole cube rotation such as x'
+MOVE = re.compile(r"^(\d*)([URFDLBxyz])(w?)(2|'|2'|'2|)$")
+
+# How many sides can be tracked at once
+TRACKER_PROCESSES = 2
+
+# With --workers these are run inside long lived worker processes instead of
+# a new interpreter per request
+WORKER_SCRIPTS = (
+    'rubiks-cube-tracker.py',
+    'rubiks-color-resolver.py',
+    'rubiks-color-resolver-old.py',
+    os.path.join(SOLVER_DIR, 'rubiks-cube-solver.py'),
+)
+
+# GET_TRACE can return the spans of this many recent solves
+TRACE_SOLVES_KEPT = 10
+
+# rubiks-cube-tracker.py numbers the squares side by side in this order
+TRACKER_SIDE_ORDER = ('U', 'L', 'F', 'R', 'B', 'D')
+
 
 class BrokenSocket(Exception):
     pass
 
 
+class RequestCancelled(Exception):
+    pass
+
+
+class SolverTables(object):
+    """
+    Read-only mmaps of the solver's lookup tables.  The solver workers open
+    the same files, paging them in once at start means every solve finds
+    them in the page cache instead of loading them from disk.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.maps = {}
+        self.load_ms = {}
+        self.size = 0
+
+    def load(self):
+        start = datetime.datetime.now()
+
+        for filename in sorted(glob.glob(os.path.join(self.directory, SOLVER_TABLES))):
+            size = os.path.getsize(filename)
+
+            if not size:
+                continue
+
+            file_start = datetime.datetime.now()
+
+            with open(filename, 'rb') as fh:
+                mm = mmap.mmap(fh.fileno(), 0, prot=mmap.PROT_READ)
+
+            # Touch every page
+            for offset in xrange(0, size, mmap.PAGESIZE):
+                mm[offset]
+
+            self.maps[filename] = mm
+            self.load_ms[os.path.basename(filename)] = delta_ms(file_start)
+            self.size += size
+
+        log.info("paged in %d solver tables, %dMB in %dms" % (len(self.maps), self.size / (1024 * 1024), delta_ms(start)))
+
+    def stats(self):
+        return {'tables': len(self.maps), 'bytes': self.size, 'load_ms': sum(self.load_ms.values())}
+
+
+def hit_rate_stats(entries, hits, misses):
+    lookups = hits + misses
+
+    return {
+        'entries': entries,
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': float(hits) / lookups if lookups else 0.0,
+    }
+
+
+class TrackerCache(object):
+    """
+    Tracker results keyed by the sha1 of the tracker version and the image,
+    the same picture is only ever tracked once.  The most recent results
+    are kept in memory and all of them as one JSON file each in directory.
+
+    The camera never captures the same frame twice so a live scan only
+    caches the results for all six sides, keyed by the keys of its sides,
+    for a GET_RGB_COLORS that is repeated after a failed resolve.
+    REPLAY_SCAN caches each side of an archived scan by its PNG, replaying
+    the scan again only tracks the sides whose PNG changed.
+    """
+
+    def __init__(self, directory, size):
+        self.directory = directory
+        self.size = size
+        self.lock = Lock()
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.version = ''
+
+    def load(self):
+        """
+        Work out the tracker version and drop the oldest files if there are
+        more than TRACKER_CACHE_FILES
+        """
+        sha = hashlib.sha1()
+        filenames = [find_executable('rubiks-cube-tracker.py')]
+
+        if RubiksImage:
+            filenames.append(sys.modules[RubiksImage.__module__].__file__)
+
+        for filename in filenames:
+            if filename:
+                filename = re.sub(r'\.py[co]$', '.py', filename)
+
+                with open(filename, 'rb') as fh:
+                    sha.update(fh.read())
+
+        self.version = sha.hexdigest()
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        filenames = sorted(glob.glob(os.path.join(self.directory, '*.json')), key=os.path.getmtime)
+
+        for filename in filenames[:-TRACKER_CACHE_FILES]:
+            os.unlink(filename)
+
+        log.info("tracker version %s, %d cached tracker results in %s" %
+                 (self.version[:8], min(len(filenames), TRACKER_CACHE_FILES), self.directory))
+
+    def key(self, *parts):
+        """
+        parts are strings or buffers such as numpy arrays
+        """
+        sha = hashlib.sha1(self.version)
+
+        for part in parts:
+            sha.update(part)
+
+        return sha.hexdigest()
+
+    def remember(self, key, result):
+        """
+        Must be called with self.lock held
+        """
+        self.results.pop(key, None)
+        self.results[key] = result
+
+        while len(self.results) > self.size:
+            self.results.popitem(last=False)
+
+    def get(self, key):
+        with self.lock:
+            result = self.results.get(key)
+
+            if result is not None:
+                self.remember(key, result)
+                self.hits += 1
+                return result
+
+        try:
+            with open(os.path.join(self.directory, key + '.json'), 'r') as fh:
+                result = json.load(fh)
+        except (IOError, ValueError):
+            result = None
+
+        with self.lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.remember(key, result)
+                self.hits += 1
+
+        return result
+
+    def put(self, key, result):
+        with self.lock:
+            self.remember(key, result)
+
+        filename = os.path.join(self.directory, key + '.json')
+
+        try:
+            with open(filename + '.tmp', 'w') as fh:
+                json.dump(result, fh)
+
+            os.rename(filename + '.tmp', filename)
+        except (IOError, OSError) as e:
+            log.warning("could not save tracker result %s, %s" % (filename, e))
+
+    def stats(self):
+        with self.lock:
+            return hit_rate_stats(len(self.results), self.hits, self.misses)
+
+
+class SolutionCache(object):
+    """
+    LRU cache of solver solutions that is also saved to disk.  Cube states
+    are stored in their canonical orientation so the same cube sitting in
+    the robot a different way round is a hit too, the moves are renamed to
+    match on the way in and out.
+    """
+
+    def __init__(self, filename, size):
+        self.filename = filename
+        self.size = size
+        self.lock = Lock()
+        self.solutions = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as fh:
+                for (canonical, moves) in json.load(fh):
+                    self.solutions[canonical] = moves
+        except IOError:
+            pass
+        except ValueError as e:
+            log.warning("ignoring %s, %s" % (self.filename, e))
+
+        log.info("loaded %d cached solutions from %s" % (len(self.solutions), self.filename))
+
+    def save(self):
+        tmp_filename = self.filename + '.tmp'
+
+        try:
+            with open(tmp_filename, 'w') as fh:
+                json.dump(list(self.solutions.items()), fh)
+
+            os.rename(tmp_filename, self.filename)
+        except (IOError, OSError) as e:
+            log.warning("could not save the solution cache to %s, %s" % (self.filename, e))
+
+    def get(self, cube_state):
+        """
+        Returns the moves that solve cube_state or None
+        """
+        (canonical, face_map) = canonical_cube_state(cube_state)
+
+        with self.lock:
+            moves = self.solutions.pop(canonical, None)
+
+            if moves is None:
+                self.misses += 1
+                return None
+
+            self.solutions[canonical] = moves
+            self.hits += 1
+
+        return rename_moves(moves, dict((to_face, face) for (face, to_face) in face_map.items()))
+
+    def put(self, cube_state, moves):
+        (canonical, face_map) = canonical_cube_state(cube_state)
+
+        if canonical is None:
+            return
+
+        moves = rename_moves(moves, face_map)
+
+        if moves is None:
+            return
+
+        with self.lock:
+            self.solutions.pop(canonical, None)
+            self.solutions[canonical] = moves
+
+            while len(self.solutions) > self.size:
+                self.solutions.popitem(last=False)
+
+            self.save()
+
+    def stats(self):
+        with self.lock:
+            return hit_rate_stats(len(self.solutions), self.hits, self.misses)
+
+
+class FrameStore(object):
+    """
+    The captured frames live in an anonymous shared mmap so the tracker
+    processes, which are forked after the FrameStore is created, can read
+    them as numpy arrays without a copy or a PNG round trip.  There is one
+    slot per side for even scans and one for odd scans so a new scan does
+    not overwrite a frame that is still being tracked.
+    """
+
+    def __init__(self, slot_bytes=FRAME_SLOT_BYTES):
+        self.slot_bytes = slot_bytes
+        self.slots = len(TRACKER_SIDE_ORDER) * 2
+        self.mm = mmap.mmap(-1, self.slot_bytes * self.slots)
+
+    def put(self, scan_id, side_name, img):
+        """
+        Copy img into the slot for scan_id/side_name, returns the
+        (slot, shape, dtype) needed to view() it
+        """
+        if img.nbytes > self.slot_bytes:
+            raise ValueError("%s frame is %d bytes, FRAME_SLOT_BYTES is %d" % (side_name, img.nbytes, self.slot_bytes))
+
+        slot = TRACKER_SIDE_ORDER.index(side_name) + (scan_id % 2) * len(TRACKER_SIDE_ORDER)
+        frame = (slot, img.shape, img.dtype.str)
+        self.view(*frame)[...] = img
+        return frame
+
+    def view(self, slot, shape, dtype):
+        count = 1
+
+        for dimension in shape:
+            count *= dimension
+
+        return np.frombuffer(self.mm, dtype=dtype, count=count, offset=slot * self.slot_bytes).reshape(shape)
+
+
+# Set by main() before the tracker processes are forked
+frame_store = None
+
+
+def cpu_seconds(pid=None):
+    """
+    user + system CPU seconds used by pid, or by this process
+    """
+    if pid is None:
+        times = os.times()
+        return times[0] + times[1]
+
+    with open('/proc/%d/stat' % pid) as fh:
+        # utime and stime are fields 14 and 15, the command name in
+        # field 2 may contain spaces
+        fields = fh.read().rsplit(')', 1)[1].split()
+
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+
+def script_worker_main(conn, initializer):
+    """
+    Runs in a ScriptWorker process, runs the (func, args) jobs that arrive
+    on conn one at a time and sends back (True, result) or (False, error)
+    """
+    # The daemon handles ctrl-c, it stops us with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    if initializer:
+        initializer()
+
+    while True:
+        try:
+            (func, args) = conn.recv()
+        except EOFError:
+            break
+
+        try:
+            result = (True, func(*args))
+        except Exception as e:
+            log.exception(e)
+            result = (False, str(e))
+
+        conn.send(result)
+
+
+def run_script(cmd, cwd):
+    """
+    Runs in a script worker.  The equivalent of subprocess.check_output(cmd,
+    cwd=cwd) without starting a new interpreter, the modules the script
+    imports stay loaded for the next call.  Returns (returncode, output),
+    exceptions do not always survive the trip back to the daemon.
+    """
+    path = cmd[0]
+
+    if not os.path.isabs(path):
+        path = find_executable(path)
+
+        if path is None:
+            return (127, '%s not found' % cmd[0])
+
+    script_dir = os.path.dirname(path)
+
+    if script_dir not in sys.path:
+        sys.path.insert(0, script_dir)
+
+    (argv, stdout, original_cwd) = (sys.argv, sys.stdout, os.getcwd())
+    output = StringIO()
+    returncode = 0
+
+    try:
+        sys.argv = [path] + list(cmd[1:])
+        sys.stdout = output
+
+        if cwd:
+            os.chdir(cwd)
+
+        try:
+            runpy.run_path(path, run_name='__main__')
+        except SystemExit as e:
+            if e.code:
+                returncode = e.code if isinstance(e.code, int) else 1
+
+    except Exception as e:
+        log.exception(e)
+        returncode = 1
+
+    finally:
+        (sys.argv, sys.stdout) = (argv, stdout)
+        os.chdir(original_cwd)
+
+    return (returncode, output.getvalue().strip())
+
+
+def facelet_positions(size):
+    """
+    Returns the (x, y, z) of every square of a size x size x size cube in
+    kociemba order.  Each face is read the way it is drawn in the usual net,
+    U has B above it, D has F above it and the other four have U above them.
+    """
+    positions = []
+    edge = size - 1
+
+    for row in range(size):
+        for col in range(size):
+            positions.append((2 * col - edge, size, 2 * row - edge))
+
+    for row in range(size):
+        for col in range(size):
+            positions.append((size, edge - 2 * row, edge - 2 * col))
+
+    for row in range(size):
+        for col in range(size):
+            positions.append((2 * col - edge, edge - 2 * row, size))
+
+    for row in range(size):
+        for col in range(size):
+            positions.append((2 * col - edge, -size, edge - 2 * row))
+
+    for row in range(size):
+        for col in range(size):
+            positions.append((-size, edge - 2 * row, 2 * col - edge))
+
+    for row in range(size):
+        for col in range(size):
+            positions.append((edge - 2 * col, edge - 2 * row, -size))
+
+    return positions
+
+
+def rotate_vector(matrix, vector):
+    return tuple(sum(matrix[row][i] * vector[i] for i in range(3)) for row in range(3))
+
+
+def cube_rotations():
+    """
+    Returns the 24 ways a cube can be turned as 3x3 rotation matrices
+    """
+    x = ((1, 0, 0), (0, 0, 1), (0, -1, 0))
+    y = ((0, 0, -1), (0, 1, 0), (1, 0, 0))
+    identity = ((1, 0, 0), (0, 1, 0), (0, 0, 1))
+    rotations = [identity]
+
+    for rotation in rotations:
+        for turn in (x, y):
+            combined = tuple(zip(*[rotate_vector(turn, column) for column in zip(*rotation)]))
+
+            if combined not in rotations:
+                rotations.append(combined)
+
+    return rotations
+
+
+# The facelet permutation and face relabelling of each cube rotation, by cube size
+cube_state_rotations = {}
+
+
+def get_cube_state_rotations(size):
+    """
+    Returns a (permutation, face_map) for each cube rotation.  Square i of
+    a cube_state ends up at permutation[i] and the square colors, which
+    kociemba names after the face with that center, are renamed by
+    face_map to follow the centers to their new faces.
+    """
+    if size not in cube_state_rotations:
+        positions = facelet_positions(size)
+        index = dict((position, i) for (i, position) in enumerate(positions))
+        face_by_normal = dict((normal, face) for (face, normal) in FACE_NORMALS)
+        result = []
+
+        for rotation in cube_rotations():
+            permutation = [index[rotate_vector(rotation, position)] for position in positions]
+            face_map = dict((face, face_by_normal[rotate_vector(rotation, normal)]) for (face, normal) in FACE_NORMALS)
+            result.append((permutation, face_map))
+
+        cube_state_rotations[size] = result
+
+    return cube_state_rotations[size]
+
+
+def canonical_cube_state(cube_state):
+    """
+    Returns (canonical, face_map) where canonical is the smallest of the
+    24 rotations of cube_state and face_map renames the faces of cube_state
+    to those of canonical.  Returns (None, None) if cube_state is not a
+    kociemba string.
+    """
+    size = int(round((len(cube_state) / 6) ** 0.5))
+
+    if not size or 6 * size * size != len(cube_state) or set(cube_state) - set('URFDLB'):
+        return (None, None)
+
+    best = (None, None)
+
+    for (permutation, face_map) in get_cube_state_rotations(size):
+        rotated = [None] * len(cube_state)
+
+        for (i, color) in enumerate(cube_state):
+            rotated[permutation[i]] = face_map[color]
+
+        rotated = ''.join(rotated)
+
+        if best[0] is None or rotated < best[0]:
+            best = (rotated, face_map)
+
+    return best
+
+
+def rename_moves(moves, face_map):
+    """
+    Rename the faces that 'moves' turn via face_map.  Returns None if there
+    is a move we do not understand.
+    """
+    result = []
+
+    for move in moves:
+        match = MOVE.match(move)
+
+        if not match:
+            return None
+
+        (layers, face, wide, turn) = match.groups()
+
+        if face in ROTATION_FACE:
+            (rotation, reverse) = FACE_ROTATION[face_map[ROTATION_FACE[face]]]
+
+            # Half turns are the same either way
+            if reverse and turn in ('', "'"):
+                turn = "'" if turn == '' else ''
+
+            result.append(rotation + turn)
+        else:
+            result.append(layers + face_map[face] + wide + turn)
+
+    return result
+
+
+def disk_reads():
+    """
+    Returns (bytes read from storage, major page faults) for this process
+    """
+    read_bytes = 0
+
+    try:
+        with open('/proc/self/io') as fh:
+            for line in fh:
+                if line.startswith('read_bytes:'):
+                    read_bytes = int(line.split()[1])
+    except IOError:
+        pass
+
+    return (read_bytes, resource.getrusage(resource.RUSAGE_SELF).ru_majflt)
+
+
+def warm_solver_worker():
+    """
+    ScriptWorker initializer for the solver workers
+    """
+    start = datetime.datetime.now()
+    run_script([os.path.join(SOLVER_DIR, 'rubiks-cube-solver.py'), '--state', WARMUP_CUBE_STATE], SOLVER_DIR)
+    log.info("solver worker %d warmed up in %dms" % (os.getpid(), delta_ms(start)))
+
+
+def run_solver_script(cmd, cwd):
+    """
+    run_script() for the solver, also returns how long the solve took and
+    how much it had to read from disk.  With the tables paged in the disk
+    reads should be close to 0.
+    """
+    (read_bytes, major_faults) = disk_reads()
+    start = datetime.datetime.now()
+    (returncode, output) = run_script(cmd, cwd)
+    search_ms = delta_ms(start)
+    (read_bytes_after, major_faults_after) = disk_reads()
+
+    return (returncode, output, {
+        'search_ms': search_ms,
+        'disk_read_bytes': read_bytes_after - read_bytes,
+        'major_faults': major_faults_after - major_faults,
+    })
+
+
+def track_frame(slot, shape, dtype, side_name):
+    """
+    Runs in a tracker process, the image is a view of the FrameStore
+    """
+    rimg = RubiksImage(TRACKER_SIDE_ORDER.index(side_name), side_name)
+    rimg.image = frame_store.view(slot, shape, dtype)
+    rimg.analyze(webcam=False)
+    return rimg.data
+
+
+def track_png(png_filename, side_name):
+    """
+    Runs in a tracker process, for the PNGs of an archived scan
+    """
+    rimg = RubiksImage(TRACKER_SIDE_ORDER.index(side_name), side_name)
+    rimg.image = cv2.imread(png_filename)
+    rimg.analyze(webcam=False)
+    return rimg.data
+
+
 def open_tcp_socket(address='0.0.0.0', port=10000):
     """
     open/return a TCP socket
@@ -29,7 +742,7 @@ def open_tcp_socket(address='0.0.0.0', port=10000):
     tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     tcp_socket.bind((address, port))
-    tcp_socket.listen(1)
+    tcp_socket.listen(5)
 
     log.info("TCP socket opened on (%s, %s)" % (address, port))
     return tcp_socket
@@ -42,188 +755,1465 @@ def get_random_string(length=6):
     return ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for _ in range(length))
 
 
-class CraneCuberDaemon(object):
+def delta_ms(start):
+    finish = datetime.datetime.now()
+    return ((finish - start).seconds * 1000) + ((finish - start).microseconds / 1000)
 
-    def __init__(self, dev_video, ip, port):
-        self.shutdown_event = Event()
+
+class CameraCapture(object):
+    """
+    Keep the camera open and read frames from it in a background thread
+    into a ring buffer of (timestamp, img).  Opening the camera for each
+    picture is slow and reading once from a camera that has been open a
+    while can return a stale frame that was sitting in the driver's
+    buffers, reading continuously keeps those buffers drained.
+    """
+
+    def __init__(self, dev_video):
         self.dev_video = dev_video
-        self.ip = ip
-        self.port = port
+        self.camera = None
+        self.camera_lock = Lock()
+        self.frames = deque(maxlen=CAMERA_RING_FRAMES)
+        self.frames_cond = Condition()
+        self.stop_event = Event()
+        self.thread = None
+        self.settings = None
+        self.frame_count = 0
 
     def __str__(self):
-        return 'CraneCuberDaemon'
+        return "CameraCapture(/dev/video%d)" % self.dev_video
 
-    def signal_handler(self, signal, frame):
-        log.info("received SIGINT or SIGTERM")
-        self.shutdown_event.set()
+    def open(self):
+        start = datetime.datetime.now()
+        camera = cv2.VideoCapture(self.dev_video)
 
-    def main(self):
-        caught_exception = False
+        # Only keep one frame in the driver if this OpenCV supports it
+        if hasattr(cv2, 'CAP_PROP_BUFFERSIZE'):
+            camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)
 
-        # Log the process ID upon start-up.
-        pid = os.getpid()
-        log.info('cranecuberd started with PID %s for /dev/video%d' % (pid, self.dev_video))
+        if self.settings:
+            for (prop, value) in self.settings:
+                camera.set(prop, value)
 
-        tcp_socket = open_tcp_socket(self.ip, self.port)
+        self.camera = camera
+        log.info("%s: opened in %dms" % (self, delta_ms(start)))
 
-        # calibrate the camera settings
-        # Take a pic but throw it away, we do this so the camera adjusts the current lighting conditions
-        log.info("take first pic")
-        camera = cv2.VideoCapture(self.dev_video)
-        camera.read()
-        del(camera)
-        camera = None
-        sleep(3)
+    def start(self):
+        self.open()
+        self.thread = Thread(target=self.capture)
+        self.thread.daemon = True
+        self.thread.start()
 
-        # Now take a pic and note the brightness, etc
-        log.info("take second pic")
-        camera = cv2.VideoCapture(self.dev_video)
-        (retval, img) = camera.read()
+    def stop(self):
+        self.stop_event.set()
 
-        brightness = camera.get(cv2.CAP_PROP_BRIGHTNESS)
-        contrast = camera.get(cv2.CAP_PROP_CONTRAST)
-        saturation = camera.get(cv2.CAP_PROP_SATURATION)
-        gain = camera.get(cv2.CAP_PROP_GAIN)
-        del(camera)
-        camera = None
-        log.info("brightness %s, contrast %s, saturation %s, gain %s" % (brightness, contrast, saturation, gain))
+        with self.frames_cond:
+            self.frames_cond.notify_all()
 
-        while True:
+        if self.thread:
+            self.thread.join()
+            self.thread = None
 
-            # Wrap everything else in try/except so that we can log errors
-            # and exit cleanly
-            try:
-                if self.shutdown_event.is_set():
-                    log.info("Shutdown signal RXed.  Breaking out of the loop.")
-                    break
+        self.camera = None
 
-                try:
-                    (connection, _) = tcp_socket.accept()
-                except socket.error as e:
-                    if isinstance(e.args, tuple) and e[0] == 4:
-                        # 4 is 'Interrupted system call', a.k.a. SIGINT.
-                        # The user wants to stop cranecuberd.
-                        log.info("socket.accept() caught signal, starting shutdown")
-                        raise BrokenSocket("socket.accept() caught signal, starting shutdown")
-                    else:
-                        log.info("socket hit error\n%s" % e)
-                        tcp_socket.close()
-                        tcp_socket = open_tcp_socket()
-                        continue
+    def capture(self):
+        failures = 0
 
-                total_data = []
-
-                # RX the entire packet
-                while True:
-                    data = connection.recv(4096)
-
-                    # If the client is using python2 data will be a str but if they
-                    # are using python3 data will be encoded and must be decoded to
-                    # a str
-                    if not isinstance(data, str):
-                        data = data.decode()
-
-                    data = data.strip()
-                    log.info("RXed %s" % data)
-
-                    total_data.append(data)
-                    data = ''.join(total_data)
-
-                    # Do we have the entire packet?
-                    if data.startswith('<START>') and data.endswith('<END>'):
-
-                        # Remove the <START> and <END>
-                        data = data[7:-5]
-
-                        if data.startswith('TAKE_PICTURE'):
-                            side_name = data.strip().split(':')[1]
-                            png_filename = os.path.join(SCRATCHPAD_DIR, 'rubiks-side-%s.png' % side_name)
-
-                            if side_name == 'F':
-                                for filename in os.listdir(SCRATCHPAD_DIR):
-                                    if filename.endswith('.png'):
-                                        os.unlink(os.path.join(SCRATCHPAD_DIR, filename))
-
-                            # Set the brightness, etc to be the same as when we took a pic of side F.
-                            # This makes rubiks-color-resolver's job much easier.
-                            camera = cv2.VideoCapture(self.dev_video)
-                            camera.set(cv2.CAP_PROP_BRIGHTNESS, brightness)
-                            camera.set(cv2.CAP_PROP_CONTRAST, contrast)
-                            camera.set(cv2.CAP_PROP_SATURATION, saturation)
-                            camera.set(cv2.CAP_PROP_GAIN, gain)
-                            (retval, img) = camera.read()
-
-                            # If you do not delete the VideoCapture object opencv2 will sometimes return the
-                            # exact same image when you call read() back-to-back.  This is really bad when
-                            # you have flipped the cube to a new side and end up with a pic of the previous
-                            # side.
-                            del(camera)
-                            camera = None
-
-                            if retval:
-                                # Save the image to disk
-                                cv2.imwrite(png_filename, img)
-
-                                size = os.path.getsize(png_filename)
-
-                                if size:
-                                    response = 'FINISHED: image %s is %d bytes' % (png_filename, size)
-                                else:
-                                    response = 'ERROR: image %s is 0 bytes' % png_filename
-                            else:
-                                response = 'ERROR: image %s camera.read() failed' % png_filename
-
-                        elif data == 'GET_RGB_COLORS':
-                            cmd = ['rubiks-cube-tracker.py', '--directory', SCRATCHPAD_DIR]
-                            log.info("cmd: %s" % ' '.join(cmd))
-                            response = subprocess.check_output(cmd).strip()
-
-                        elif data.startswith('GET_CUBE_STATE:'):
-                            cmd = ['rubiks-color-resolver.py', '--json', '--rgb', data[len('GET_CUBE_STATE:'):]]
-                            log.info("cmd: %s" % ' '.join(cmd))
-                            response = subprocess.check_output(cmd).strip()
-
-                        elif data.startswith('GET_CUBE_STATE_OLD:'):
-                            cmd = ['rubiks-color-resolver-old.py', '--json', '--rgb', data[len('GET_CUBE_STATE_OLD:'):]]
-                            log.info("cmd: %s" % ' '.join(cmd))
-                            response = subprocess.check_output(cmd).strip()
-
-                        elif data == 'GET_CUBE_STATE_FROM_PICS':
-                            # Have not tested this
-                            cmd = ['rubiks-cube-tracker.py', '--directory', SCRATCHPAD_DIR]
-                            log.info("cmd: %s" % ' '.join(cmd))
-                            rgb = subprocess.check_output(cmd).strip()
-
-                            cmd = ['rubiks-color-resolver.py', '--json', '--rgb', rgb]
-                            log.info("cmd: %s" % ' '.join(cmd))
-                            response = subprocess.check_output(cmd).strip()
-
-                        elif data.startswith('GET_SOLUTION:'):
-                            cube_state = data.split(':')[1]
-                            cmd = "cd /home/robot/rubiks-cube-NxNxN-solver/; ./rubiks-cube-solver.py --state %s" % cube_state
-                            log.info("cmd: %s" % cmd)
-                            response = subprocess.check_output(cmd, shell=True).strip()
-
-                        elif data == 'PING':
-                            response = 'REPLY'
-
-                        else:
-                            log.warning("RXed %s (not supported)" % data)
-
-                        # TX our response and close the socket
-                        connection.send(response)
-                        connection.close()
-                        log.info("TXed %s response\n%s\n\n" % (data, response))
-
-                        # We have the entire msg so break out of the inside 'while True' loop
-                        break
+        while not self.stop_event.is_set():
 
-            except Exception as e:
-                log.exception(e)
-                caught_exception = True
-                break
+            # Stamp the frame with when we started to read it, the frame may
+            # have been exposed before read() returned
+            started = time()
 
-        log.info('cranecuberd is stopping with PID %s' % pid)
+            with self.camera_lock:
+                (retval, img) = self.camera.read()
+
+            if not retval:
+                failures += 1
+
+                if failures >= CAMERA_MAX_READ_FAILURES:
+                    log.warning("%s: camera.read() failed %d times in a row, reopening" % (self, failures))
+
+                    with self.camera_lock:
+                        self.camera = None
+                        self.open()
+
+                    failures = 0
+
+                sleep(0.05)
+                continue
+
+            failures = 0
+
+            with self.frames_cond:
+                self.frame_count += 1
+                self.frames.append((started, img))
+                self.frames_cond.notify_all()
+
+    def lock_settings(self):
+        """
+        Read the brightness, etc the camera settled on and pin them so every
+        picture is taken with the same settings.  This makes
+        rubiks-color-resolver's job much easier.
+        """
+        props = (cv2.CAP_PROP_BRIGHTNESS, cv2.CAP_PROP_CONTRAST, cv2.CAP_PROP_SATURATION, cv2.CAP_PROP_GAIN)
+
+        with self.camera_lock:
+            self.settings = [(prop, self.camera.get(prop)) for prop in props]
+
+            for (prop, value) in self.settings:
+                self.camera.set(prop, value)
+
+        return [value for (prop, value) in self.settings]
+
+    def frame_after(self, after, timeout):
+        """
+        Returns the first img captured after time 'after' or None if there
+        is not one within timeout seconds
+        """
+        deadline = time() + timeout
+
+        with self.frames_cond:
+            while not self.stop_event.is_set():
+                for (timestamp, img) in self.frames:
+                    if timestamp > after:
+                        return img
+
+                remaining = deadline - time()
+
+                if remaining <= 0:
+                    break
+
+                self.frames_cond.wait(remaining)
+
+        return None
+
+
+class CancelToken(object):
+    """
+    One per request.  The command worker running the request registers the
+    subprocess or ScriptWorker that the current stage is waiting on, the
+    event loop calls cancel() when the client disconnects or sends CANCEL.
+    """
+
+    def __init__(self):
+        self.event = Event()
+        self.lock = Lock()
+        self.stage = None
+        self.stage_start = None
+        self.process = None
+        self.worker = None
+
+    def is_set(self):
+        return self.event.is_set()
+
+    def check(self):
+        if self.event.is_set():
+            raise RequestCancelled()
+
+    def start_stage(self, stage, process=None, worker=None):
+        with self.lock:
+            (self.stage, self.stage_start, self.process, self.worker) = (stage, datetime.datetime.now(), process, worker)
+
+            if self.event.is_set():
+                self.kill()
+
+    def end_stage(self):
+        with self.lock:
+            (self.stage, self.process, self.worker) = (None, None, None)
+
+    def kill(self):
+        """
+        Kill the subprocess or ScriptWorker of the current stage, must be
+        called with self.lock held.  Returns the CPU seconds it had used.
+        """
+        cpu = 0.0
+
+        try:
+            if self.process and self.process.poll() is None:
+                cpu = cpu_seconds(self.process.pid)
+                self.process.kill()
+
+            # The worker only goes back to its ScriptWorkers after
+            # end_stage() so it is still running our job
+            elif self.worker is not None:
+                cpu = cpu_seconds(self.worker.pid) - self.worker.job_cpu
+                self.worker.kill()
+
+        # It finished while we were killing it
+        except (IOError, OSError):
+            pass
+
+        return cpu
+
+    def cancel(self):
+        """
+        Returns (stage, stage_start, cpu_seconds) for the stage that was
+        killed, stage is None if the request was between stages
+        """
+        with self.lock:
+            self.event.set()
+
+            if self.stage is None:
+                return (None, None, 0.0)
+
+            return (self.stage, self.stage_start, self.kill())
+
+
+class ScriptWorker(object):
+    """
+    A long lived process that runs one job at a time.  It has a pipe of its
+    own so, unlike a multiprocessing.Pool worker, it can be killed in the
+    middle of a job without leaving a queue lock held that every other job
+    needs.
+    """
+
+    def __init__(self, initializer=None):
+        (self.conn, child_conn) = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=script_worker_main, args=(child_conn, initializer))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.pid = self.process.pid
+        self.job_cpu = 0.0
+        self.killed = False
+
+    def __str__(self):
+        return 'ScriptWorker(%d)' % self.pid
+
+    def apply(self, func, args, name, cancel):
+        self.job_cpu = cpu_seconds(self.pid)
+        self.conn.send((func, args))
+
+        if cancel:
+            cancel.start_stage(name, worker=self)
+
+        try:
+            # Poll instead of blocking in recv(), another process may hold
+            # our pipe open after we were killed
+            while not self.conn.poll(0.1):
+                if cancel:
+                    cancel.check()
+
+                if not self.process.is_alive():
+                    raise Exception("%s: %s died" % (name, self))
+
+            (ok, result) = self.conn.recv()
+
+        # Our end of the pipe sees EOF once the worker is gone
+        except EOFError:
+            if cancel:
+                cancel.check()
+
+            raise Exception("%s: %s died" % (name, self))
+
+        finally:
+            if cancel:
+                cancel.end_stage()
+
+        if not ok:
+            raise Exception("%s: %s" % (name, result))
+
+        return result
+
+    def kill(self):
+        self.killed = True
+        os.kill(self.pid, signal.SIGKILL)
+
+    def is_alive(self):
+        # A killed worker may not have exited yet
+        return not self.killed and self.process.is_alive()
+
+    def terminate(self):
+        self.conn.close()
+
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def join(self):
+        self.process.join()
+
+
+class ScriptWorkers(object):
+    """
+    A pool of ScriptWorker processes.  A job has a worker to itself until it
+    finishes so cancel can kill that worker without touching any other job,
+    a worker that died or was killed is replaced with a new one.
+    """
+
+    def __init__(self, count, initializer=None):
+        self.initializer = initializer
+        self.cond = Condition(Lock())
+        self.idle = [ScriptWorker(initializer) for _ in range(count)]
+        self.workers = list(self.idle)
+        self.terminated = False
+
+    def apply(self, func, args, name=None, cancel=None):
+        worker = self.checkout(cancel)
+
+        try:
+            return worker.apply(func, args, name, cancel)
+        finally:
+            self.checkin(worker)
+
+    def checkout(self, cancel):
+        with self.cond:
+            while not self.idle:
+                if self.terminated:
+                    raise Exception("ScriptWorkers were terminated")
+
+                if cancel:
+                    cancel.check()
+
+                self.cond.wait(0.1)
+
+            return self.idle.pop()
+
+    def checkin(self, worker):
+        with self.cond:
+            if self.terminated:
+                return
+
+            if not worker.is_alive():
+                log.warning("%s is gone, starting a new script worker" % worker)
+                self.workers.remove(worker)
+                worker.join()
+                worker = ScriptWorker(self.initializer)
+                self.workers.append(worker)
+
+            self.idle.append(worker)
+            self.cond.notify()
+
+    def terminate(self):
+        with self.cond:
+            self.terminated = True
+            self.cond.notify_all()
+
+        for worker in self.workers:
+            worker.terminate()
+
+    def join(self):
+        for worker in self.workers:
+            worker.join()
+
+
+class ClientConnection(object):
+    """
+    A client socket.  Only the event loop reads from it, the command workers
+    send the responses so sends are serialized with send_lock.
+    """
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.buf = bytearray()
+        self.framed = None
+        self.one_shot_queued = False
+        self.closed = False
+        self.send_lock = Lock()
+
+    def __str__(self):
+        return "ClientConnection(%s:%d)" % self.address
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send_frame(self, request_id, text, binary='', flags=0):
+        with self.send_lock:
+            if self.closed:
+                raise socket.error("connection is closed")
+
+            protocol.send_frame(self.sock, request_id, text, binary, flags)
+
+    def close(self):
+        with self.send_lock:
+            if not self.closed:
+                self.closed = True
+                self.sock.close()
+
+
+class CraneCuberDaemon(object):
+
+    def __init__(self, dev_video, ip, port, jobs, archive_png, workers, solver_workers):
+        self.shutdown_event = Event()
+        self.dev_video = dev_video
+        self.ip = ip
+        self.port = port
+        self.jobs = jobs
+
+        # The tracker processes are started by main() if we have RubiksImage,
+        # without them the tracker needs the PNGs
+        self.tracker_pool = None
+        self.archive_png = archive_png or RubiksImage is None
+
+        # With --workers the WORKER_SCRIPTS are run by script_pool.
+        # startup_ms is how long each script takes to start in a new
+        # interpreter, worker_stats totals what the workers saved.
+        self.workers = workers
+        self.script_pool = None
+        self.startup_ms = {}
+        self.worker_stats = {}
+
+        # With --solver-workers solves go to solver_pool, its workers are
+        # warmed up at start and the lookup tables are paged in
+        self.solver_workers = solver_workers
+        self.solver_pool = None
+        self.solver_tables = SolverTables(SOLVER_DIR)
+        self.solution_cache = SolutionCache(SOLUTION_CACHE_FILENAME, SOLUTION_CACHE_SIZE)
+        self.brightness = None
+        self.contrast = None
+        self.saturation = None
+        self.gain = None
+        self.camera = CameraCapture(dev_video)
+
+        # TAKE_PICTURE replies as soon as the frame is in the FrameStore,
+        # frames[side_name] is its (slot, shape, dtype).  With archive_png
+        # the PNG is written by a writer thread while the robot moves to the
+        # next side.
+        self.frames = {}
+        self.png_writers = []
+        self.capture_stats = {}
+        self.capture_lock = Lock()
+
+        # Each frame is tracked as soon as it is stored so GET_RGB_COLORS
+        # only has to merge the results.  scan_id is bumped for every side F
+        # so late results from an old scan are ignored.  face_keys are the
+        # TrackerCache keys of the sides of the current scan.
+        self.scan_id = 0
+        self.tracker_queue = Queue()
+        self.tracker_results = {}
+        self.face_keys = {}
+        self.tracker_cache = TrackerCache(TRACKER_CACHE_DIR, TRACKER_CACHE_SIZE)
+
+        # Spans for the requests the robot tagged with a (solve_id, span_id)
+        # trace, keyed by solve_id
+        self.spans = OrderedDict()
+        self.span_lock = Lock()
+        self.next_span_id = 0
+
+        # The event loop reads the requests, FAST_COMMANDS go to fast_queue
+        # and everything else to job_queue.  Both are ordered by
+        # (priority, job_seq).
+        self.fast_queue = PriorityQueue()
+        self.job_queue = PriorityQueue()
+        self.job_seq = 0
+        self.job_lock = Lock()
+
+        # requests[conn][request_id] is the CancelToken of each request that
+        # has not been answered yet, also guarded by job_lock.  stage_ms[name]
+        # is (count, total ms) of the stages that ran to completion, a
+        # cancelled stage would have taken about as long.
+        self.requests = {}
+        self.stage_ms = {}
+
+    def __str__(self):
+        return 'CraneCuberDaemon'
+
+    def signal_handler(self, signal, frame):
+        log.info("received SIGINT or SIGTERM")
+        self.shutdown_event.set()
+
+    def record_span(self, trace, name, start):
+        """
+        Record a span that started at 'start' (a datetime) and ends now.
+        trace is the (solve_id, span_id) of the robot request that caused
+        it, spans for untraced requests are not kept.
+        """
+        if trace is None:
+            return
+
+        (solve_id, parent) = trace
+        ms = delta_ms(start)
+
+        with self.span_lock:
+            if solve_id not in self.spans:
+                self.spans[solve_id] = []
+
+                while len(self.spans) > TRACE_SOLVES_KEPT:
+                    self.spans.popitem(last=False)
+
+            self.next_span_id += 1
+            self.spans[solve_id].append({
+                'span': 'd%d' % self.next_span_id,
+                'parent': parent,
+                'name': name,
+                'start': mktime(start.timetuple()) + start.microsecond / 1000000.0,
+                'ms': ms,
+            })
+
+    def check_output(self, name, cmd, trace, cwd=None, cancel=None):
+        """
+        subprocess.check_output() plus a span for the subprocess.  With
+        --workers the WORKER_SCRIPTS are run by a script worker instead.
+        If cancel is set the subprocess or worker is killed and
+        RequestCancelled is raised.
+        """
+        start = datetime.datetime.now()
+
+        if cancel:
+            cancel.check()
+
+        try:
+            if self.solver_pool and os.path.basename(cmd[0]) == 'rubiks-cube-solver.py':
+                (returncode, output, stats) = self.solver_pool.apply(run_solver_script, (cmd, cwd), name, cancel)
+
+                if returncode:
+                    raise subprocess.CalledProcessError(returncode, cmd, output)
+
+                self.record_solve(stats)
+
+            elif self.script_pool and self.worker_script(cmd[0]):
+                (returncode, output) = self.script_pool.apply(run_script, (cmd, cwd), name, cancel)
+
+                if returncode:
+                    raise subprocess.CalledProcessError(returncode, cmd, output)
+
+                self.record_worker_saving(name, cmd[0], delta_ms(start))
+
+            else:
+                output = self.run_subprocess(name, cmd, cwd, cancel)
+
+            with self.job_lock:
+                (count, total_ms) = self.stage_ms.get(name, (0, 0))
+                self.stage_ms[name] = (count + 1, total_ms + delta_ms(start))
+
+            return output
+
+        finally:
+            self.record_span(trace, name, start)
+
+    def run_subprocess(self, name, cmd, cwd, cancel):
+        """
+        subprocess.check_output() that cancel can kill
+        """
+        if cancel is None:
+            return subprocess.check_output(cmd, cwd=cwd).strip()
+
+        # close_fds so a subprocess started by another worker does not hold
+        # our stdout pipe open after this one is killed
+        process = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, close_fds=True)
+        cancel.start_stage(name, process=process)
+
+        try:
+            output = process.communicate()[0]
+        finally:
+            cancel.end_stage()
+
+        cancel.check()
+
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, cmd, output)
+
+        return output.strip()
+
+    def worker_script(self, script):
+        return script in WORKER_SCRIPTS or os.path.basename(script) in WORKER_SCRIPTS
+
+    def measure_startup(self):
+        """
+        Time '<script> --help' for each of the WORKER_SCRIPTS, that is
+        roughly what a new interpreter spends on startup and imports before
+        it can do any work
+        """
+        with open(os.devnull, 'w') as devnull:
+            for script in WORKER_SCRIPTS:
+                path = script if os.path.isabs(script) else find_executable(script)
+
+                if not path or not os.path.exists(path):
+                    continue
+
+                start = datetime.datetime.now()
+                subprocess.call([path, '--help'], stdout=devnull, stderr=devnull, cwd=os.path.dirname(path))
+                self.startup_ms[os.path.basename(script)] = delta_ms(start)
+
+        log.info("script startup times %s" % ', '.join('%s %dms' % item for item in sorted(self.startup_ms.items())))
+
+    def record_solve(self, stats):
+        tables = self.solver_tables.stats()
+        log.info("solver: %dms of search, %dKB read from disk (%d major faults), %dMB of tables were paged in at start in %dms" %
+                 (stats['search_ms'], stats['disk_read_bytes'] / 1024, stats['major_faults'], tables['bytes'] / (1024 * 1024), tables['load_ms']))
+
+        with self.capture_lock:
+            totals = self.worker_stats.setdefault('solver', {'solves': 0, 'search_ms': 0, 'disk_read_bytes': 0, 'major_faults': 0})
+            totals['solves'] += 1
+
+            for key in ('search_ms', 'disk_read_bytes', 'major_faults'):
+                totals[key] += stats[key]
+
+            totals['tables'] = tables
+
+    def record_worker_saving(self, name, script, ms):
+        startup_ms = self.startup_ms.get(os.path.basename(script), 0)
+        log.info("%s took %dms in a script worker, a new interpreter would have spent ~%dms starting up" % (name, ms, startup_ms))
+
+        with self.capture_lock:
+            stats = self.worker_stats.setdefault(os.path.basename(script), {'requests': 0, 'ms': 0, 'startup_saved_ms': 0})
+            stats['requests'] += 1
+            stats['ms'] += ms
+            stats['startup_saved_ms'] += startup_ms
+
+    def write_png(self, scan_id, side_name, png_filename, img, trace):
+        start = datetime.datetime.now()
+        cv2.imwrite(png_filename, img)
+        self.record_span(trace, 'png_write %s' % side_name, start)
+
+        if os.path.exists(png_filename) and os.path.getsize(png_filename):
+            error = None
+
+            if self.tracker_pool is None:
+                self.tracker_queue.put((scan_id, side_name, None, png_filename, trace))
+        else:
+            error = 'image %s is 0 bytes' % png_filename
+            log.error(error)
+
+        with self.capture_lock:
+            self.capture_stats[side_name]['write_ms'] = delta_ms(start)
+            self.capture_stats[side_name]['error'] = error
+
+    def tracker_worker(self):
+        """
+        Extract the square colors from each picture as it arrives, from the
+        FrameStore via a tracker process if we have one else from the PNG
+        """
+        while not self.shutdown_event.is_set():
+            try:
+                (scan_id, side_name, frame, png_filename, trace) = self.tracker_queue.get(timeout=1)
+            except Empty:
+                continue
+
+            start = datetime.datetime.now()
+            key = None
+
+            # A live frame is never in the cache, its key is only used to
+            # find the results for all six sides (see get_rgb_colors())
+            try:
+                if frame:
+                    key = self.tracker_cache.key(side_name, str(frame[1]), frame_store.view(*frame))
+                    result = self.tracker_pool.apply(track_frame, frame + (side_name,))
+                    self.record_span(trace, 'tracker %s' % side_name, start)
+                else:
+                    with open(png_filename, 'rb') as fh:
+                        key = self.tracker_cache.key(side_name, fh.read())
+
+                    result = self.track_png_side(side_name, png_filename, trace)
+            except Exception as e:
+                log.exception(e)
+                result = None
+
+            tracker_ms = delta_ms(start)
+            log.info("tracker side %s took %dms" % (side_name, tracker_ms))
+
+            with self.capture_lock:
+                if scan_id == self.scan_id:
+                    self.tracker_results[side_name] = result
+                    self.face_keys[side_name] = key
+                    self.capture_stats[side_name]['tracker_ms'] = tracker_ms
+
+            self.tracker_queue.task_done()
+
+    def track_png_side(self, side_name, png_filename, trace, cancel=None):
+        """
+        Run the tracker on the picture of one side
+        """
+        if self.tracker_pool:
+            return self.tracker_pool.apply(track_png, (png_filename, side_name))
+
+        cmd = ['rubiks-cube-tracker.py', '--filename', png_filename,
+               '--index', str(TRACKER_SIDE_ORDER.index(side_name)), '--name', side_name]
+        log.info("cmd: %s" % ' '.join(cmd))
+        return json.loads(self.check_output('tracker %s' % side_name, cmd, trace, cancel=cancel))
+
+    def replay_scan(self, directory, trace=None, cancel=None):
+        """
+        The GET_RGB_COLORS output for the rubiks-side-*.png of an archived
+        scan in directory.  Each side is looked up in the tracker cache by
+        its PNG so only the sides that changed since the scan was last
+        replayed are tracked.
+        """
+        start = datetime.datetime.now()
+        colors = {}
+        cached = []
+        squares_per_side = None
+
+        for side_name in TRACKER_SIDE_ORDER:
+            if cancel:
+                cancel.check()
+
+            png_filename = os.path.join(directory, 'rubiks-side-%s.png' % side_name)
+
+            try:
+                with open(png_filename, 'rb') as fh:
+                    key = self.tracker_cache.key(side_name, fh.read())
+            except IOError as e:
+                return 'ERROR: could not read %s, %s' % (png_filename, e)
+
+            result = self.tracker_cache.get(key)
+
+            if result is None:
+                side_start = datetime.datetime.now()
+                result = self.track_png_side(side_name, png_filename, trace, cancel)
+                self.record_span(trace, 'tracker %s' % side_name, side_start)
+
+                if not result:
+                    return 'ERROR: could not find the squares on side %s' % side_name
+
+                self.tracker_cache.put(key, result)
+            else:
+                cached.append(side_name)
+
+            if squares_per_side is None:
+                squares_per_side = len(result)
+            elif len(result) != squares_per_side:
+                return 'ERROR: side %s has %d squares, side U has %d' % (side_name, len(result), squares_per_side)
+
+            colors.update(result)
+
+        log.info("REPLAY_SCAN %s took %dms, sides %s were cached" % (directory, delta_ms(start), ' '.join(cached) if cached else 'none'))
+        return json.dumps(colors)
+
+    def get_cube_size(self):
+        """
+        Return the cube size based on the tracker results for side F, the
+        robot uses this to switch to the right motion profile before it
+        scans the other five sides
+        """
+        start = datetime.datetime.now()
+        error = self.wait_for_frames()
+
+        if error:
+            return error
+
+        self.tracker_queue.join()
+
+        with self.capture_lock:
+            result = self.tracker_results.get('F')
+
+        if not result:
+            return 'ERROR: could not find the squares on side F'
+
+        size = int(round(len(result) ** 0.5))
+
+        if size * size != len(result):
+            return 'ERROR: side F has %d squares' % len(result)
+
+        log.info("GET_CUBE_SIZE %dx%dx%d took %dms" % (size, size, size, delta_ms(start)))
+        return str(size)
+
+    def get_rgb_colors(self, trace=None, cancel=None):
+        """
+        Merge the per side tracker results, if any side is missing or they
+        do not agree on the cube size run the tracker over all six pictures
+        """
+        start = datetime.datetime.now()
+        self.tracker_queue.join()
+
+        with self.capture_lock:
+            results = dict(self.tracker_results)
+            face_keys = dict(self.face_keys)
+
+        if all(results.get(side_name) for side_name in TRACKER_SIDE_ORDER):
+            squares_per_side = len(results['U'])
+            colors = {}
+
+            for side_name in TRACKER_SIDE_ORDER:
+                colors.update(results[side_name])
+
+            if (all(len(results[side_name]) == squares_per_side for side_name in TRACKER_SIDE_ORDER) and
+                    sorted(map(int, colors.keys())) == range(1, (squares_per_side * 6) + 1)):
+                log.info("GET_RGB_COLORS merged the per side tracker results in %dms" % delta_ms(start))
+                return json.dumps(colors)
+
+        # The tracker over all six pictures is cached too, by the keys of
+        # the six sides
+        if all(face_keys.get(side_name) for side_name in TRACKER_SIDE_ORDER):
+            key = self.tracker_cache.key('all', *[face_keys[side_name] for side_name in TRACKER_SIDE_ORDER])
+            colors = self.tracker_cache.get(key)
+
+            if colors is not None:
+                self.record_span(trace, 'tracker_cache', start)
+                log.info("GET_RGB_COLORS found the tracker results for all six sides in the cache in %dms" % delta_ms(start))
+                return json.dumps(colors)
+        else:
+            key = None
+
+        log.warning("GET_RGB_COLORS could not use the per side tracker results, running the tracker on %s" % SCRATCHPAD_DIR)
+
+        if not self.archive_png:
+            with self.capture_lock:
+                frames = dict(self.frames)
+
+            for (side_name, frame) in frames.items():
+                cv2.imwrite(os.path.join(SCRATCHPAD_DIR, 'rubiks-side-%s.png' % side_name), frame_store.view(*frame))
+
+        cmd = ['rubiks-cube-tracker.py', '--directory', SCRATCHPAD_DIR]
+        log.info("cmd: %s" % ' '.join(cmd))
+        output = self.check_output('tracker', cmd, trace, cancel=cancel)
+
+        if key:
+            try:
+                self.tracker_cache.put(key, json.loads(output))
+            except ValueError:
+                pass
+
+        return output
+
+    def wait_for_frames(self):
+        """
+        Wait until the frames of the current scan can be tracked, only the
+        rubiks-cube-tracker.py fallback has to wait for the PNGs
+        """
+        if self.tracker_pool:
+            return None
+
+        return self.wait_for_png_writers()
+
+    def wait_for_png_writers(self):
+        """
+        Wait for the PNGs of the current scan to be on disk, returns an
+        error string if any of them could not be written
+        """
+        # TAKE_PICTURE may add writers while we wait, only forget the ones
+        # that are done
+        with self.capture_lock:
+            writers = list(self.png_writers)
+
+        for writer in writers:
+            writer.join()
+
+        with self.capture_lock:
+            self.png_writers = [writer for writer in self.png_writers if writer.is_alive()]
+
+        with self.capture_lock:
+            errors = [stats['error'] for stats in self.capture_stats.values() if stats.get('error')]
+
+        if errors:
+            return 'ERROR: %s' % ', '.join(errors)
+        return None
+
+    def run_solver(self, cube_state, trace=None, cancel=None):
+        """
+        Returns the raw output of rubiks-cube-solver.py for cube_state, or
+        just its Solution: line if the solution was cached
+        """
+        start = datetime.datetime.now()
+        moves = self.solution_cache.get(cube_state)
+
+        if moves is not None:
+            self.record_span(trace, 'solution_cache', start)
+            log.info("solution cache hit, %d moves in %dms" % (len(moves), delta_ms(start)))
+            return 'Solution: %s' % ' '.join(moves)
+
+        cmd = [os.path.join(SOLVER_DIR, 'rubiks-cube-solver.py'), '--state', cube_state]
+        log.info("cmd: %s" % ' '.join(cmd))
+        output = self.check_output('solver', cmd, trace, cwd=SOLVER_DIR, cancel=cancel)
+
+        for line in output.splitlines():
+            if line.startswith('Solution:'):
+                self.solution_cache.put(cube_state, line.split(':')[1].strip().split())
+                break
+
+        return output
+
+    def solve_from_pics(self, progress, trace=None, cancel=None):
+        """
+        Run tracker -> resolver -> solver on the pictures of the current
+        scan without sending anything back to the robot in between.
+        progress() is called with a JSON update after each stage.
+
+        Returns a JSON dict of the rgb colors, the resolved cube state, the
+        solution and how long each stage took.
+        """
+        start = datetime.datetime.now()
+        timings_ms = {}
+        result = {}
+
+        def finished_stage(stage, stage_start):
+            timings_ms[stage] = delta_ms(stage_start)
+            log.info("SOLVE_FROM_PICS %s took %dms" % (stage, timings_ms[stage]))
+            progress(json.dumps({'stage': stage, 'ms': timings_ms[stage]}))
+
+        try:
+            stage = 'tracker'
+            stage_start = datetime.datetime.now()
+            error = self.wait_for_frames()
+
+            if error:
+                return error
+
+            result['colors'] = json.loads(self.get_rgb_colors(trace, cancel))
+            finished_stage(stage, stage_start)
+
+            stage = 'resolver'
+            stage_start = datetime.datetime.now()
+            cmd = ['rubiks-color-resolver.py', '--json', '--rgb', json.dumps(result['colors'])]
+            log.info("cmd: rubiks-color-resolver.py --json --rgb <%d colors>" % len(result['colors']))
+            result['state'] = json.loads(self.check_output('resolver', cmd, trace, cancel=cancel))
+            finished_stage(stage, stage_start)
+
+            stage = 'solver'
+            stage_start = datetime.datetime.now()
+            output = self.run_solver(result['state']['kociemba'], trace, cancel)
+
+            for line in output.splitlines():
+                if line.startswith('Solution:'):
+                    result['solution'] = line.split(':')[1].strip().split()
+                    break
+            else:
+                return 'ERROR: solver did not print a solution\n%s' % output
+
+            finished_stage(stage, stage_start)
+
+        except RequestCancelled:
+            raise
+
+        except Exception as e:
+            log.exception(e)
+            return 'ERROR: SOLVE_FROM_PICS %s stage failed, %s' % (stage, e)
+
+        timings_ms['total'] = delta_ms(start)
+        result['timings_ms'] = timings_ms
+        log.info("SOLVE_FROM_PICS took %dms" % timings_ms['total'])
+        return json.dumps(result)
+
+    def handle_command(self, data, progress=None, trace=None, cancel=None, queued=None):
+        """
+        'data' is the command with any framing removed, returns a
+        (response, binary) tuple.  binary is '' except for commands that
+        return raw bytes such as GET_PICTURE.
+
+        progress is called with updates from long running commands and trace
+        is the (solve_id, span_id) of the request, both are None for a
+        one-shot <START>cmd<END> connection.  cancel is the CancelToken of
+        the request and queued is when the event loop read it.
+        """
+        if progress is None:
+            progress = lambda update: None
+
+        binary = ''
+
+        if data.startswith('TAKE_PICTURE'):
+            side_name = data.strip().split(':')[1]
+            png_filename = os.path.join(SCRATCHPAD_DIR, 'rubiks-side-%s.png' % side_name)
+
+            if side_name == 'F':
+                self.wait_for_png_writers()
+
+                with self.capture_lock:
+                    self.scan_id += 1
+                    self.frames = {}
+                    self.capture_stats = {}
+                    self.tracker_results = {}
+                    self.face_keys = {}
+
+                for name in TRACKER_SIDE_ORDER:
+                    filename = os.path.join(SCRATCHPAD_DIR, 'rubiks-side-%s.png' % name)
+
+                    if os.path.exists(filename):
+                        os.unlink(filename)
+
+            start = datetime.datetime.now()
+
+            if queued is None:
+                queued = start
+
+            # The cube may have been moving until the robot sent this request so
+            # only a frame captured after it arrived will do.  It may have sat
+            # in the queue for a while, a frame from since then is still fine.
+            img = self.camera.frame_after(mktime(queued.timetuple()) + queued.microsecond / 1000000.0, 2)
+            self.record_span(trace, 'camera_wait', start)
+
+            if img is not None:
+                # Reply now so the robot can start moving to the next side,
+                # the frame is tracked (and archived) in the background
+                grab_ms = delta_ms(start)
+                store_start = datetime.datetime.now()
+                frame = frame_store.put(self.scan_id, side_name, img)
+                self.record_span(trace, 'frame_store %s' % side_name, store_start)
+
+                with self.capture_lock:
+                    self.frames[side_name] = frame
+                    self.capture_stats[side_name] = {'grab_ms': grab_ms, 'store_ms': delta_ms(store_start), 'error': None}
+
+                if self.tracker_pool:
+                    self.tracker_queue.put((self.scan_id, side_name, frame, None, trace))
+
+                if self.archive_png:
+                    writer = Thread(target=self.write_png, args=(self.scan_id, side_name, png_filename, img, trace))
+                    writer.start()
+
+                    with self.capture_lock:
+                        self.png_writers.append(writer)
+
+                response = 'FINISHED: side %s grabbed in %dms' % (side_name, grab_ms)
+            else:
+                response = 'ERROR: side %s no frame from the camera within 2s' % side_name
+
+        elif data == 'GET_RGB_COLORS':
+            response = self.wait_for_frames()
+
+            if response is None:
+                response = self.get_rgb_colors(trace, cancel)
+
+        elif data == 'GET_CUBE_SIZE':
+            response = self.get_cube_size()
+
+        elif data == 'GET_CAPTURE_STATS':
+            self.wait_for_png_writers()
+
+            with self.capture_lock:
+                response = json.dumps(self.capture_stats)
+
+        elif data.startswith('GET_CUBE_STATE:'):
+            cmd = ['rubiks-color-resolver.py', '--json', '--rgb', data[len('GET_CUBE_STATE:'):]]
+            log.info("cmd: %s" % ' '.join(cmd))
+            response = self.check_output('resolver', cmd, trace, cancel=cancel)
+
+        elif data.startswith('GET_CUBE_STATE_OLD:'):
+            cmd = ['rubiks-color-resolver-old.py', '--json', '--rgb', data[len('GET_CUBE_STATE_OLD:'):]]
+            log.info("cmd: %s" % ' '.join(cmd))
+            response = self.check_output('resolver-old', cmd, trace, cancel=cancel)
+
+        elif data == 'SOLVE_FROM_PICS':
+            response = self.solve_from_pics(progress, trace, cancel)
+
+        elif data == 'REPLAY_SCAN' or data.startswith('REPLAY_SCAN:'):
+            # The PNGs of the last scan taken with --archive-png by default
+            directory = data[len('REPLAY_SCAN:'):] or SCRATCHPAD_DIR
+            response = self.replay_scan(directory, trace, cancel)
+
+        elif data.startswith('GET_SOLUTION:'):
+            response = self.run_solver(data.split(':')[1], trace, cancel)
+
+        elif data.startswith('GET_TRACE:'):
+            solve_id = int(data.split(':')[1])
+
+            with self.span_lock:
+                response = json.dumps(self.spans.get(solve_id, []))
+
+        elif data.startswith('GET_PICTURE:'):
+            side_name = data.split(':')[1]
+            png_filename = os.path.join(SCRATCHPAD_DIR, 'rubiks-side-%s.png' % side_name)
+            self.wait_for_png_writers()
+
+            with self.capture_lock:
+                frame = self.frames.get(side_name)
+
+            if os.path.exists(png_filename):
+                with open(png_filename, 'rb') as fh:
+                    binary = fh.read()
+                response = 'FINISHED: %s is %d bytes' % (png_filename, len(binary))
+
+            elif frame:
+                # Not archived, encode the PNG from the FrameStore
+                (retval, png) = cv2.imencode('.png', frame_store.view(*frame))
+                binary = png.tostring()
+                response = 'FINISHED: side %s is %d bytes' % (side_name, len(binary))
+
+            else:
+                response = 'ERROR: there is no picture of side %s' % side_name
+
+        elif data == 'GET_CACHE_STATS':
+            response = json.dumps({'solutions': self.solution_cache.stats(), 'tracker': self.tracker_cache.stats()})
+
+        elif data == 'GET_WORKER_STATS':
+            with self.capture_lock:
+                response = json.dumps(self.worker_stats)
+
+        elif data == 'PING':
+            response = 'REPLY'
+
+        else:
+            log.warning("RXed %s (not supported)" % data)
+            response = 'ERROR: %s is not supported' % data
+
+        return (response, binary)
+
+    def read_requests(self, conn):
+        """
+        Called by the event loop after more data arrived on conn, queues
+        every complete request.  Returns False once the loop should stop
+        reading from conn.
+        """
+        if conn.one_shot_queued:
+            del conn.buf[:]
+            return True
+
+        if conn.framed is None:
+            if len(conn.buf) < len(protocol.MAGIC):
+                return True
+
+            # A framed client starts with protocol.MAGIC, anything else is a
+            # one-shot <START>cmd<END> client
+            conn.framed = bytes(conn.buf[:len(protocol.MAGIC)]) == protocol.MAGIC
+            log.info("%s is %s" % (conn, 'framed' if conn.framed else 'one-shot'))
+
+        if conn.framed:
+            while True:
+                try:
+                    (frame, length) = protocol.parse_frame(conn.buf)
+                except protocol.ProtocolError as e:
+                    log.warning("%s hit error\n%s" % (conn, e))
+                    conn.close()
+                    return False
+
+                if frame is None:
+                    return True
+
+                del conn.buf[:length]
+                self.queue_request(conn, frame.request_id, frame.text, frame.trace)
+
+        # Do we have the entire packet?  Only look at the end of the buffer,
+        # <END> may be split across two chunks.
+        if not bytes(conn.buf[-16:]).rstrip().endswith('<END>'):
+            return True
+
+        data = bytes(conn.buf).strip()
+
+        if not data.startswith('<START>'):
+            log.warning("%s RXed %s without <START>" % (conn, data))
+            conn.close()
+            return False
+
+        # Remove the <START> and <END>, the worker closes the connection
+        # once it has sent the response.  We keep reading so we notice if
+        # the client gives up before that.
+        conn.one_shot_queued = True
+        self.queue_request(conn, None, data[7:-5], None)
+        return True
+
+    def queue_request(self, conn, request_id, data, trace):
+        name = data.split(':')[0]
+        log.info("%s RXed %s (request %s)" % (conn, data, request_id))
+
+        # Handled right here so it never waits behind the request it cancels
+        if name == 'CANCEL':
+            self.handle_cancel(conn, request_id, data)
+            return
+
+        cancel = CancelToken()
+
+        with self.job_lock:
+            self.job_seq += 1
+            self.requests.setdefault(conn, {})[request_id] = cancel
+            job = (JOB_PRIORITY.get(name, DEFAULT_JOB_PRIORITY), self.job_seq,
+                   (conn, request_id, data, trace, datetime.datetime.now(), cancel))
+
+        if name in FAST_COMMANDS:
+            self.fast_queue.put(job)
+        else:
+            self.job_queue.put(job)
+
+    def handle_cancel(self, conn, request_id, data):
+        """
+        CANCEL:<request_id> cancels one of the requests of conn, CANCEL on
+        its own cancels all of them.  A one-shot connection carries only the
+        CANCEL itself so there is never anything for it to cancel.
+        """
+        with self.job_lock:
+            requests = self.requests.get(conn, {})
+
+            if request_id is None:
+                cancelled = None
+            elif data == 'CANCEL':
+                cancelled = list(requests.items())
+                requests.clear()
+            else:
+                try:
+                    cancel_id = int(data.split(':')[1])
+                except ValueError:
+                    cancel_id = None
+
+                if cancel_id in requests:
+                    cancelled = [(cancel_id, requests.pop(cancel_id))]
+                else:
+                    cancelled = []
+
+        if cancelled is None:
+            response = 'ERROR: CANCEL only works on a framed connection'
+        elif cancelled or data == 'CANCEL':
+            response = 'FINISHED: cancelled %d requests' % len(cancelled)
+        else:
+            response = 'ERROR: %s does not match a running request' % data
+
+        for (cancel_id, cancel) in cancelled or []:
+            self.cancel_request(conn, cancel_id, cancel, 'CANCEL')
+
+        try:
+            if request_id is None:
+                conn.sock.sendall(response)
+                conn.close()
+            else:
+                conn.send_frame(request_id, response)
+        except socket.error as e:
+            log.warning("%s hit error sending the CANCEL response\n%s" % (conn, e))
+
+    def cancel_requests(self, conn, reason):
+        """
+        Cancel everything conn is still waiting on
+        """
+        with self.job_lock:
+            cancelled = self.requests.pop(conn, {})
+
+        for (request_id, cancel) in cancelled.items():
+            self.cancel_request(conn, request_id, cancel, reason)
+
+    def cancel_request(self, conn, request_id, cancel, reason):
+        (stage, stage_start, cpu) = cancel.cancel()
+        saved = 0.0
+
+        if stage:
+            # What is left of the time the stage usually takes, the scripts
+            # are single threaded so that is also roughly their CPU time
+            with self.job_lock:
+                (count, total_ms) = self.stage_ms.get(stage, (0, 0))
+
+            if count:
+                saved = max(total_ms / count - delta_ms(stage_start), 0) / 1000.0
+
+            log.warning("%s %s, cancelled request %s and killed its %s stage which had used %.1f CPU seconds, ~%.1f more saved" %
+                        (conn, reason, request_id, stage, cpu, saved))
+        else:
+            log.warning("%s %s, cancelled request %s" % (conn, reason, request_id))
+
+        with self.capture_lock:
+            stats = self.worker_stats.setdefault('cancelled', {'requests': 0, 'stages_killed': 0, 'cpu_seconds_wasted': 0.0, 'cpu_seconds_saved': 0.0})
+            stats['requests'] += 1
+            stats['cpu_seconds_wasted'] = round(stats['cpu_seconds_wasted'] + cpu, 2)
+            stats['cpu_seconds_saved'] = round(stats['cpu_seconds_saved'] + saved, 2)
+
+            if stage:
+                stats['stages_killed'] += 1
+
+    def command_worker(self, queue):
+        """
+        Run the requests from queue, there is one of these for the
+        FAST_COMMANDS and --jobs of them for everything else
+        """
+        while True:
+            (_, _, job) = queue.get()
+
+            if job is None:
+                break
+
+            try:
+                self.run_request(*job)
+            except Exception as e:
+                log.exception(e)
+
+    def run_request(self, conn, request_id, data, trace, queued, cancel):
+        name = data.split(':')[0]
+        self.record_span(trace, 'queued', queued)
+
+        def progress(update):
+            conn.send_frame(request_id, update, flags=protocol.FLAG_PROGRESS)
+
+        try:
+            cancel.check()
+
+            if request_id is None:
+                (response, binary) = self.handle_command(data, cancel=cancel, queued=queued)
+            else:
+                (response, binary) = self.handle_command(data, progress, trace, cancel, queued)
+
+        except RequestCancelled:
+            log.warning("%s %s (request %s) was cancelled after %dms" % (conn, name, request_id, delta_ms(queued)))
+            (response, binary) = ('ERROR: %s was cancelled' % name, '')
+
+        except Exception as e:
+            log.exception(e)
+            (response, binary) = ('ERROR: %s failed, %s' % (name, e), '')
+
+        with self.job_lock:
+            requests = self.requests.get(conn, {})
+
+            if requests.get(request_id) is cancel:
+                del requests[request_id]
+
+                if not requests:
+                    del self.requests[conn]
+
+        # The client is gone, there is no one to tell
+        if conn.closed:
+            return
+
+        # The robot uses this span to line up our clock with its clock
+        self.record_span(trace, 'request %s' % name, queued)
+
+        try:
+            if request_id is None:
+                # One-shot, we signal the end of the response by closing the socket
+                conn.sock.sendall(response)
+                conn.close()
+            else:
+                conn.send_frame(request_id, response, binary)
+
+        except socket.error as e:
+            log.warning("%s hit error sending the %s response\n%s" % (conn, name, e))
+            return
+
+        if binary:
+            log.info("%s TXed %s response (request %s, %dms) with %d bytes of binary\n%s\n\n" %
+                     (conn, data, request_id, delta_ms(queued), len(binary), response))
+        else:
+            log.info("%s TXed %s response (request %s, %dms)\n%s\n\n" % (conn, data, request_id, delta_ms(queued), response))
+
+    def run_event_loop(self, tcp_socket):
+        """
+        All of the socket reads happen here, requests are handed to the
+        command workers which send the responses themselves
+        """
+        connections = []
+
+        while not self.shutdown_event.is_set():
+
+            # A worker closes a one-shot connection after sending the response
+            connections = [conn for conn in connections if not conn.closed]
+
+            # Wake up every second to check for a shutdown
+            try:
+                (readable, _, _) = select([tcp_socket] + connections, [], [], 1)
+            except (select_error, socket.error) as e:
+                # 4 is 'Interrupted system call', the signal handler has
+                # set shutdown_event.  9 is 'Bad file descriptor', a worker
+                # closed a connection since we checked.
+                if e[0] in (4, 9):
+                    continue
+                raise
+
+            for conn in readable:
+
+                if conn is tcp_socket:
+                    try:
+                        (sock, address) = tcp_socket.accept()
+                    except socket.error as e:
+                        log.warning("accept() hit error\n%s" % e)
+                        continue
+
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+                    # Only limits how long a worker can block sending a response
+                    sock.settimeout(30)
+                    connections.append(ClientConnection(sock, address))
+                    continue
+
+                if conn.closed:
+                    continue
+
+                try:
+                    chunk = conn.sock.recv(65536)
+                except socket.error as e:
+                    log.warning("%s hit error\n%s" % (conn, e))
+                    chunk = None
+
+                if not chunk:
+                    log.info("%s closed" % conn)
+                    connections.remove(conn)
+                    conn.close()
+                    self.cancel_requests(conn, 'disconnected')
+                    continue
+
+                conn.buf.extend(chunk)
+
+                if not self.read_requests(conn):
+                    connections.remove(conn)
+                    self.cancel_requests(conn, 'hit error')
+
+        for conn in connections:
+            conn.close()
+
+    def main(self):
+        caught_exception = False
+
+        # Log the process ID upon start-up.
+        pid = os.getpid()
+        log.info('cranecuberd started with PID %s for /dev/video%d' % (pid, self.dev_video))
+
+        # The tracker processes must be forked after the FrameStore exists
+        # and before we have any threads or sockets
+        self.solution_cache.load()
+        self.tracker_cache.load()
+
+        global frame_store
+        frame_store = FrameStore()
+
+        if RubiksImage:
+            self.tracker_pool = multiprocessing.Pool(TRACKER_PROCESSES)
+            log.info("%d tracker processes read frames from the FrameStore" % TRACKER_PROCESSES)
+        else:
+            log.warning("rubikscubetracker is not installed, archiving PNGs for rubiks-cube-tracker.py")
+
+        if self.workers:
+            self.script_pool = ScriptWorkers(self.workers)
+            log.info("%d script workers will run %s" % (self.workers, ', '.join(map(os.path.basename, WORKER_SCRIPTS))))
+
+            startup = Thread(target=self.measure_startup)
+            startup.daemon = True
+            startup.start()
+
+        if self.solver_workers:
+            self.solver_pool = ScriptWorkers(self.solver_workers, warm_solver_worker)
+            log.info("%d solver workers are warming up" % self.solver_workers)
+
+            tables = Thread(target=self.solver_tables.load)
+            tables.daemon = True
+            tables.start()
+
+        tcp_socket = open_tcp_socket(self.ip, self.port)
+
+        trackers = [Thread(target=self.tracker_worker) for _ in range(TRACKER_PROCESSES)]
+
+        for tracker in trackers:
+            tracker.daemon = True
+            tracker.start()
+
+        # calibrate the camera settings
+        # Let the camera adjust to the current lighting conditions then pin
+        # the brightness, etc it settled on
+        self.camera.start()
+        sleep(3)
+        (self.brightness, self.contrast, self.saturation, self.gain) = self.camera.lock_settings()
+        log.info("%s: %d frames captured while calibrating" % (self.camera, self.camera.frame_count))
+        log.info("brightness %s, contrast %s, saturation %s, gain %s" % (self.brightness, self.contrast, self.saturation, self.gain))
+
+        workers = [Thread(target=self.command_worker, args=(self.fast_queue,))]
+        workers.extend(Thread(target=self.command_worker, args=(self.job_queue,)) for _ in range(self.jobs))
+
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        log.info("running FAST_COMMANDS on their own worker and up to %d other jobs at a time" % self.jobs)
+
+        # Wrap the event loop in try/except so that we can log errors and
+        # exit cleanly
+        try:
+            self.run_event_loop(tcp_socket)
+        except Exception as e:
+            log.exception(e)
+            caught_exception = True
+
+        log.info('cranecuberd is stopping with PID %s' % pid)
+
+        # Let the workers exit before the interpreter tears down, a worker
+        # in the middle of a long solve is not waited on for long
+        self.shutdown_event.set()
+        for tracker in trackers:
+            tracker.join()
+
+        self.camera.stop()
+
+        for pool in (self.tracker_pool, self.script_pool, self.solver_pool):
+            if pool:
+                pool.terminate()
+                pool.join()
+        self.fast_queue.put((-1, 0, None))
+
+        for _ in range(self.jobs):
+            self.job_queue.put((-1, 0, None))
+
+        for worker in workers:
+            worker.join(5)
 
         if tcp_socket:
             tcp_socket.close()
@@ -242,6 +2232,15 @@ if __name__ == '__main__':
     parser.add_argument('--video', type=int, default=0, help='The X in /dev/videoX')
     parser.add_argument('--ip', type=str, default='')
     parser.add_argument('--port', type=int, default=10000)
+    parser.add_argument('--archive-png', action='store_true', default=False,
+                        help='Also write each picture to %s as a PNG (always done if rubikscubetracker can not be imported)' % SCRATCHPAD_DIR)
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Run the tracker, resolver and solver scripts in this many long lived worker processes '
+                             'instead of a new interpreter per request')
+    parser.add_argument('--solver-workers', type=int, default=0,
+                        help='Keep this many warm solver workers, the lookup tables in %s are paged in at start' % SOLVER_DIR)
+    parser.add_argument('--jobs', type=int, default=2,
+                        help='How many resolver/solver jobs can run at once, PING, TAKE_PICTURE, etc have their own worker')
     parser_args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO,
@@ -258,7 +2257,7 @@ if __name__ == '__main__':
     if not os.path.exists(SCRATCHPAD_DIR):
         os.makedirs(SCRATCHPAD_DIR, mode=0755)
 
-    ccd = CraneCuberDaemon(parser_args.video, parser_args.ip, parser_args.port)
+    ccd = CraneCuberDaemon(parser_args.video, parser_args.ip, parser_args.port, parser_args.jobs, parser_args.archive_png, parser_args.workers, parser_args.solver_workers)
 
     if parser_args.daemon:
         from daemon import DaemonContext
@@ -0,0 +1,169 @@
+"""
+Framing for the cranecuber.py <-> cranecuberd.py connection.  This is
+imported by both sides so it must work with python2 (cranecuberd.py) and
+python3 (cranecuber.py).
+
+Every request and every response is one frame, a fixed size header followed
+by a text part and an optional binary part:
+
+    magic          2 bytes   'CC'
+    flags          1 byte    FLAG_PROGRESS, FLAG_TRACE
+    request_id     4 bytes   the response echoes the id of its request
+    text_length    4 bytes
+    binary_length  4 bytes
+
+The text part is the command (or the response to it) as utf-8, the binary
+part carries things like PNGs or packed arrays as-is.  The lengths are known
+up front so the reader pulls each part in with a few large recv() calls
+instead of scanning for a terminator.
+
+A long running command may send any number of FLAG_PROGRESS frames before
+its final response, all of them carry the request id of the command.
+
+If FLAG_TRACE is set the header is followed by a (solve_id, span_id) trace
+context, cranecuberd records its spans for the request under it.
+"""
+
+from collections import namedtuple
+import socket
+import struct
+import sys
+
+MAGIC = b'CC'
+HEADER = struct.Struct('!2sBIII')
+
+# This frame is a progress update, the response is still to come
+FLAG_PROGRESS = 0x01
+
+# A TRACE (solve_id, span_id) follows the header
+FLAG_TRACE = 0x02
+TRACE = struct.Struct('!QI')
+
+# Nothing we send comes close to this, a larger length means the stream is garbage
+MAX_PART_LENGTH = 64 * 1024 * 1024
+
+PY3 = sys.version_info[0] >= 3
+
+
+Frame = namedtuple('Frame', ('request_id', 'flags', 'text', 'binary', 'trace'))
+
+
+class ConnectionClosed(socket.error):
+    pass
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def recv_exactly(sock, length):
+    """
+    Read exactly 'length' bytes from 'sock' straight into one buffer
+    """
+    buf = bytearray(length)
+    view = memoryview(buf)
+    received = 0
+
+    while received < length:
+        count = sock.recv_into(view[received:], length - received)
+
+        if not count:
+            raise ConnectionClosed("connection closed after %d of %d bytes" % (received, length))
+
+        received += count
+
+    return bytes(buf)
+
+
+def send_frame(sock, request_id, text, binary=b'', flags=0, trace=None):
+    """
+    trace is None or a (solve_id, span_id) tuple
+    """
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+
+    if trace:
+        flags |= FLAG_TRACE
+        trace = TRACE.pack(*trace)
+    else:
+        trace = b''
+
+    header = HEADER.pack(MAGIC, flags, request_id, len(text), len(binary))
+    sock.sendall(b''.join((header, trace, text, binary)))
+
+
+def unpack_header(data):
+    """
+    Returns (flags, request_id, text_length, binary_length) from the header
+    at the start of data
+    """
+    (magic, flags, request_id, text_length, binary_length) = HEADER.unpack_from(data)
+
+    if magic != MAGIC:
+        raise ProtocolError("bad magic %r, is the other side using the <START>/<END> protocol?" % magic)
+
+    if text_length > MAX_PART_LENGTH or binary_length > MAX_PART_LENGTH:
+        raise ProtocolError("frame %d is too large, %d text bytes and %d binary bytes" %
+                            (request_id, text_length, binary_length))
+
+    return (flags, request_id, text_length, binary_length)
+
+
+def recv_frame(sock):
+    """
+    Return the next Frame, text is a str on both python2 and python3 and
+    trace is None unless FLAG_TRACE is set
+    """
+    (flags, request_id, text_length, binary_length) = unpack_header(recv_exactly(sock, HEADER.size))
+
+    if flags & FLAG_TRACE:
+        trace = TRACE.unpack(recv_exactly(sock, TRACE.size))
+    else:
+        trace = None
+
+    text = recv_exactly(sock, text_length)
+
+    if binary_length:
+        binary = recv_exactly(sock, binary_length)
+    else:
+        binary = b''
+
+    if PY3:
+        text = text.decode('utf-8')
+
+    return Frame(request_id, flags, text, binary, trace)
+
+
+def parse_frame(buf):
+    """
+    For readers that do their own recv() into a bytearray.  Returns
+    (frame, length) if buf starts with a complete frame of 'length' bytes,
+    else (None, 0).
+    """
+    if len(buf) < HEADER.size:
+        return (None, 0)
+
+    (flags, request_id, text_length, binary_length) = unpack_header(buf)
+    offset = HEADER.size
+
+    if flags & FLAG_TRACE:
+        if len(buf) < offset + TRACE.size:
+            return (None, 0)
+
+        trace = TRACE.unpack_from(buf, offset)
+        offset += TRACE.size
+    else:
+        trace = None
+
+    length = offset + text_length + binary_length
+
+    if len(buf) < length:
+        return (None, 0)
+
+    text = bytes(buf[offset:offset + text_length])
+    binary = bytes(buf[offset + text_length:length])
+
+    if PY3:
+        text = text.decode('utf-8')
+
+    return (Frame(request_id, flags, text, binary, trace), length)
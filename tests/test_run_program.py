@@ -0,0 +1,60 @@
+"""
+run_program() must reject a bad step before the first step moves the cube
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cranecuber import CraneCuber3x3x3  # noqa: E402
+
+
+def make_cranecuber(calls):
+    """
+    A CraneCuber3x3x3 without any motors, its primitives are recorded in
+    calls instead of moving anything
+    """
+    cc = object.__new__(CraneCuber3x3x3)
+    cc.rows_and_cols = 3
+
+    class Event(object):
+        def is_set(self):
+            return False
+
+    cc.shutdown_event = Event()
+    cc.elevate = lambda rows: calls.append(('elevate', rows))
+    cc.rotate = lambda clockwise, quarter_turns, count_total_distance=False: calls.append(('rotate', clockwise, quarter_turns))
+    cc.flip = lambda slow=False: calls.append(('flip',))
+    return cc
+
+
+@pytest.mark.parametrize('bad_step', [
+    ['elevate', '3'],
+    ['elevate', True],
+    ['elevate', 4],
+    ['elevate'],
+    ['rotate', 1, 2, 3],
+    ['rotate', True, 3],
+    ['rotate', True],
+    ['flip', 'slow'],
+    ['scan_face', 'F'],
+    'flip',
+])
+def test_bad_step_is_rejected_before_anything_moves(bad_step):
+    calls = []
+    cc = make_cranecuber(calls)
+
+    with pytest.raises(Exception):
+        cc.run_program([['elevate', 3], ['rotate', True, 1], bad_step])
+
+    assert calls == []
+
+
+def test_good_program_runs():
+    calls = []
+    cc = make_cranecuber(calls)
+    cc.run_program([['elevate', 3], ['rotate', True, 1], ['rotate', False, 2, False], ['elevate', 0], ['flip']])
+    assert calls == [('elevate', 3), ('rotate', True, 1), ('rotate', False, 2), ('elevate', 0), ('flip',)]
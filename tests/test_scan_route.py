@@ -0,0 +1,88 @@
+"""
+Walk the routes from plan_scan_route() and check that every side is
+photographed the same way up as the fixed route photographs it, that is the
+orientation cranecuberd's tracker and resolver expect.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cranecuber import plan_scan_route  # noqa: E402
+
+START_FACING = ('B', 'L', 'F', 'R', 'U', 'D')
+
+
+def walk(route, rows_and_cols):
+    """
+    Replay route with the facing bookkeeping of CraneCuber.flip() and
+    CraneCuber.rotate().  Returns (side, side at the top of the picture)
+    for every scan_face step.
+    """
+    (rows, at_init, facing) = (0, True, START_FACING)
+    pictures = []
+
+    for step in route:
+        (north, west, south, east, up, down) = facing
+
+        if step[0] == 'elevate':
+            rows = step[1]
+
+        elif step[0] == 'flip':
+            if rows == 0:
+                if at_init:
+                    facing = (up, west, down, east, south, north)
+                else:
+                    facing = (down, west, up, east, north, south)
+            at_init = not at_init
+
+        elif step[0] == 'rotate':
+            assert rows == rows_and_cols, "rotate with only %d rows in the turntable" % rows
+
+            if step[2] == 2:
+                facing = (south, east, north, west, up, down)
+            elif step[1]:
+                facing = (west, south, east, north, up, down)
+            else:
+                facing = (east, north, west, south, up, down)
+
+        elif step[0] == 'scan_face':
+            assert rows == 0 and at_init, "%s scanned with the cube away from the camera" % step[1]
+            assert south == step[1], "expected %s to face the camera, it is %s" % (step[1], south)
+            pictures.append((south, up))
+
+    return pictures
+
+
+def fixed_route(rows_and_cols):
+    """
+    The steps of CraneCuber.scan_fixed_route(), including the picture of F
+    that scan_first_side() takes
+    """
+    up = ('elevate', rows_and_cols)
+    return [
+        ('scan_face', 'F'),
+        up, ('rotate', True, 1), ('elevate', 0), ('scan_face', 'R'),
+        up, ('rotate', True, 1), ('elevate', 0), ('scan_face', 'B'),
+        up, ('rotate', True, 1), ('elevate', 0), ('scan_face', 'L'),
+        up, ('rotate', True, 1), ('flip',), ('elevate', 0), ('flip',), ('scan_face', 'U'),
+        ('flip',), ('elevate', 1), ('flip',), ('elevate', 0),
+        ('flip',), ('elevate', 1), ('flip',), ('elevate', 0), ('scan_face', 'D'),
+    ]
+
+
+@pytest.mark.parametrize('rows_and_cols', [2, 3, 4, 5, 6, 7])
+def test_planned_route_matches_fixed_route_orientation(rows_and_cols):
+    expected = dict(walk(fixed_route(rows_and_cols), rows_and_cols))
+    assert expected == {'F': 'U', 'R': 'U', 'B': 'U', 'L': 'U', 'U': 'B', 'D': 'F'}
+
+    (route, cost_ms) = plan_scan_route(rows_and_cols, 0, True, START_FACING, ['F'])
+    pictures = walk([('scan_face', 'F')] + route, rows_and_cols)
+
+    assert sorted(side for (side, _) in pictures) == sorted(expected)
+
+    for (side, up) in pictures:
+        assert up == expected[side], "side %s is photographed with %s at the top instead of %s" % (side, up, expected[side])
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+"""
+Queue a job on the cranecuber.py --agent running on this EV3
+
+$ ./agent_client.py status
+$ ./agent_client.py scan-and-solve
+$ ./agent_client.py --size 3 run-solution "R U R' U'"
+$ ./agent_client.py --size 3 run-program program.json
+$ ./agent_client.py quit
+
+program.json is a list of primitives such as
+[["elevate", 3], ["rotate", true, 1], ["flip"], ["squish"]]
+"""
+
+from select import select
+from time import time
+import argparse
+import json
+import socket
+import sys
+
+parser = argparse.ArgumentParser(description="Queue a job on cranecuber.py --agent")
+parser.add_argument("job", type=str, choices=("status", "scan-and-solve", "run-solution", "run-program", "quit"))
+parser.add_argument("arg", type=str, nargs="?", help="the moves for run-solution, the program filename for run-program")
+parser.add_argument("--size", type=int, default=3, help="cube size for run-solution and run-program")
+parser.add_argument("--port", type=int, default=10001)
+parser.add_argument("--timeout", type=int, default=1800, help="seconds to wait for the job to finish")
+args = parser.parse_args()
+
+if args.job == "status":
+    cmd = "STATUS"
+elif args.job == "scan-and-solve":
+    cmd = "SCAN_AND_SOLVE"
+elif args.job == "run-solution":
+    cmd = "RUN_SOLUTION:%d:%s" % (args.size, args.arg)
+elif args.job == "run-program":
+    with open(args.arg, "r") as fh:
+        cmd = "RUN_PROGRAM:%s" % json.dumps({"size": args.size, "program": json.load(fh)})
+else:
+    cmd = "QUIT"
+
+start = time()
+sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+sock.connect(("127.0.0.1", args.port))
+sock.sendall(("<START>" + cmd + "<END>").encode())
+total_data = []
+
+while True:
+    ready = select([sock], [], [], args.timeout)
+
+    if not ready[0]:
+        print("ERROR: no response within %d seconds" % args.timeout)
+        sys.exit(1)
+
+    data = sock.recv(4096)
+
+    if not data:
+        break
+
+    total_data.append(data.decode())
+
+sock.close()
+response = "".join(total_data)
+print("%s (%dms)" % (response, (time() - start) * 1000))
+
+if not response.startswith("FINISHED"):
+    sys.exit(1)
@@ -2,8 +2,27 @@
 
 """
 Stop all motors
+
+The motors are braked in parallel, one thread per motor, so the last motor
+does not have to wait on the sysfs writes for the others.
 """
 from ev3dev2.motor import list_motors
+from threading import Thread
+from time import time
+
 
-for motor in list_motors():
+def brake(motor):
     motor.stop(stop_action='brake')
+    motor.wait_until_not_moving(timeout=1000)
+
+
+start = time()
+threads = [Thread(target=brake, args=(motor,)) for motor in list_motors()]
+
+for thread in threads:
+    thread.start()
+
+for thread in threads:
+    thread.join()
+
+print("%d motors stopped in %dms" % (len(threads), (time() - start) * 1000))